@@ -19,92 +19,137 @@ Description:
 """
 import os
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import tabulate
+from array import array
 from dotenv import load_dotenv
 
 
 class MFStructure:
-    def __init__(self, cust, prod):
-        self.cust = cust
-        self.prod = prod
-        self.count_quant = 0
-        self.sum_quant = 0
-        self.sum_1_quant = 0
+    """
+    Struct-of-arrays MF structure: group g has grouping key keys[g] and each aggregate
+    is an array('q') column indexed by g.
+    """
+    __slots__ = ('index', 'keys', 'count_quant', 'sum_quant', 'sum_1_quant')
 
-# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+    def __init__(self):
+        self.index = {}   # grouping key tuple (V) -> group id
+        self.keys = []    # group id -> grouping key tuple
+        # 0th scan aggregates grow by one entry per new group
+        self.count_quant = array('q')
+        self.sum_quant = array('q')
 
-def query():
-    load_dotenv()
+    def allocate(self):
+        """
+        Preallocates the grouping variable aggregates, initialized to 0, once the 0th
+        scan has found every group.
+        """
+        n_groups = len(self.keys)
+        self.sum_1_quant = array('q', [0]) * n_groups
 
-    user = os.getenv('USER')
-    password = os.getenv('PASSWORD')
-    dbname = os.getenv('DBNAME')
+    def extend(self, other):
+        """
+        Appends the groups of another (allocated) MF structure that has no group in common
+        with this one, e.g. the result of another partition of the rows.
+        """
+        offset = len(self.keys)
+        self.index.update((key, offset + g) for key, g in other.index.items())
+        self.keys.extend(other.keys)
+        self.count_quant.extend(other.count_quant)
+        self.sum_quant.extend(other.sum_quant)
+        self.sum_1_quant.extend(other.sum_1_quant)
 
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-    sales_rows = cur.fetchall()
-    _global = []
-    
-    h_table = [] # Initialize empty list to store MFStructure entries for each unique group
-    # First scan: populate h_table with grouping key combinations and compute 0th g.v aggregates
+    def add_groups(self, group_keys):
+        """
+        Adds the grouping keys that have no group yet, with every aggregate 0.
+        """
+        for key in group_keys:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.count_quant.append(0)
+                self.sum_quant.append(0)
+                self.sum_1_quant.append(0)
+
+
+SALES_QUERY = 'SELECT cust, prod, quant FROM sales'
+
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+def mf_scans(sales_rows, group_rows=None):
+    """
+    Runs the 0th scan and every grouping variable scan over sales_rows and returns the MF structure.
+    """
+    mf = MFStructure()
+    index = mf.index   # grouping key tuple (V) -> group id, O(1) lookup per row
+    keys = mf.keys
+    count_quant = mf.count_quant
+    sum_quant = mf.sum_quant
+    # First scan: populate the groups and compute 0th g.v aggregates
     for row in sales_rows:
-        found = False   # Flag to check if a matching group already exists in h_table
-        for entry in h_table:
-            # Check if current row matches an existing group (i.e., same grouping key values)
-            if entry.cust == row['cust'] and entry.prod == row['prod']:
-                found = True
-                # Loop through all attributes in the MFStructure object and update aggregates
-                for att,val in vars(entry).items():
-                    if att=='sum_quant':
-                        entry.sum_quant += row['quant']
-                    if att=='min_quant':
-                        if entry.min_quant > row['quant']:
-                            entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        if entry.max_quant < row['quant']:
-                            entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        entry.count_quant += 1
-                break   # Stop scanning once the correct group is updated
-        if not found:
-            # If this is a new group, create a new MFStructure entry
-            new_entry = MFStructure(row['cust'], row['prod'])
-            # Initialize the required aggregate fields with current row's quant value
-            for att,val in vars(new_entry).items():
-                    if att=='sum_quant':
-                        new_entry.sum_quant = row['quant']
-                    if att=='min_quant':
-                        new_entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        new_entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        new_entry.count_quant = 1
-            h_table.append(new_entry)   # Add the new group entry to the h_table
-    
+        key = (row[0], row[1])
+        g = index.get(key)
+        if g is None:
+            # New group: its id is the next position in every column
+            index[key] = len(keys)
+            keys.append(key)
+            count_quant.append(1)
+            sum_quant.append(row[2])
+        else:
+            count_quant[g] += 1
+            sum_quant[g] += row[2]
     # Logic to compute grouping_variable aggregates
+    mf.allocate()
+    sum_1_quant = mf.sum_1_quant
     
-    # Scan for grouping variable 1
+    # Scan 1: grouping variable 1
     for row in sales_rows:
-        for entry in h_table:
-            if row['quant'] > (entry.sum_quant / entry.count_quant if entry.count_quant != 0 else 0):
-                if entry.cust == row['cust'] and entry.prod == row['prod']:
-                    entry.sum_1_quant += row['quant']
-                    break
-
-    # Sorting the h_table by grouping key attributes to keep output consistent   
-    h_table.sort(key=lambda x: tuple(getattr(x, attr) for attr in ['cust', 'prod']))
-    # Apply the final selection condition (G_condition) and prepare result for output
-    for entry in h_table:
+        g = index[(row[0], row[1])]  # O(1) lookup of the row's group id
+        # Grouping variable 1
+        if row[2] > (sum_quant[g] / count_quant[g] if count_quant[g] != 0 else 0):
+            sum_1_quant[g] += row[2]
+
+    return mf
+
+
+def mf_output(mf):
+    """
+    Applies G to the groups of the MF structure and projects S, in grouping key order.
+    """
+    index = mf.index
+    count_quant = mf.count_quant
+    sum_quant = mf.sum_quant
+    sum_1_quant = mf.sum_1_quant
+    _global = []
+    # Build the sorted view of the groups once, only for the final output
+    for key, g in sorted(index.items()):
         if True:
             _global.append({
-            'cust': entry.cust, 'prod': entry.prod, 'sum_quant': entry.sum_quant, 'sum_1_quant': entry.sum_1_quant
-    })       
-    
-    
-    return tabulate.tabulate(_global,
+            'cust': key[0], 'prod': key[1], 'sum_quant': sum_quant[g], 'sum_1_quant': sum_1_quant[g]
+    })
+    return _global
+
+
+def run(conn):
+    """
+    Runs the MF query over an open connection and returns the output rows as dicts.
+    """
+    cur = conn.cursor()
+    cur.execute(SALES_QUERY)
+    sales_rows = cur.fetchall()
+    mf = mf_scans(sales_rows)
+    return mf_output(mf)
+
+
+def query():
+    load_dotenv()
+
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)
+    return tabulate.tabulate(run(conn),
                         headers="keys", tablefmt="psql")
 
 def main():
@@ -19,20 +19,140 @@ Description:
 """
 import os
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import tabulate
+from array import array
 from dotenv import load_dotenv
 
 
 class MFStructure:
-    def __init__(self, cust):
-        self.cust = cust
-        self.sum_1_quant = 0
-        self.count_2_quant = 0
-        self.sum_2_quant = 0
+    """
+    Struct-of-arrays MF structure: group g has grouping key keys[g] and each aggregate
+    is an array('q') column indexed by g.
+    """
+    __slots__ = ('index', 'keys', 'sum_1_quant', 'count_2_quant', 'sum_2_quant')
+
+    def __init__(self):
+        self.index = {}   # grouping key tuple (V) -> group id
+        self.keys = []    # group id -> grouping key tuple
+        # 0th scan aggregates grow by one entry per new group
+
+    def allocate(self):
+        """
+        Preallocates the grouping variable aggregates, initialized to 0, once the 0th
+        scan has found every group.
+        """
+        n_groups = len(self.keys)
+        self.sum_1_quant = array('q', [0]) * n_groups
+        self.count_2_quant = array('q', [0]) * n_groups
+        self.sum_2_quant = array('q', [0]) * n_groups
+
+    def extend(self, other):
+        """
+        Appends the groups of another (allocated) MF structure that has no group in common
+        with this one, e.g. the result of another partition of the rows.
+        """
+        offset = len(self.keys)
+        self.index.update((key, offset + g) for key, g in other.index.items())
+        self.keys.extend(other.keys)
+        self.sum_1_quant.extend(other.sum_1_quant)
+        self.count_2_quant.extend(other.count_2_quant)
+        self.sum_2_quant.extend(other.sum_2_quant)
+
+    def add_groups(self, group_keys):
+        """
+        Adds the grouping keys that have no group yet, with every aggregate 0.
+        """
+        for key in group_keys:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.sum_1_quant.append(0)
+                self.count_2_quant.append(0)
+                self.sum_2_quant.append(0)
+
+
+SALES_QUERY = "SELECT cust, state, quant FROM sales WHERE (state = 'NY') OR (state = 'NJ')"
+GROUPS_QUERY = 'SELECT DISTINCT cust FROM sales'
 
 # DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
 
+def mf_scans(sales_rows, group_rows=None):
+    """
+    Runs the 0th scan and every grouping variable scan over sales_rows and returns the MF structure.
+    """
+    mf = MFStructure()
+    index = mf.index   # grouping key tuple (V) -> group id, O(1) lookup per row
+    keys = mf.keys
+    # First scan: there are no 0th g.v aggregates, so the groups come straight from GROUPS_QUERY
+    # (sales_rows only holds the rows matching the pushed-down sigma predicates)
+    if group_rows is not None:
+        for key in group_rows:
+            index[key] = len(keys)
+            keys.append(key)
+    else:
+        for row in sales_rows:
+            key = (row[0],)
+            if key not in index:
+                index[key] = len(keys)
+                keys.append(key)
+
+    # Logic to compute grouping_variable aggregates
+    mf.allocate()
+    sum_1_quant = mf.sum_1_quant
+    count_2_quant = mf.count_2_quant
+    sum_2_quant = mf.sum_2_quant
+    
+    # Scan 1: grouping variables 1, 2 fused into one pass (they only depend on earlier scans)
+    for row in sales_rows:
+        accept_1 = row[1] == 'NY'
+        accept_2 = row[1] == 'NJ'
+        if accept_1 or accept_2:
+            g = index[(row[0],)]  # O(1) lookup of the row's group id
+            # Grouping variable 1
+            if accept_1:
+                sum_1_quant[g] += row[2]
+            # Grouping variable 2
+            if accept_2:
+                count_2_quant[g] += 1
+                sum_2_quant[g] += row[2]
+
+    return mf
+
+
+def mf_output(mf):
+    """
+    Applies G to the groups of the MF structure and projects S, in grouping key order.
+    """
+    index = mf.index
+    sum_1_quant = mf.sum_1_quant
+    count_2_quant = mf.count_2_quant
+    sum_2_quant = mf.sum_2_quant
+    _global = []
+    # Build the sorted view of the groups once, only for the final output
+    for key, g in sorted(index.items()):
+        if sum_1_quant[g]>(sum_2_quant[g] / count_2_quant[g] if count_2_quant[g] != 0 else 0):
+            _global.append({
+            'cust': key[0]
+    })
+    return _global
+
+
+def run(conn):
+    """
+    Runs the MF query over an open connection and returns the output rows as dicts.
+    """
+    # GROUPS_QUERY and SALES_QUERY must see the same snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cur = conn.cursor()
+    cur.execute(GROUPS_QUERY)
+    group_rows = cur.fetchall()
+    cur.execute(SALES_QUERY)
+    sales_rows = cur.fetchall()
+    mf = mf_scans(sales_rows, group_rows)
+    return mf_output(mf)
+
+
 def query():
     load_dotenv()
 
@@ -40,78 +160,8 @@ def query():
     password = os.getenv('PASSWORD')
     dbname = os.getenv('DBNAME')
 
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-    sales_rows = cur.fetchall()
-    _global = []
-    
-    h_table = [] # Initialize empty list to store MFStructure entries for each unique group
-    # First scan: populate h_table with grouping key combinations and compute 0th g.v aggregates
-    for row in sales_rows:
-        found = False   # Flag to check if a matching group already exists in h_table
-        for entry in h_table:
-            # Check if current row matches an existing group (i.e., same grouping key values)
-            if entry.cust == row['cust']:
-                found = True
-                # Loop through all attributes in the MFStructure object and update aggregates
-                for att,val in vars(entry).items():
-                    if att=='sum_quant':
-                        entry.sum_quant += row['quant']
-                    if att=='min_quant':
-                        if entry.min_quant > row['quant']:
-                            entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        if entry.max_quant < row['quant']:
-                            entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        entry.count_quant += 1
-                break   # Stop scanning once the correct group is updated
-        if not found:
-            # If this is a new group, create a new MFStructure entry
-            new_entry = MFStructure(row['cust'])
-            # Initialize the required aggregate fields with current row's quant value
-            for att,val in vars(new_entry).items():
-                    if att=='sum_quant':
-                        new_entry.sum_quant = row['quant']
-                    if att=='min_quant':
-                        new_entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        new_entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        new_entry.count_quant = 1
-            h_table.append(new_entry)   # Add the new group entry to the h_table
-    
-    # Logic to compute grouping_variable aggregates
-    
-    # Scan for grouping variable 1
-    for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NY':
-                if entry.cust == row['cust']:
-                    entry.sum_1_quant += row['quant']
-                    break
-
-    # Scan for grouping variable 2
-    for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NJ':
-                if entry.cust == row['cust']:
-                    entry.sum_2_quant += row['quant']; entry.count_2_quant += 1
-                    break
-
-    # Sorting the h_table by grouping key attributes to keep output consistent   
-    h_table.sort(key=lambda x: tuple(getattr(x, attr) for attr in ['cust']))
-    # Apply the final selection condition (G_condition) and prepare result for output
-    for entry in h_table:
-        if entry.sum_1_quant>(entry.sum_2_quant / entry.count_2_quant if entry.count_2_quant != 0 else 0):
-            _global.append({
-            'cust': entry.cust
-    })       
-    
-    
-    return tabulate.tabulate(_global,
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)
+    return tabulate.tabulate(run(conn),
                         headers="keys", tablefmt="psql")
 
 def main():
@@ -19,112 +19,172 @@ Description:
 """
 import os
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import tabulate
+from array import array
 from dotenv import load_dotenv
 
 
 class MFStructure:
-    def __init__(self, cust, prod):
-        self.prod = prod
-        self.cust = cust
-        self.count_quant = 0
-        self.sum_quant = 0
-        self.count_1_quant = 0
-        self.sum_1_quant = 0
-        self.count_2_quant = 0
-        self.sum_2_quant = 0
-        self.max_3_quant = 0
+    """
+    Struct-of-arrays MF structure: group g has grouping key keys[g] and each aggregate
+    is an array('q') column indexed by g.
+    """
+    __slots__ = ('index', 'keys', 'count_quant', 'sum_quant', 'count_1_quant', 'sum_1_quant', 'count_2_quant', 'sum_2_quant', 'max_3_quant')
 
-# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+    def __init__(self):
+        self.index = {}   # grouping key tuple (V) -> group id
+        self.keys = []    # group id -> grouping key tuple
+        # 0th scan aggregates grow by one entry per new group
+        self.count_quant = array('q')
+        self.sum_quant = array('q')
 
-def query():
-    load_dotenv()
+    def allocate(self):
+        """
+        Preallocates the grouping variable aggregates, initialized to 0, once the 0th
+        scan has found every group.
+        """
+        n_groups = len(self.keys)
+        self.count_1_quant = array('q', [0]) * n_groups
+        self.sum_1_quant = array('q', [0]) * n_groups
+        self.count_2_quant = array('q', [0]) * n_groups
+        self.sum_2_quant = array('q', [0]) * n_groups
+        self.max_3_quant = array('q', [0]) * n_groups
 
-    user = os.getenv('USER')
-    password = os.getenv('PASSWORD')
-    dbname = os.getenv('DBNAME')
+    def extend(self, other):
+        """
+        Appends the groups of another (allocated) MF structure that has no group in common
+        with this one, e.g. the result of another partition of the rows.
+        """
+        offset = len(self.keys)
+        self.index.update((key, offset + g) for key, g in other.index.items())
+        self.keys.extend(other.keys)
+        self.count_quant.extend(other.count_quant)
+        self.sum_quant.extend(other.sum_quant)
+        self.count_1_quant.extend(other.count_1_quant)
+        self.sum_1_quant.extend(other.sum_1_quant)
+        self.count_2_quant.extend(other.count_2_quant)
+        self.sum_2_quant.extend(other.sum_2_quant)
+        self.max_3_quant.extend(other.max_3_quant)
 
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-    sales_rows = cur.fetchall()
-    _global = []
-    
-    h_table = [] # Initialize empty list to store MFStructure entries for each unique group
-    # First scan: populate h_table with grouping key combinations and compute 0th g.v aggregates
+    def add_groups(self, group_keys):
+        """
+        Adds the grouping keys that have no group yet, with every aggregate 0.
+        """
+        for key in group_keys:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.count_quant.append(0)
+                self.sum_quant.append(0)
+                self.count_1_quant.append(0)
+                self.sum_1_quant.append(0)
+                self.count_2_quant.append(0)
+                self.sum_2_quant.append(0)
+                self.max_3_quant.append(0)
+
+
+SALES_QUERY = 'SELECT cust, prod, state, quant FROM sales'
+
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+def mf_scans(sales_rows, group_rows=None):
+    """
+    Runs the 0th scan and every grouping variable scan over sales_rows and returns the MF structure.
+    """
+    mf = MFStructure()
+    index = mf.index   # grouping key tuple (V) -> group id, O(1) lookup per row
+    keys = mf.keys
+    count_quant = mf.count_quant
+    sum_quant = mf.sum_quant
+    # First scan: populate the groups and compute 0th g.v aggregates
     for row in sales_rows:
-        found = False   # Flag to check if a matching group already exists in h_table
-        for entry in h_table:
-            # Check if current row matches an existing group (i.e., same grouping key values)
-            if entry.cust == row['cust'] and entry.prod == row['prod']:
-                found = True
-                # Loop through all attributes in the MFStructure object and update aggregates
-                for att,val in vars(entry).items():
-                    if att=='sum_quant':
-                        entry.sum_quant += row['quant']
-                    if att=='min_quant':
-                        if entry.min_quant > row['quant']:
-                            entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        if entry.max_quant < row['quant']:
-                            entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        entry.count_quant += 1
-                break   # Stop scanning once the correct group is updated
-        if not found:
-            # If this is a new group, create a new MFStructure entry
-            new_entry = MFStructure(row['cust'], row['prod'])
-            # Initialize the required aggregate fields with current row's quant value
-            for att,val in vars(new_entry).items():
-                    if att=='sum_quant':
-                        new_entry.sum_quant = row['quant']
-                    if att=='min_quant':
-                        new_entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        new_entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        new_entry.count_quant = 1
-            h_table.append(new_entry)   # Add the new group entry to the h_table
-    
+        key = (row[0], row[1])
+        g = index.get(key)
+        if g is None:
+            # New group: its id is the next position in every column
+            index[key] = len(keys)
+            keys.append(key)
+            count_quant.append(1)
+            sum_quant.append(row[3])
+        else:
+            count_quant[g] += 1
+            sum_quant[g] += row[3]
     # Logic to compute grouping_variable aggregates
+    mf.allocate()
+    count_1_quant = mf.count_1_quant
+    sum_1_quant = mf.sum_1_quant
+    count_2_quant = mf.count_2_quant
+    sum_2_quant = mf.sum_2_quant
+    max_3_quant = mf.max_3_quant
     
-    # Scan for grouping variable 1
+    # Scan 1: grouping variables 1, 2 fused into one pass (they only depend on earlier scans)
     for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NY':
-                if entry.cust == row['cust'] and entry.prod == row['prod']:
-                    entry.count_1_quant += 1; entry.sum_1_quant += row['quant']
-                    break
+        accept_1 = row[2] == 'NY'
+        accept_2 = row[2] == 'NJ'
+        if accept_1 or accept_2:
+            g = index[(row[0], row[1])]  # O(1) lookup of the row's group id
+            # Grouping variable 1
+            if accept_1:
+                count_1_quant[g] += 1
+                sum_1_quant[g] += row[3]
+            # Grouping variable 2
+            if accept_2 and row[3] > (sum_quant[g] / count_quant[g] if count_quant[g] != 0 else 0):
+                count_2_quant[g] += 1
+                sum_2_quant[g] += row[3]
 
-    # Scan for grouping variable 2
+    # Scan 2: grouping variable 3
     for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NJ' and row['quant'] > (entry.sum_quant / entry.count_quant if entry.count_quant != 0 else 0):
-                if entry.cust == row['cust'] and entry.prod == row['prod']:
-                    entry.count_2_quant += 1; entry.sum_2_quant += row['quant']
-                    break
+        if row[2] == 'CT':
+            g = index[(row[0], row[1])]  # O(1) lookup of the row's group id
+            if row[3] < (sum_2_quant[g] / count_2_quant[g] if count_2_quant[g] != 0 else 0):
+                if row[3] > max_3_quant[g]: max_3_quant[g] = row[3]
 
-    # Scan for grouping variable 3
-    for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'CT' and row['quant'] < (entry.sum_2_quant / entry.count_2_quant if entry.count_2_quant != 0 else 0):
-                if entry.cust == row['cust'] and entry.prod == row['prod']:
-                    entry.max_3_quant = max(entry.max_3_quant, row['quant'])
-                    break
-
-    # Sorting the h_table by grouping key attributes to keep output consistent   
-    h_table.sort(key=lambda x: tuple(getattr(x, attr) for attr in ['cust', 'prod']))
-    # Apply the final selection condition (G_condition) and prepare result for output
-    for entry in h_table:
-        if (entry.sum_2_quant / entry.count_2_quant if entry.count_2_quant != 0 else 0) > 500 and entry.max_3_quant > (entry.sum_quant / entry.count_quant if entry.count_quant != 0 else 0):
+    return mf
+
+
+def mf_output(mf):
+    """
+    Applies G to the groups of the MF structure and projects S, in grouping key order.
+    """
+    index = mf.index
+    count_quant = mf.count_quant
+    sum_quant = mf.sum_quant
+    count_1_quant = mf.count_1_quant
+    sum_1_quant = mf.sum_1_quant
+    count_2_quant = mf.count_2_quant
+    sum_2_quant = mf.sum_2_quant
+    max_3_quant = mf.max_3_quant
+    _global = []
+    # Build the sorted view of the groups once, only for the final output
+    for key, g in sorted(index.items()):
+        if (sum_2_quant[g] / count_2_quant[g] if count_2_quant[g] != 0 else 0) > 500 and max_3_quant[g] > (sum_quant[g] / count_quant[g] if count_quant[g] != 0 else 0):
             _global.append({
-            'cust': entry.cust, 'prod': entry.prod, 'avg_quant': (entry.sum_quant / entry.count_quant) if entry.count_quant != 0 else 0, 'sum_1_quant': entry.sum_1_quant, 'count_1_quant': entry.count_1_quant, 'avg_2_quant': (entry.sum_2_quant / entry.count_2_quant) if entry.count_2_quant != 0 else 0, 'max_3_quant': entry.max_3_quant
-    })       
-    
-    
-    return tabulate.tabulate(_global,
+            'cust': key[0], 'prod': key[1], 'avg_quant': (sum_quant[g] / count_quant[g]) if count_quant[g] != 0 else 0, 'sum_1_quant': sum_1_quant[g], 'count_1_quant': count_1_quant[g], 'avg_2_quant': (sum_2_quant[g] / count_2_quant[g]) if count_2_quant[g] != 0 else 0, 'max_3_quant': max_3_quant[g]
+    })
+    return _global
+
+
+def run(conn):
+    """
+    Runs the MF query over an open connection and returns the output rows as dicts.
+    """
+    cur = conn.cursor()
+    cur.execute(SALES_QUERY)
+    sales_rows = cur.fetchall()
+    mf = mf_scans(sales_rows)
+    return mf_output(mf)
+
+
+def query():
+    load_dotenv()
+
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)
+    return tabulate.tabulate(run(conn),
                         headers="keys", tablefmt="psql")
 
 def main():
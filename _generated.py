@@ -19,107 +19,152 @@ Description:
 """
 import os
 import psycopg2
-import psycopg2.extras
+import psycopg2.extensions
 import tabulate
+from array import array
 from dotenv import load_dotenv
 
 
 class MFStructure:
-    def __init__(self, cust):
-        self.cust = cust
-        self.count_1_quant = 0
-        self.sum_2_quant = 0
-        self.max_3_quant = 0
+    """
+    Struct-of-arrays MF structure: group g has grouping key keys[g] and each aggregate
+    is an array('q') column indexed by g.
+    """
+    __slots__ = ('index', 'keys', 'count_1_quant', 'sum_2_quant', 'max_3_quant')
 
-# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+    def __init__(self):
+        self.index = {}   # grouping key tuple (V) -> group id
+        self.keys = []    # group id -> grouping key tuple
+        # 0th scan aggregates grow by one entry per new group
 
-def query():
-    load_dotenv()
+    def allocate(self):
+        """
+        Preallocates the grouping variable aggregates, initialized to 0, once the 0th
+        scan has found every group.
+        """
+        n_groups = len(self.keys)
+        self.count_1_quant = array('q', [0]) * n_groups
+        self.sum_2_quant = array('q', [0]) * n_groups
+        self.max_3_quant = array('q', [0]) * n_groups
 
-    user = os.getenv('USER')
-    password = os.getenv('PASSWORD')
-    dbname = os.getenv('DBNAME')
+    def extend(self, other):
+        """
+        Appends the groups of another (allocated) MF structure that has no group in common
+        with this one, e.g. the result of another partition of the rows.
+        """
+        offset = len(self.keys)
+        self.index.update((key, offset + g) for key, g in other.index.items())
+        self.keys.extend(other.keys)
+        self.count_1_quant.extend(other.count_1_quant)
+        self.sum_2_quant.extend(other.sum_2_quant)
+        self.max_3_quant.extend(other.max_3_quant)
+
+    def add_groups(self, group_keys):
+        """
+        Adds the grouping keys that have no group yet, with every aggregate 0.
+        """
+        for key in group_keys:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key)
+                self.count_1_quant.append(0)
+                self.sum_2_quant.append(0)
+                self.max_3_quant.append(0)
+
+
+SALES_QUERY = "SELECT cust, state, quant FROM sales WHERE (state = 'NY') OR (state = 'NJ') OR (state = 'CT')"
+GROUPS_QUERY = 'SELECT DISTINCT cust FROM sales'
+
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+def mf_scans(sales_rows, group_rows=None):
+    """
+    Runs the 0th scan and every grouping variable scan over sales_rows and returns the MF structure.
+    """
+    mf = MFStructure()
+    index = mf.index   # grouping key tuple (V) -> group id, O(1) lookup per row
+    keys = mf.keys
+    # First scan: there are no 0th g.v aggregates, so the groups come straight from GROUPS_QUERY
+    # (sales_rows only holds the rows matching the pushed-down sigma predicates)
+    if group_rows is not None:
+        for key in group_rows:
+            index[key] = len(keys)
+            keys.append(key)
+    else:
+        for row in sales_rows:
+            key = (row[0],)
+            if key not in index:
+                index[key] = len(keys)
+                keys.append(key)
 
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-    sales_rows = cur.fetchall()
-    _global = []
-    
-    h_table = [] # Initialize empty list to store MFStructure entries for each unique group
-    # First scan: populate h_table with grouping key combinations and compute 0th g.v aggregates
-    for row in sales_rows:
-        found = False   # Flag to check if a matching group already exists in h_table
-        for entry in h_table:
-            # Check if current row matches an existing group (i.e., same grouping key values)
-            if entry.cust == row['cust']:
-                found = True
-                # Loop through all attributes in the MFStructure object and update aggregates
-                for att,val in vars(entry).items():
-                    if att=='sum_quant':
-                        entry.sum_quant += row['quant']
-                    if att=='min_quant':
-                        if entry.min_quant > row['quant']:
-                            entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        if entry.max_quant < row['quant']:
-                            entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        entry.count_quant += 1
-                break   # Stop scanning once the correct group is updated
-        if not found:
-            # If this is a new group, create a new MFStructure entry
-            new_entry = MFStructure(row['cust'])
-            # Initialize the required aggregate fields with current row's quant value
-            for att,val in vars(new_entry).items():
-                    if att=='sum_quant':
-                        new_entry.sum_quant = row['quant']
-                    if att=='min_quant':
-                        new_entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        new_entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        new_entry.count_quant = 1
-            h_table.append(new_entry)   # Add the new group entry to the h_table
-    
     # Logic to compute grouping_variable aggregates
+    mf.allocate()
+    count_1_quant = mf.count_1_quant
+    sum_2_quant = mf.sum_2_quant
+    max_3_quant = mf.max_3_quant
     
-    # Scan for grouping variable 1
+    # Scan 1: grouping variables 1, 2, 3 fused into one pass (they only depend on earlier scans)
     for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NY':
-                if entry.cust == row['cust']:
-                    entry.count_1_quant += 1
-                    break
+        accept_1 = row[1] == 'NY'
+        accept_2 = row[1] == 'NJ'
+        accept_3 = row[1] == 'CT'
+        if accept_1 or accept_2 or accept_3:
+            g = index[(row[0],)]  # O(1) lookup of the row's group id
+            # Grouping variable 1
+            if accept_1:
+                count_1_quant[g] += 1
+            # Grouping variable 2
+            if accept_2:
+                sum_2_quant[g] += row[2]
+            # Grouping variable 3
+            if accept_3:
+                if row[2] > max_3_quant[g]: max_3_quant[g] = row[2]
 
-    # Scan for grouping variable 2
-    for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'NJ':
-                if entry.cust == row['cust']:
-                    entry.sum_2_quant += row['quant']
-                    break
+    return mf
 
-    # Scan for grouping variable 3
-    for row in sales_rows:
-        for entry in h_table:
-            if row['state'] == 'CT':
-                if entry.cust == row['cust']:
-                    entry.max_3_quant = max(entry.max_3_quant, row['quant'])
-                    break
-
-    # Sorting the h_table by grouping key attributes to keep output consistent   
-    h_table.sort(key=lambda x: tuple(getattr(x, attr) for attr in ['cust']))
-    # Apply the final selection condition (G_condition) and prepare result for output
-    for entry in h_table:
+
+def mf_output(mf):
+    """
+    Applies G to the groups of the MF structure and projects S, in grouping key order.
+    """
+    index = mf.index
+    count_1_quant = mf.count_1_quant
+    sum_2_quant = mf.sum_2_quant
+    max_3_quant = mf.max_3_quant
+    _global = []
+    # Build the sorted view of the groups once, only for the final output
+    for key, g in sorted(index.items()):
         if True:
             _global.append({
-            'cust': entry.cust, 'count_1_quant': entry.count_1_quant, 'sum_2_quant': entry.sum_2_quant, 'max_3_quant': entry.max_3_quant
-    })       
-    
-    
-    return tabulate.tabulate(_global,
+            'cust': key[0], 'count_1_quant': count_1_quant[g], 'sum_2_quant': sum_2_quant[g], 'max_3_quant': max_3_quant[g]
+    })
+    return _global
+
+
+def run(conn):
+    """
+    Runs the MF query over an open connection and returns the output rows as dicts.
+    """
+    # GROUPS_QUERY and SALES_QUERY must see the same snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cur = conn.cursor()
+    cur.execute(GROUPS_QUERY)
+    group_rows = cur.fetchall()
+    cur.execute(SALES_QUERY)
+    sales_rows = cur.fetchall()
+    mf = mf_scans(sales_rows, group_rows)
+    return mf_output(mf)
+
+
+def query():
+    load_dotenv()
+
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)
+    return tabulate.tabulate(run(conn),
                         headers="keys", tablefmt="psql")
 
 def main():
@@ -0,0 +1,437 @@
+"""
+-------------------------------------------------------
+benchmark.py - MF Query Benchmark Suite
+Author: Sairithik Komuravelly (Team: NoJoinZone)
+Description:
+    Measures the generated MF query programs on synthetic sales data.
+
+    - generate_sales() produces a reproducible synthetic 'sales' table with a
+      configurable row count, customer/product cardinality, state skew and date
+      range; load_sales() loads it into Postgres (through COPY), write_csv()
+      writes it to a CSV file and write_arrow() to a Parquet or Arrow IPC file
+    - For every table size, the Test_Queries specs (Q1-Q5, read from
+      Test_Queries/Q*_esql.txt) are run in a fresh process, recording wall time,
+      rows/s, peak RSS and the number of passes over the data
+    - The equivalent hand-written SQL (Test_Queries/Q*_sql.txt) is run on the same
+      table for a side-by-side comparison, and its output is checked against ours
+    - With --ingest, the rows of each query are also fetched through a DictCursor,
+      the tuple cursor and the binary COPY of the NumPy backend, recording rows/s
+
+    Results are written as JSON so runs of different versions can be compared.
+
+    Usage:
+        python benchmark.py --sizes 10000 100000 1000000 --output results.json
+
+    The table is (re)created in the database given by --database (default
+    'mf_bench'), which is created when it does not exist; the connection settings
+    come from the USER and PASSWORD environment variables (or .env). With
+    --source csv|parquet|arrow the table is written to a file of that format
+    instead and the MF queries read it directly, without a database.
+-------------------------------------------------------
+"""
+import argparse
+import csv
+import datetime
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+from dotenv import find_dotenv, load_dotenv
+
+from generator import build_dependency_dag, compile_mf_query, plan_scan_stages
+
+QUERY_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Test_Queries")
+STATES = ["NY", "NJ", "CT", "PA"]
+# Fetch paths compared by the "ingest" measurement
+INGEST_METHODS = ["dict_cursor", "tuple_cursor", "tuple_cursor_columns", "copy"]
+SALES_DDL = ("CREATE TABLE sales (cust varchar(20), prod varchar(20), day integer, month integer, "
+             "year integer, state character(2), quant integer, date date)")
+
+
+def read_test_queries(names=None):
+    """
+    Reads the query specifications of the Test_Queries, from the input.json that every
+    Q*_esql.txt file lists after its ESQL query.
+
+    Parameters:
+        names (list): Query names such as "Q1" (default: every Q*_esql.txt).
+
+    Returns:
+        dict: Query name -> query specification.
+    """
+    if names is None:
+        names = sorted(name.split("_", 1)[0] for name in os.listdir(QUERY_DIR) if name.endswith("_esql.txt"))
+    specs = {}
+    for name in names:
+        with open(os.path.join(QUERY_DIR, f"{name}_esql.txt")) as f:
+            text = f.read()
+        specs[name] = json.loads(text[text.index("{", text.index("Appropriate input.json")):])
+    return specs
+
+
+def generate_sales(rows, customers=100, products=50, state_skew=0.0,
+                   start=datetime.date(2016, 1, 1), end=datetime.date(2020, 12, 31), seed=562):
+    """
+    Generates synthetic sales rows.
+
+    Customers and products are uniform. The state of a row follows a Zipf-like
+    distribution: the i-th state of STATES has weight 1 / (i + 1) ** state_skew, so 0 is
+    uniform and larger values make NY dominate. Dates are uniform in [start, end].
+
+    Parameters:
+        rows (int): Number of rows.
+        customers (int): Number of distinct customers.
+        products (int): Number of distinct products.
+        state_skew (float): Skew of the state distribution.
+        start (datetime.date): First date.
+        end (datetime.date): Last date.
+        seed (int): Random seed; the same arguments always produce the same rows.
+
+    Returns:
+        iterator: Tuples (cust, prod, day, month, year, state, quant, date).
+    """
+    rng = random.Random(seed)
+    weights = list(itertools.accumulate(1 / (i + 1) ** state_skew for i in range(len(STATES))))
+    days = (end - start).days + 1
+    for _ in range(rows):
+        date = start + datetime.timedelta(days=rng.randrange(days))
+        yield (f"Cust{rng.randrange(customers):05d}", f"Prod{rng.randrange(products):04d}",
+               date.day, date.month, date.year, rng.choices(STATES, cum_weights=weights)[0],
+               rng.randint(1, 1000), date)
+
+
+def load_sales(conn, rows, chunk_size=100000):
+    """
+    Replaces the sales table of a database with the given rows, loaded through COPY in
+    chunks so memory stays bounded.
+
+    Parameters:
+        conn: An open psycopg2 connection.
+        rows (iterable): Sales row tuples, e.g. from generate_sales().
+        chunk_size (int): Rows per COPY.
+
+    Returns:
+        int: Number of rows loaded.
+    """
+    count = 0
+    rows = iter(rows)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS sales")
+        cur.execute(SALES_DDL)
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            buffer = io.StringIO()
+            csv.writer(buffer, delimiter="\t", lineterminator="\n").writerows(chunk)
+            buffer.seek(0)
+            cur.copy_expert("COPY sales FROM STDIN", buffer)
+            count += len(chunk)
+        cur.execute("ANALYZE sales")
+    conn.commit()
+    return count
+
+
+def write_csv(path, rows):
+    """
+    Writes sales rows to a CSV file with a header line.
+
+    Parameters:
+        path (str): Output file.
+        rows (iterable): Sales row tuples, e.g. from generate_sales().
+
+    Returns:
+        int: Number of rows written.
+    """
+    count = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["cust", "prod", "day", "month", "year", "state", "quant", "date"])
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+def write_arrow(path, rows, chunk_size=100000):
+    """
+    Writes sales rows to a Parquet file, or to an Arrow IPC file when the path does not end
+    in .parquet, in record batches of chunk_size rows.
+
+    Parameters:
+        path (str): Output file.
+        rows (iterable): Sales row tuples, e.g. from generate_sales().
+        chunk_size (int): Rows per record batch (and Parquet row group).
+
+    Returns:
+        int: Number of rows written.
+    """
+    # pyarrow is only needed for the file sources, so it is not imported at module level
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([("cust", pa.string()), ("prod", pa.string()), ("day", pa.int32()), ("month", pa.int32()),
+                        ("year", pa.int32()), ("state", pa.string()), ("quant", pa.int32()), ("date", pa.date32())])
+    writer = pq.ParquetWriter(path, schema) if path.endswith(".parquet") else pa.ipc.new_file(path, schema)
+    count = 0
+    rows = iter(rows)
+    with writer:
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            writer.write_batch(pa.record_batch([list(column) for column in zip(*chunk)], schema=schema))
+            count += len(chunk)
+    return count
+
+
+def _measure(kind, payload, dsn, options):
+    """
+    Runs one measurement; called in a fresh process, so the peak RSS is its own.
+    """
+    # MF queries over a source file need no connection
+    conn = psycopg2.connect(dsn, cursor_factory=psycopg2.extras.DictCursor if kind == "sql" else None) if dsn else None
+    result = {}
+    if kind == "ingest":
+        # Only the fetch of the columnar program's SALES_QUERY, into row dicts, row tuples, and
+        # arrays from row tuples or from the binary COPY (see the copy option of generate_code())
+        program = compile_mf_query(payload, backend="numpy", copy=True)
+        for method in INGEST_METHODS:
+            start = time.perf_counter()
+            if method == "copy":
+                columns = program.copy_columns(conn)
+            else:
+                with conn.cursor(cursor_factory=psycopg2.extras.DictCursor if method == "dict_cursor"
+                                 else psycopg2.extensions.cursor) as cur:
+                    cur.execute(program.SALES_QUERY)
+                    rows = cur.fetchall()
+                if method == "tuple_cursor_columns":
+                    expected = program.load_columns(rows, program.COLUMNS)
+            result[method] = time.perf_counter() - start
+        result["rows"] = len(rows)
+        result["copy_matches"] = all(columns[name].tolist() == values.tolist() for name, values in expected.items())
+        conn.close()
+        return result
+    if kind == "mf":
+        start = time.perf_counter()
+        program = compile_mf_query(payload, **options)
+        result["generate_seconds"] = time.perf_counter() - start
+        start = time.perf_counter()
+        rows = program.run(conn) if conn else program.run()
+    else:
+        start = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(payload)
+            rows = [dict(row) for row in cur.fetchall()]
+    result["seconds"] = time.perf_counter() - start
+    try:
+        # Only on Unix
+        import resource
+    except ImportError:
+        result["peak_rss_bytes"] = None
+    else:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result["peak_rss_bytes"] = maxrss if sys.platform == "darwin" else maxrss * 1024
+    result["output_rows"] = len(rows)
+    result["output"] = sorted(json.dumps([_number(value) for value in row.values()], default=str) for row in rows)
+    if conn:
+        conn.close()
+    return result
+
+
+def _number(value):
+    # SQL returns numerics as Decimal with more digits than the generated floats, and NULL
+    # where an MF aggregate over no rows is 0
+    if value is None:
+        return 0.0
+    try:
+        return round(float(value), 6)
+    except (TypeError, ValueError):
+        return value
+
+
+def measure(kind, payload, dsn, options=None):
+    """
+    Runs an MF query specification (kind "mf") or a SQL query (kind "sql") in a fresh
+    process. Kind "ingest" only fetches the rows of a specification's columnar program
+    through every ingestion path instead.
+
+    Returns:
+        dict: seconds, peak_rss_bytes (None where the resource module is missing, e.g.
+            on Windows), output_rows and the normalized output rows
+            (plus generate_seconds for MF queries). For "ingest": the seconds of every
+            path (dict_cursor, tuple_cursor, tuple_cursor_columns and copy), the rows
+            fetched and whether the COPY columns match the tuple cursor's.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(_measure, kind, payload, dsn, options or {}).result()
+
+
+def run_benchmark(dsn, sizes, queries, options=None, customers=100, products=50, state_skew=0.0,
+                  start=datetime.date(2016, 1, 1), end=datetime.date(2020, 12, 31), compare_sql=True, source=None,
+                  ingest=False):
+    """
+    Loads a synthetic table of every size and measures each query on it.
+
+    Parameters:
+        dsn (str): Connection string of the benchmark database (its sales table is replaced),
+            unused with a source.
+        sizes (list): Table sizes in rows.
+        queries (dict): Query name -> specification, e.g. from read_test_queries().
+        options (dict): Generation options passed to compile_mf_query().
+        customers, products, state_skew, start, end: Data distribution, see generate_sales().
+        compare_sql (bool): Also run Test_Queries/<name>_sql.txt and compare outputs.
+        source (str): 'csv', 'parquet' or 'arrow' writes every table to a temporary file of
+            that format, which the MF queries read (the source option of generate_code()),
+            instead of loading it into the database; no SQL is run.
+        ingest (bool): Also measure the fetch throughput (rows/s) of each query's rows through
+            a DictCursor, the tuple cursor (alone and into NumPy arrays) and the binary COPY.
+
+    Returns:
+        list: One result dict per (size, query).
+    """
+    results = []
+    directory = tempfile.TemporaryDirectory(prefix="mf_bench_") if source else None
+    for size in sizes:
+        rows = generate_sales(size, customers, products, state_skew, start, end)
+        started = time.perf_counter()
+        if source:
+            path = os.path.join(directory.name, f"sales.{source}")
+            if source == "csv":
+                write_csv(path, rows)
+            else:
+                write_arrow(path, rows)
+            options = dict(options or {}, source=path)
+        else:
+            conn = psycopg2.connect(dsn)
+            load_sales(conn, rows)
+            conn.close()
+        print(f"loaded {size} rows in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        for name, spec in queries.items():
+            mf = measure("mf", spec, None if source else dsn, options)
+            result = {
+                "query": name,
+                "rows": size,
+                "seconds": mf["seconds"],
+                "generate_seconds": mf["generate_seconds"],
+                "rows_per_second": size / mf["seconds"] if mf["seconds"] else None,
+                "peak_rss_bytes": mf["peak_rss_bytes"],
+                # The 0th scan plus one pass per dependency level (see plan_scan_stages())
+                "passes": len(plan_scan_stages(build_dependency_dag(spec))),
+                "output_rows": mf["output_rows"],
+            }
+            sql_path = os.path.join(QUERY_DIR, f"{name}_sql.txt")
+            if compare_sql and not source and os.path.exists(sql_path):
+                with open(sql_path) as f:
+                    sql = measure("sql", f.read(), dsn)
+                result["sql"] = {"seconds": sql["seconds"], "peak_rss_bytes": sql["peak_rss_bytes"],
+                                 "output_rows": sql["output_rows"]}
+                result["speedup_vs_sql"] = sql["seconds"] / mf["seconds"] if mf["seconds"] else None
+                result["matches_sql"] = mf["output"] == sql["output"]
+                # Some hand-written queries use inner joins and drop the groups a grouping
+                # variable matches no row of, which the MF query keeps with 0 aggregates
+                result["mf_only_rows"] = len(set(mf["output"]) - set(sql["output"]))
+                result["sql_only_rows"] = len(set(sql["output"]) - set(mf["output"]))
+            print(f"{name} {size:>10} rows {result['seconds']:8.3f}s {result['rows_per_second'] or 0:12.0f} rows/s"
+                  + (f"  sql {result['sql']['seconds']:8.3f}s  {'ok' if result['matches_sql'] else 'differs'}"
+                     f" (mf only {result['mf_only_rows']}, sql only {result['sql_only_rows']})"
+                     if "sql" in result else ""), file=sys.stderr)
+            if ingest and not source:
+                fetched = measure("ingest", spec, dsn)
+                result["ingest"] = {"rows": fetched["rows"], "copy_matches": fetched["copy_matches"],
+                                    "rows_per_second": {method: fetched["rows"] / fetched[method] if fetched[method]
+                                                        else None for method in INGEST_METHODS}}
+                print(f"{name} {size:>10} rows fetched " + "  ".join(
+                    f"{method} {rate or 0:,.0f}/s" for method, rate in result["ingest"]["rows_per_second"].items()),
+                    file=sys.stderr)
+            results.append(result)
+    if directory:
+        directory.cleanup()
+    return results
+
+
+def main(argv=None):
+    """
+    Runs the benchmark suite from the command line and writes the results as JSON.
+
+    Parameters:
+        argv (list): Command line arguments (defaults to sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the generated MF query programs on synthetic sales data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000, 10000000],
+                        help="table sizes in rows (default: 10k 100k 1M 10M)")
+    parser.add_argument("--queries", nargs="+", help="Test_Queries to run (default: all)")
+    parser.add_argument("--customers", type=int, default=100, help="distinct customers (default: 100)")
+    parser.add_argument("--products", type=int, default=50, help="distinct products (default: 50)")
+    parser.add_argument("--state-skew", type=float, default=0.0,
+                        help="Zipf exponent of the state distribution, 0 is uniform (default: 0)")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, default=datetime.date(2016, 1, 1),
+                        help="first sale date (default: 2016-01-01)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, default=datetime.date(2020, 12, 31),
+                        help="last sale date (default: 2020-12-31)")
+    parser.add_argument("--options", type=json.loads, default={},
+                        help='generation options as JSON, e.g. \'{"backend": "numpy"}\'')
+    parser.add_argument("--database", default="mf_bench",
+                        help="database whose sales table is replaced (default: mf_bench)")
+    parser.add_argument("--no-sql", action="store_true", help="skip the hand-written SQL comparison")
+    parser.add_argument("--source", choices=["csv", "parquet", "arrow"],
+                        help="write the tables to files of this format and run the MF queries on them "
+                             "instead of Postgres (no database needed, no SQL comparison)")
+    parser.add_argument("--ingest", action="store_true",
+                        help="also measure the rows/s of fetching each query's rows through a DictCursor, the "
+                             "tuple cursor and the binary COPY of the numpy backend")
+    parser.add_argument("--csv", metavar="PATH",
+                        help="only write a table of the first size to a CSV file and exit")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    rows = generate_sales(args.sizes[0], args.customers, args.products, args.state_skew, args.start, args.end)
+    if args.csv:
+        print(f"wrote {write_csv(args.csv, rows)} rows to {args.csv}")
+        return
+
+    dsn = None
+    if not args.source:
+        load_dotenv(find_dotenv(usecwd=True))
+        credentials = f"user={os.getenv('USER')} password={os.getenv('PASSWORD')}"
+        admin = psycopg2.connect(f"dbname={os.getenv('DBNAME')} {credentials}")
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (args.database,))
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE DATABASE "{args.database}"')
+        admin.close()
+        dsn = f"dbname={args.database} {credentials}"
+
+    results = run_benchmark(dsn, args.sizes, read_test_queries(args.queries),
+                            args.options, args.customers, args.products, args.state_skew, args.start, args.end,
+                            compare_sql=not args.no_sql, source=args.source, ingest=args.ingest)
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    report = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "options": args.options,
+        "source": args.source,
+        "data": {"customers": args.customers, "products": args.products, "state_skew": args.state_skew,
+                 "start": args.start.isoformat(), "end": args.end.isoformat()},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {len(results)} results to {args.output}")
+
+
+if "__main__" == __name__:
+    main()
@@ -17,10 +17,32 @@ Components:
 -------------------------------------------------------
 """
 
+import argparse
+import ast
+import atexit
+import datetime
+import functools
+import importlib.util
+import os
+import shutil
 import subprocess
 import json
 import sys
 import re
+import tempfile
+import time
+
+import psycopg2
+import psycopg2.extensions
+import tabulate
+from dotenv import find_dotenv, load_dotenv
+
+from plan_cache import DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES, PlanCache, plan_key
+
+# Columns of the sales table, in the order the generated program selects them.
+# Rows are plain tuples, so generated code reads each attribute by its position here.
+SALES_COLUMNS = ["cust", "prod", "day", "month", "year", "state", "quant", "date"]
+
 
 def read_json(file):
     """
@@ -34,85 +56,165 @@ def read_json(file):
         return json.load(f)
 
 
-def generate_mf_class(input_data):
+AGGREGATE_PATTERN = r'\b(?:sum|count|min|max|avg|median|p\d{1,2}|top)_\d*_?\w+\b'
+
+# Sketch aggregates: count_distinct_[i_]col, median_[i_]col, p<NN>_[i_]col (the NN-th
+# percentile) and top_[i_]col (the most frequent value), see generate_sketches()
+SKETCH_PATTERN = r'(count_distinct|median|p\d{1,2}|top)_(?:(\d+)_)?(\w+)'
+SKETCH_CLASSES = {"count_distinct": "HyperLogLog", "quantile": "KLLSketch", "top": "SpaceSaving"}
+
+
+def parse_sketch(agg):
+    """
+    Parses a sketch aggregate name, e.g. 'count_distinct_1_cust', 'median_quant',
+    'p90_2_quant' or 'top_prod'.
+
+    Parameters:
+        agg (str): Aggregate name.
+
+    Returns:
+        tuple: (kind, column, quantile) with kind 'count_distinct', 'quantile' or 'top'
+            and quantile the fraction of a quantile sketch (None otherwise), or None if
+            the aggregate is not a sketch.
+
+    Raises:
+        ValueError: If the sketch reads an unknown column, or a quantile reads a
+            non-integer column or is not between p1 and p99.
+    """
+    match = re.fullmatch(SKETCH_PATTERN, agg)
+    if match is None:
+        return None
+    function, _, column = match.groups()
+    if column not in SALES_COLUMNS:
+        raise ValueError(f"Sketch aggregate over an unknown column: {agg}")
+    if function in ("count_distinct", "top"):
+        return function, column, None
+    quantile = 0.5 if function == "median" else int(function[1:]) / 100
+    if column not in INTEGER_COLUMNS or not 0 < quantile < 1:
+        raise ValueError(f"Quantiles are only supported from p1 to p99 of integer columns: {agg}")
+    return "quantile", column, quantile
+
+
+def sketch_value(agg):
+    """
+    Returns the expression reading a sketch aggregate of group `g`: the distinct count,
+    the quantile or the most frequent value.
+    """
+    kind, _, quantile = parse_sketch(agg)
+    if kind == "count_distinct":
+        return f"{agg}[g].estimate()"
+    if kind == "quantile":
+        return f"{agg}[g].quantile({quantile!r})"
+    return f"{agg}[g].top()"
+
+
+def generate_mf_class(input_data, class_name="MFStructure", dictionary_encoded=False):
     """
     Dynamically generates the MFStructure class definition based on the input JSON.
 
-    This function constructs a Python class with attributes for grouping variables and
-    required aggregate fields. It also replaces 'avg_*' aggregates with their corresponding
-    'sum_*' and 'count_*' fields, categorizing them based on the grouping variable index.
-    
+    The MF structure is a struct-of-arrays: `index` maps each grouping key tuple (V) to
+    an integer group id, `keys` maps the id back to its key, and every aggregate is one
+    array('q') column indexed by group id. The 0th scan aggregates grow as new groups
+    are found; grouping variable aggregates are preallocated by allocate() once the 0th
+    scan has found every group. This avoids a per-group object and __dict__.
+
+    'avg_*' aggregates are replaced with their corresponding 'sum_*' and 'count_*' fields,
+    categorized by the grouping variable index.
+
     Parameters:
         input_data (dict): The parsed contents of input.json, including:
             - "V": List of grouping attributes
             - "F": List of aggregate functions
             - "n": Number of grouping variable scans
+        class_name (str): Name of the generated class.
+        dictionary_encoded (bool): The grouping keys hold dictionary codes; the structure
+            then also keeps the dictionaries (see generate_dictionary_encoding()).
 
     Returns:
         tuple:
             - str: The full Python class definition for MFStructure
-            - dict: A mapping from grouping variable index (as string) to the list of
-                    aggregates needed for that scan (F_map)
+            - dict: A mapping from grouping variable index (as string, "0" for the 0th
+                    scan) to the sorted list of aggregates computed by that scan (F_map)
     """
-    grouping_attributes = input_data["V"]
     aggregates = input_data["F"]
     n = input_data["n"]
-     # Initialize map to hold aggregates required per grouping variable (1 to n)
-    F_map = {str(i): set() for i in range(1, n+1)}
-    # Track all fields needed in the MF structure, including 0th scan
-    group_fields = set(grouping_attributes)
-    agg_fields = {str(i): set() for i in range(0, n+1)}
+    # Initialize map to hold aggregates required per scan (0th scan and grouping variables 1 to n)
+    F_map = {str(i): set() for i in range(0, n+1)}
     # Loop through each aggregate in F and categorize
     for agg in aggregates:
         if "avg" in agg.lower():
             # Decompose 'avg_*' into its required sum_ and count_ parts
-            sum_field = agg.replace("avg","sum")
-            count_field = agg.replace("avg","count")
-            parts = sum_field.split("_", 2)
-            # Default to 0th scan unless a grouping variable index is found
-            group_idx = "0"
-            if len(parts) >= 3 and parts[1].isdigit():
-                group_idx  = parts[1]
-                F_map[group_idx].add(sum_field)
-                F_map[group_idx].add(count_field)
-             # Store in the full aggregate list for this scan index
-            agg_fields[group_idx].add(sum_field)
-            agg_fields[group_idx].add(count_field)
+            fields = [agg.replace("avg","sum"), agg.replace("avg","count")]
         else:
-            # Process other aggregates (sum, count, min, max)
-            group_idx = "0"
-            parts = agg.split("_", 2)
-            if len(parts) >= 3 and parts[1].isdigit():
-                group_idx = parts[1]
-                F_map[group_idx].add(agg)
-            agg_fields[group_idx].add(agg)
-    # Convert F_map sets to lists for consistency
-    F_map = {k: list(v) for k, v in F_map.items()}
-    # Generate code lines for assigning grouping attributes in __init__
-    group_assignments = "\n        ".join([f"self.{attr} = {attr}" for attr in group_fields])
-    # Flatten and order aggregate fields across all scans
-    ordered_agg_fields = []
-    for i in range(0,n+1):
-        ordered_agg_fields.extend(sorted(agg_fields[str(i)]))
-    # Generate code lines for initializing aggregate fields to 0
-    agg_assignments = "\n        ".join([f"self.{attr} = 0" for attr in ordered_agg_fields])
+            # Other aggregates (sum, count, min, max) are stored as is
+            fields = [agg]
+        # Default to 0th scan unless a grouping variable index is found
+        F_map[str(aggregate_scan_index(agg))].update(fields)
+    # Convert F_map sets to sorted lists so the generated code is deterministic
+    F_map = {k: sorted(v) for k, v in F_map.items()}
+    gv_fields = [agg for i in range(1, n+1) for agg in F_map[str(i)]]
+    slots = ", ".join(repr(field) for field in ["index", "keys"] + (["dictionaries"] if dictionary_encoded else [])
+                      + F_map["0"] + gv_fields)
+    # Sketch aggregates are lists of sketch objects (see generate_sketches()), the others array('q') columns
+    sketches = {agg: SKETCH_CLASSES[sketch[0]] for agg in F_map["0"] + gv_fields if (sketch := parse_sketch(agg))}
+    base_columns = "".join(f"\n        self.{agg} = []" if agg in sketches else f"\n        self.{agg} = array('q')"
+                           for agg in F_map["0"])
+    gv_columns = "".join(f"\n        self.{agg} = [{sketches[agg]}() for _ in range(n_groups)]" if agg in sketches else
+                         f"\n        self.{agg} = array('q', [0]) * n_groups" for agg in gv_fields)
+    extend_columns = "".join(f"\n        self.{agg}.extend(other.{agg})" for agg in F_map["0"] + gv_fields)
+    append_zeros = "".join(f"\n                self.{agg}.append({sketches[agg] + '()' if agg in sketches else 0})"
+                           for agg in F_map["0"] + gv_fields)
+    sketch_note = " (sketch aggregates\n    are a list of sketch objects)" if sketches else ""
+    dictionaries = "\n        self.dictionaries = None   # dictionary-encoded column -> its sorted values" if dictionary_encoded else ""
     # Construct the full class definition as a string
     mf_class_code = f"""
-class MFStructure:
-    def __init__(self, {', '.join(grouping_attributes)}):
-        {group_assignments}
-        {agg_assignments}
+class {class_name}:
+    \"""
+    Struct-of-arrays MF structure: group g has grouping key keys[g] and each aggregate
+    is an array('q') column indexed by g{sketch_note}.
+    \"""
+    __slots__ = ({slots})
+
+    def __init__(self):
+        self.index = {{}}   # grouping key tuple (V) -> group id
+        self.keys = []    # group id -> grouping key tuple{dictionaries}
+        # 0th scan aggregates grow by one entry per new group{base_columns}
+
+    def allocate(self):
+        \"""
+        Preallocates the grouping variable aggregates, initialized to 0, once the 0th
+        scan has found every group.
+        \"""
+        {"n_groups = len(self.keys)" + gv_columns if gv_fields else "pass"}
+
+    def extend(self, other):
+        \"""
+        Appends the groups of another (allocated) MF structure that has no group in common
+        with this one, e.g. the result of another partition of the rows.
+        \"""
+        offset = len(self.keys)
+        self.index.update((key, offset + g) for key, g in other.index.items())
+        self.keys.extend(other.keys){extend_columns}
+
+    def add_groups(self, group_keys):
+        \"""
+        Adds the grouping keys that have no group yet, with every aggregate 0.
+        \"""
+        for key in group_keys:
+            if key not in self.index:
+                self.index[key] = len(self.keys)
+                self.keys.append(key){append_zeros}
 """
     return mf_class_code, F_map
 
 def transform_condition(G):
     """
     Transforms logical conditions from the input query by rewriting aggregate functions 
-    and attribute references to be Python-evaluable expressions compatible with MFStructure entries.
+    and attribute references to be Python-evaluable expressions over the MFStructure columns.
 
     Specifically:
-    - Replaces any 'avg_*' with the equivalent (entry.sum / entry.count) expression.
-    - Prefixes aggregate fields (e.g., sum_1_quant, count_2_quant) with 'entry.' if not already.
+    - Replaces any 'avg_*' with the equivalent (sum[g] / count[g]) expression.
+    - Indexes aggregate fields (e.g., sum_1_quant, count_2_quant) by the group id 'g'.
     - Converts standalone '=' into '==' for valid Python comparisons.
 
     This function is used to convert both the G (having condition) and sigma conditions 
@@ -124,222 +226,4707 @@ def transform_condition(G):
     Returns:
         str: The transformed condition ready for use in the generated MF query code.
     """
-    # Replace avg_* with (entry.sum / entry.count ...)
-    def avg_replacer(match):
-        avg_field = match.group()
-        sum_field = avg_field.replace("avg", "sum")
-        count_field = avg_field.replace("avg", "count")
-        return f"(entry.{sum_field} / entry.{count_field} if entry.{count_field} != 0 else 0)"
-
-    G = re.sub(r'\bavg_\d*_?\w+\b', avg_replacer, G)
-
-    # Only prefix un-prefixed sum_, count_, max_, min_
-    def prefix_entry(match):
+    def replace_aggregate(match):
         field = match.group()
-        return f"entry.{field}"
+        if field.startswith("avg"):
+            # Replace avg_* with (sum[g] / count[g] ...)
+            sum_field = field.replace("avg", "sum")
+            count_field = field.replace("avg", "count")
+            return f"({sum_field}[g] / {count_field}[g] if {count_field}[g] != 0 else 0)"
+        if re.fullmatch(SKETCH_PATTERN, field):
+            return sketch_value(field)
+        return f"{field}[g]"
 
-    # Only match if NOT already prefixed with 'entry.'
-    G = re.sub(r'(?<!entry\.)\b(?:sum|count|min|max)_\d*_?\w+\b', prefix_entry, G)
+    G = re.sub(AGGREGATE_PATTERN, replace_aggregate, G)
     # Replace standalone = with == (not touching >=, <=, !=, ==)
     G = re.sub(r'(?<![<>=!])=(?![=])', '==', G)
     return G
 
 
-def main():
+def aggregate_scan_index(agg):
     """
-    Main driver function that orchestrates the MF query code generation process.
+    Returns the grouping variable index that computes a given aggregate.
 
-    This function:
-    - Reads the input JSON file ('input.json') containing the MF query specification
-    - Generates the MFStructure class and identifies required aggregates per grouping variable
-    - Dynamically constructs a Python program to:
-        * Perform 0th and nth scans on the 'sales' table
-        * Compute aggregates based on grouping variables
-        * Apply any specified 'having' condition
-        * Output the selected attributes
-    - Writes the generated Python code to '_generated.py'
+    Parameters:
+        agg (str): Aggregate name, e.g. 'avg_quant' (0th scan) or 'sum_2_quant'.
 
-    This function is intended to be run once to generate the executable query logic.
+    Returns:
+        int: The grouping variable index (0 for the 0th scan).
     """
-    input_data = read_json("input.json")
-    
-    mf_class_code, F_map = generate_mf_class(input_data)
-    grouping_keys  = input_data["V"]
-    n = input_data["n"]
-    G = input_data["G"]
-    G_condition = transform_condition(G) if G else True
-    final_fields = list(dict.fromkeys(grouping_keys + input_data['S']))
-    sigma_map = {}
+    sketch = re.fullmatch(SKETCH_PATTERN, agg)
+    if sketch:
+        return int(sketch.group(2) or 0)
+    parts = agg.split("_", 2)
+    if len(parts) >= 3 and parts[1].isdigit():
+        return int(parts[1])
+    return 0
+
+
+def build_dependency_dag(input_data):
+    """
+    Builds the dependency DAG between grouping variables from the sigma conditions.
+
+    Every grouping variable depends on the 0th scan (which builds the groups), plus on
+    every grouping variable whose aggregates its sigma condition references. For example
+    "3.state = 'CT' and 3.quant < avg_2_quant" makes grouping variable 3 depend on 2.
+    The having clause G is evaluated once all scans are done, so it is not a node.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+
+    Returns:
+        dict: Grouping variable index -> set of indices it depends on.
+
+    Raises:
+        ValueError: If a sigma condition references its own grouping variable's aggregates.
+    """
+    dag = {0: set()}
     for cond in input_data["sigma"]:
-        idx = cond.split(".", 1)[0]
-        sigma_map[idx] = cond
-    scan_blocks = ""
-    for i in range(1, n + 1):
-        i_str = str(i)
-        raw_cond = sigma_map[i_str]
-        # Find all conditions like "1.state = 'NY'"
-        # Convert "1.state = 'NY'" them into "row['state'] == 'NY'"
-        tokens = re.split(r'\s+(and|or)\s+', raw_cond)  # keeps 'and'/'or' as tokens
-        parsed_conditions = []
-
-        for token in tokens:
-            if token.lower() in ['and', 'or']:
-                parsed_conditions.append(token.lower())
-            else:
-                match = re.match(r"\d+\.(\w+)\s*([=!><]=?)\s*(.+)", token.strip())
-                if match:
-                    attr, op, value = match.groups()
-                    if op=='=': op='=='
-                    # Check if value refers to an aggregate field or another scan's result
-                    value = value.strip()
-                    if re.match(r'\b(?:sum|count|min|max|avg)_\d*_?\w+\b', value):
-                        # Transform to entry reference (e.g., entry.avg_1_quant => valid python expr)
-                        value = transform_condition(value)
-                        parsed_conditions.append(f"row[{repr(attr)}] {op} {value}")
-                    else:
-                        parsed_conditions.append(f"row[{repr(attr)}] {op} {value}")
-                else:
-                    raise ValueError(f"Unrecognized sigma condition: {token.strip()}")
-        condition = " ".join(parsed_conditions)
-
-
-        agg_list = F_map.get(i_str, [])
-        updates = []
-        for agg in agg_list:
-            if "sum" in agg:
-                updates.append(f"entry.{agg} += row['quant']")
-            elif "count" in agg:
-                updates.append(f"entry.{agg} += 1")
-            elif "max" in agg:
-                updates.append(f"entry.{agg} = max(entry.{agg}, row['quant'])")
-            elif "min" in agg:
-                updates.append(f"entry.{agg} = min(entry.{agg}, row['quant'])")
-
-        group_match = " and ".join([f"entry.{key} == row['{key}']" for key in grouping_keys])
-        scan_block = f"""
-    # Scan for grouping variable {i_str}
-    for row in sales_rows:
-        for entry in h_table:
-            if {condition}:
-                if {group_match}:
-                    {"; ".join(updates)}
-                    break
+        idx = int(cond.split(".", 1)[0])
+        deps = {aggregate_scan_index(agg) for agg in condition_aggregates(parse_condition(cond))}
+        if idx in deps:
+            raise ValueError(f"Sigma condition for grouping variable {idx} references its own aggregates: {cond}")
+        dag[idx] = deps | {0}
+    for i in range(1, input_data["n"] + 1):
+        dag.setdefault(i, {0})
+    return dag
+
+
+def plan_scan_stages(dag):
+    """
+    Groups grouping variables into fused scans using the dependency DAG.
+
+    A grouping variable is placed in the earliest scan that comes after every scan it
+    depends on, so all grouping variables that only need already-computed aggregates
+    share one pass over the sales rows (e.g. Q1 runs as [[0], [1, 2, 3]]).
+
+    Parameters:
+        dag (dict): Grouping variable index -> set of indices it depends on.
+
+    Returns:
+        list: One list of grouping variable indices per physical scan, in execution order.
+
+    Raises:
+        ValueError: If the sigma conditions contain a dependency cycle.
+    """
+    level = {}
+    def visit(i, path):
+        if i in path:
+            raise ValueError(f"Cyclic dependency between grouping variables: {sorted(path)}")
+        if i not in level:
+            if i not in dag:
+                raise ValueError(f"Sigma references grouping variable {i} which is not defined")
+            level[i] = 1 + max((visit(d, path | {i}) for d in dag[i]), default=-1)
+        return level[i]
+    for i in dag:
+        visit(i, set())
+    stages = [[] for _ in range(max(level.values()) + 1)]
+    for i in sorted(level):
+        stages[level[i]].append(i)
+    return stages
+
+
+def column_ref(attr, columns=SALES_COLUMNS):
+    """
+    Returns the generated-code expression that reads a sales column from `row`.
+
+    Parameters:
+        attr (str): Column name of the sales table, e.g. 'quant'.
+        columns (list): The columns selected by the generated program, in row order.
+
+    Returns:
+        str: Positional tuple access such as "row[6]".
+
+    Raises:
+        ValueError: If the column is not part of the sales schema.
+    """
+    if attr not in SALES_COLUMNS:
+        raise ValueError(f"Unknown sales column: {attr}")
+    return f"row[{columns.index(attr)}]"
+
+
+def transform_sigma(raw_cond, columns=SALES_COLUMNS):
+    """
+    Converts a sigma condition into a Python expression over `row` and the aggregate
+    columns of group `g`.
+
+    For example "1.state = 'NY'" becomes "row[5] == 'NY'". The condition is parsed
+    into an AST (see parse_condition()), so parentheses, IN lists and BETWEEN work and
+    aggregate references such as avg_quant become guarded column reads.
+
+    Parameters:
+        raw_cond (str): The sigma condition for one grouping variable.
+        columns (list): The columns selected by the generated program, in row order.
+
+    Returns:
+        str: The Python condition used inside the generated scan.
+
+    Raises:
+        ValueError: If the condition cannot be parsed or uses an unsupported construct.
+    """
+    return generate_python_expr(parse_condition(raw_cond), columns)
+
+
+def sigma_conjuncts(raw_cond, columns=SALES_COLUMNS, codes=None):
+    """
+    Splits a sigma condition into its top-level 'and' conjuncts, with the conjuncts
+    that only read the row (no aggregate) first.
+
+    The scans test those row-only conjuncts before looking up the row's group, so rows
+    no grouping variable can accept never pay for the lookup, and the instrumented
+    scans count the rows passing each conjunct in this order.
+
+    Parameters:
+        raw_cond (str): The sigma condition for one grouping variable.
+        columns (list): The columns selected by the generated program, in row order.
+        codes (dict): Collects the constants of dictionary-encoded columns, see
+            generate_python_expr().
+
+    Returns:
+        list: (condition text, Python condition, reads aggregates) triples.
+    """
+    prefix = re.match(r"\s*(\d+)\.", raw_cond)
+    conjuncts = []
+    for node in split_conjuncts(parse_condition(raw_cond)):
+        text = ast.unparse(node)
+        if prefix:
+            text = re.sub(r"\brow\.", prefix.group(1) + ".", text)
+        expr = generate_python_expr(node, columns, codes)
+        # An 'or' conjunct is parenthesized so the conjuncts can be joined with 'and'
+        conjuncts.append((text, f"({expr})" if isinstance(node, ast.BoolOp) else expr, reads_aggregates(node)))
+    return sorted(conjuncts, key=lambda conjunct: conjunct[2])
+
+
+def generate_updates(agg_list, columns=SALES_COLUMNS):
+    """
+    Generates the aggregate update statements for one scan, specialized per aggregate.
+
+    Parameters:
+        agg_list (list): Aggregates computed by the scan (from F_map).
+        columns (list): The columns selected by the generated program, in row order.
+
+    Returns:
+        list: Python statements updating the columns of group `g` from the current `row`.
+    """
+    quant = column_ref("quant", columns)
+    updates = []
+    for agg in agg_list:
+        sketch = parse_sketch(agg)
+        if sketch:
+            updates.append(f"{agg}[g].add({column_ref(sketch[1], columns)})")
+        elif agg.startswith("sumsq"):
+            # Sum of squares, for the confidence intervals of the approximate mode
+            updates.append(f"{agg}[g] += {quant} * {quant}")
+        elif "sum" in agg:
+            updates.append(f"{agg}[g] += {quant}")
+        elif "count" in agg:
+            updates.append(f"{agg}[g] += 1")
+        elif "max" in agg:
+            updates.append(f"if {quant} > {agg}[g]: {agg}[g] = {quant}")
+        elif "min" in agg:
+            updates.append(f"if {quant} < {agg}[g]: {agg}[g] = {quant}")
+    return updates
+
+
+def generate_new_group(agg_list, columns=SALES_COLUMNS):
+    """
+    Generates the statements that add a new group's first row to the 0th scan aggregates.
+
+    Parameters:
+        agg_list (list): Aggregates computed by the 0th scan (F_map["0"]).
+        columns (list): The columns selected by the generated program, in row order.
+
+    Returns:
+        list: Python statements appending one entry to every 0th scan column.
+    """
+    quant = column_ref("quant", columns)
+    statements = []
+    for agg in agg_list:
+        sketch = parse_sketch(agg)
+        if sketch:
+            statements.append(f"{agg}.append({SKETCH_CLASSES[sketch[0]]}({column_ref(sketch[1], columns)}))")
+        else:
+            statements.append(f"{agg}.append({1 if agg.startswith('count') else f'{quant} * {quant}' if agg.startswith('sumsq') else quant})")
+    return statements
+
+
+# Parameters of the sketch aggregates in the generated program
+HLL_PRECISION = 10
+KLL_K = 200
+HH_COUNTERS = 16
+
+
+def generate_sketches(kinds):
+    """
+    Generates the sketch classes of the sketch aggregates a program uses (see
+    parse_sketch()).
+
+    Every sketch has a fixed memory bound per group, whatever the number of rows:
+        * HyperLogLog (count_distinct): 2 ** HLL_PRECISION one-byte registers, with a
+          standard error of 1.04 / sqrt(registers) (3%), and linear counting (nearly
+          exact) for small counts. Values are hashed with blake2b, so sketches built in
+          different processes agree.
+        * KLLSketch (median, p<NN>): compactors holding at most about 3 * KLL_K values;
+          the rank error is about 1.7 / KLL_K (1%) and the quantile is exact (as
+          percentile_disc) while a group has fewer than KLL_K values.
+        * SpaceSaving (top): HH_COUNTERS counters; every value occurring in more than
+          1 / HH_COUNTERS of a group's rows is kept, the most frequent one is returned.
+
+    Each sketch has add(value), merge(other), which folds in the sketch of another part
+    of the rows (e.g. another partition) and returns self, and a constructor taking
+    the first values.
+
+    Parameters:
+        kinds (set): The sketch kinds used: 'count_distinct', 'quantile' and/or 'top'.
+
+    Returns:
+        str: Module-level code of the sketch classes.
+    """
+    code = ""
+    if "count_distinct" in kinds:
+        code += f"""
+
+HLL_PRECISION = {HLL_PRECISION}
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+
+
+@functools.lru_cache(maxsize=65536)
+def hll_hash(value):
+    # A 64-bit hash that is the same in every process (str hashes are salted per process)
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "little")
+
+
+class HyperLogLog:
+    \"""
+    HyperLogLog distinct count sketch: HLL_REGISTERS one-byte registers, each holding the
+    longest run of leading zero bits among the hashes that select it.
+    \"""
+    __slots__ = ("registers", "cached")
+
+    def __init__(self, *values):
+        self.registers = bytearray(HLL_REGISTERS)
+        self.cached = None   # the estimate, kept until a register changes
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        h = hll_hash(value)
+        register = h & (HLL_REGISTERS - 1)
+        rank = 65 - HLL_PRECISION - (h >> HLL_PRECISION).bit_length()
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+            self.cached = None
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        self.cached = None
+        return self
+
+    def estimate(self):
+        if self.cached is None:
+            self.cached = self.count()
+        return self.cached
+
+    def count(self):
+        estimate = HLL_ALPHA * HLL_REGISTERS * HLL_REGISTERS / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            # Small range correction: linear counting of the empty registers
+            estimate = HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return round(estimate)
 """
-        scan_blocks += scan_block
+    if "quantile" in kinds:
+        code += f"""
 
-    
-    body = f"""
-    h_table = [] # Initialize empty list to store MFStructure entries for each unique group
-    # First scan: populate h_table with grouping key combinations and compute 0th g.v aggregates
-    for row in sales_rows:
-        found = False   # Flag to check if a matching group already exists in h_table
-        for entry in h_table:
-            # Check if current row matches an existing group (i.e., same grouping key values)
-            if {" and ".join([f"entry.{key} == row['{key}']" for key in grouping_keys])}:
-                found = True
-                # Loop through all attributes in the MFStructure object and update aggregates
-                for att,val in vars(entry).items():
-                    if att=='sum_quant':
-                        entry.sum_quant += row['quant']
-                    if att=='min_quant':
-                        if entry.min_quant > row['quant']:
-                            entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        if entry.max_quant < row['quant']:
-                            entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        entry.count_quant += 1
-                break   # Stop scanning once the correct group is updated
-        if not found:
-            # If this is a new group, create a new MFStructure entry
-            new_entry = MFStructure({', '.join(["row['" + key + "']" for key in grouping_keys])})
-            # Initialize the required aggregate fields with current row's quant value
-            for att,val in vars(new_entry).items():
-                    if att=='sum_quant':
-                        new_entry.sum_quant = row['quant']
-                    if att=='min_quant':
-                        new_entry.min_quant = row['quant']
-                    if att=='max_quant':
-                        new_entry.max_quant = row['quant']
-                    if att=='count_quant':
-                        new_entry.count_quant = 1
-            h_table.append(new_entry)   # Add the new group entry to the h_table
-    
-    # Logic to compute grouping_variable aggregates
-    {scan_blocks}
-    # Sorting the h_table by grouping key attributes to keep output consistent   
-    h_table.sort(key=lambda x: tuple(getattr(x, attr) for attr in {grouping_keys}))
-    # Apply the final selection condition (G_condition) and prepare result for output
-    for entry in h_table:
-        if {G_condition}:
-            _global.append({{
-            {', '.join([
-                f"'{field}': (entry.{field.replace('avg','sum')} / entry.{field.replace('avg','count')}) if entry.{field.replace('avg','count')} != 0 else 0"
-                if 'avg' in field.lower() else f"'{field}': entry.{field}"
-                for field in final_fields
-            ])}
-    }})       
+KLL_K = {KLL_K}
+# Coin flips of the compactions; seeded so repeated runs give the same quantiles
+_kll_coins = random.Random(0)
+
+
+class KLLSketch:
+    \"""
+    KLL quantile sketch: compactor h holds values of weight 2 ** h. A full compactor is
+    sorted and a random half of it (every other value) moves up a level. Lower levels
+    hold geometrically fewer values (ratio 2/3), so a sketch holds about 3 * KLL_K values.
+    \"""
+    __slots__ = ("compactors", "size", "limit", "ranks")
+
+    def __init__(self, *values):
+        self.compactors = [[]]
+        self.size = 0
+        self.limit = KLL_K
+        self.ranks = None   # (sorted values, cumulative weights), kept until the next change
+        for value in values:
+            self.add(value)
+
+    def capacity(self, level):
+        return max(2, int(KLL_K * (2 / 3) ** (len(self.compactors) - level - 1)))
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.size += 1
+        self.ranks = None
+        if self.size >= self.limit:
+            self.compress()
+
+    def compress(self):
+        for level, values in enumerate(self.compactors):
+            if len(values) >= self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                values.sort()
+                kept = values[_kll_coins.getrandbits(1)::2]
+                self.compactors[level + 1] += kept
+                self.size -= len(values) - len(kept)
+                values.clear()
+                break
+        self.limit = sum(self.capacity(level) for level in range(len(self.compactors)))
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, values in enumerate(other.compactors):
+            self.compactors[level] += values
+        self.size += other.size
+        self.ranks = None
+        self.limit = sum(self.capacity(level) for level in range(len(self.compactors)))
+        while self.size >= self.limit:
+            self.compress()
+        return self
+
+    def quantile(self, q):
+        \"""
+        The smallest value whose weighted rank reaches q (percentile_disc), 0 without values.
+        \"""
+        if self.ranks is None:
+            weighted = sorted((value, 1 << level) for level, values in enumerate(self.compactors) for value in values)
+            self.ranks = ([value for value, _ in weighted], list(itertools.accumulate(weight for _, weight in weighted)))
+        values, ranks = self.ranks
+        if not values:
+            return 0
+        return values[min(bisect.bisect_left(ranks, q * ranks[-1]), len(values) - 1)]
+"""
+    if "top" in kinds:
+        code += f"""
+
+HH_COUNTERS = {HH_COUNTERS}
+
+
+class SpaceSaving:
+    \"""
+    Space-Saving heavy hitter sketch: at most HH_COUNTERS counters. A new value replaces
+    the smallest counter and inherits its count, so counts are upper bounds.
+    \"""
+    __slots__ = ("counts",)
+
+    def __init__(self, *values):
+        self.counts = {{}}
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        counts = self.counts
+        if value in counts:
+            counts[value] += 1
+        elif len(counts) < HH_COUNTERS:
+            counts[value] = 1
+        else:
+            smallest = min(counts, key=counts.__getitem__)
+            counts[value] = counts.pop(smallest) + 1
+
+    def merge(self, other):
+        # Sum the counters of both summaries and keep the HH_COUNTERS largest
+        counts = dict(self.counts)
+        for value, count in other.counts.items():
+            counts[value] = counts.get(value, 0) + count
+        self.counts = dict(sorted(counts.items(), key=lambda item: -item[1])[:HH_COUNTERS])
+        return self
+
+    def top(self):
+        \"""
+        The most frequent value (the smallest one on ties), None without values.
+        \"""
+        return min(self.counts, key=lambda value: (-self.counts[value], value)) if self.counts else None
+"""
+    return code
+
+
+def generate_imports(modules):
     """
+    Generates the import block of the generated program.
 
+    Parameters:
+        modules (list): Modules imported with a plain `import` statement, or complete
+            "from ... import ..." statements.
 
-    tmp = f"""
-\"""
--------------------------------------------------------
-Auto-Generated Program - Multi-Feature Query Processor
-Generated by: generator.py
-Author: Sairithik Komuravelly (Team: NoJoinZone)
-Description:
-    This program executes a dynamically constructed MF (Multi-Feature) query
-    over the 'sales' table. It performs multiple scans to evaluate conditions
-    associated with each grouping variable and computes the required aggregates
-    (e.g., sum, count, avg, max, min).
+    Returns:
+        str: Sorted import statements, followed by the from-imports (including dotenv).
+    """
+    plain = [f"import {module}" for module in sorted(set(modules)) if not module.startswith("from ")]
+    froms = sorted({module for module in modules if module.startswith("from ")} | {"from dotenv import load_dotenv"})
+    return "\n".join(plain + froms)
 
-    The logic is based on enhanced SQL-like processing without using joins,
-    in accordance with the CS562 Project specifications and relevant research.
 
-    Final output is printed in a formatted table containing the fields
-    specified in the 'S' clause of input.json.
--------------------------------------------------------
-\"""
-import os
-import psycopg2
-import psycopg2.extras
-import tabulate
-from dotenv import load_dotenv
+# Reader of the spill files of pickled row batches of the generated program
+READ_SPILL_HELPER = """
 
-{mf_class_code}
-# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+def read_batches(path):
+    \"""
+    Reads back the rows of a spill file one pickled batch at a time.
+    \"""
+    # Each reader opens its own handle, so concurrent scans do not share a file position
+    with open(path, "rb") as f:
+        while True:
+            try:
+                batch = pickle.load(f)
+            except EOFError:
+                return
+            yield from batch
+"""
 
-def query():
-    load_dotenv()
 
-    user = os.getenv('USER')
-    password = os.getenv('PASSWORD')
-    dbname = os.getenv('DBNAME')
+def generate_ingest(plan, stream=None, batch_size=10000, single_pass=False):
+    """
+    Generates the code that loads the sales rows every scan iterates over.
 
-    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password,
-                            cursor_factory=psycopg2.extras.DictCursor)
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM sales")
-    sales_rows = cur.fetchall()
-    _global = []
-    {body}
-    
-    return tabulate.tabulate(_global,
-                        headers="keys", tablefmt="psql")
+    Three ingestion modes are supported:
+        * None (default): fetchall() of the whole table into a list of tuples
+        * 'restream': every scan re-streams the table through a server-side (named)
+          cursor; all scans run inside one REPEATABLE READ snapshot so they see the same rows
+        * 'spill': the first scan streams the table through a server-side cursor and
+          spills a compact pickled copy to a temporary file that later scans read back
 
-def main():
-    print(query())
-    
-if "__main__" == __name__:
-    main()
+    In both streaming modes at most `batch_size` rows are held in memory at a time,
+    so peak memory is bounded by the batch size plus the MF structure.
+
+    When the plan has a groups query (see plan_sales_query()), `group_rows` is bound
+    as well and both queries run in one REPEATABLE READ snapshot.
+
+    Parameters:
+        plan (dict): The SQL plan from plan_sales_query().
+        stream (str): None, 'restream' or 'spill'.
+        batch_size (int): Rows fetched per round trip in the streaming modes.
+        single_pass (bool): The program reads the rows only once, so both streaming
+            modes simply stream the table once.
+
+    Returns:
+        tuple:
+            - str: Module-level helper code for the generated program
+            - str: Statements inside query() that bind `sales_rows` (and `group_rows`)
+
+    Raises:
+        ValueError: If the stream mode is unknown.
+    """
+    groups_query = plan["groups_query"]
+    helpers = f"""
+
+SALES_QUERY = {plan['query']!r}
+"""
+    snapshot = ""
+    if groups_query:
+        helpers += f"""GROUPS_QUERY = {groups_query!r}
+"""
+        snapshot = """# GROUPS_QUERY and SALES_QUERY must see the same snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    """
+    if stream is None:
+        ingest = snapshot + """cur = conn.cursor()"""
+        if groups_query:
+            ingest += """
+    cur.execute(GROUPS_QUERY)
+    group_rows = cur.fetchall()"""
+        ingest += """
+    cur.execute(SALES_QUERY)
+    sales_rows = cur.fetchall()"""
+        return helpers, ingest
+    if stream not in ("restream", "spill"):
+        raise ValueError(f"Unknown stream mode: {stream}")
+
+    helpers += f"""BATCH_SIZE = {batch_size}
+_cursor_names = itertools.count()
+
+
+def stream_sales(conn, query=SALES_QUERY):
+    \"""
+    Streams the rows of a query through a server-side (named) cursor, BATCH_SIZE rows per round trip.
+    \"""
+    with conn.cursor(name=f"mf_sales_scan_{{next(_cursor_names)}}") as cur:
+        cur.itersize = BATCH_SIZE
+        cur.execute(query)
+        yield from cur
+"""
+    groups = """
+    group_rows = stream_sales(conn, GROUPS_QUERY)""" if groups_query else ""
+    if single_pass:
+        ingest = snapshot + """sales_rows = stream_sales(conn)""" + groups
+    elif stream == "restream":
+        helpers += """
+
+class SalesStream:
+    \"""
+    Re-iterable view of the sales table: every scan opens a new server-side cursor.
+    \"""
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __iter__(self):
+        return stream_sales(self.conn)
+"""
+        ingest = """# Every scan re-streams the table; REPEATABLE READ keeps all scans on one snapshot
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    sales_rows = SalesStream(conn)""" + groups
+    else:
+        helpers += READ_SPILL_HELPER + """
+
+class SpilledSales:
+    \"""
+    Re-iterable view of the sales table: the first scan streams it from the server and
+    spills it to a temporary file in pickled batches, later scans read the local copy.
+    \"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.spill = tempfile.NamedTemporaryFile(prefix="mf_sales_", suffix=".spill")
+        self.complete = False
+
+    def __iter__(self):
+        return self.read_spill() if self.complete else self.stream_and_spill()
+
+    def stream_and_spill(self):
+        self.spill.seek(0)
+        self.spill.truncate()
+        batch = []
+        for row in stream_sales(self.conn):
+            batch.append(row)
+            yield row
+            if len(batch) == BATCH_SIZE:
+                pickle.dump(batch, self.spill, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        pickle.dump(batch, self.spill, pickle.HIGHEST_PROTOCOL)
+        self.spill.flush()
+        self.complete = True
+
+    def read_spill(self):
+        return read_batches(self.spill.name)
+"""
+        ingest = snapshot + """sales_rows = SpilledSales(conn)""" + groups
+    return helpers, ingest
+
+
+def generate_copy_ingest(plan, columns):
+    """
+    Generates the code that loads the referenced sales columns with a binary COPY, for the
+    NumPy backend.
+
+    COPY (SALES_QUERY) TO STDOUT in binary format sends every row as one message of
+    length-prefixed, big-endian fields, and psycopg2 builds no Python object per value.
+    The integer columns are cast to int8 and date to date in the COPY query, so their
+    fields have a fixed width; rows are grouped by their byte layout (the length of every
+    string field), and each group is decoded with one vectorized NumPy slice per field.
+    When the server refuses the COPY, or a row does not decode (e.g. a NULL), the columns
+    are fetched through the tuple cursor and load_columns() instead; the COPY runs on a
+    savepoint, so a failed one does not abort the transaction.
+
+    Decoding the COPY rows back into row tuples is slower than psycopg2's tuple cursor,
+    so only the columnar backend uses this path.
+
+    Parameters:
+        plan (dict): The SQL plan from plan_sales_query().
+        columns (list): The loaded columns, in the order of plan["columns"].
+
+    Returns:
+        tuple:
+            - str: Module-level helper code for the generated program
+            - str: Statements inside run() that bind `columns`, the dict of arrays (and
+              `group_rows`)
     """
+    kinds = {name: "int" if name in INTEGER_COLUMNS else "date" if name == "date" else "str" for name in columns}
+    select = ", ".join(f"{name}::int8" if kind == "int" else f"{name}::date" if kind == "date" else name
+                       for name, kind in kinds.items())
+    copy_query = f"COPY (SELECT {select} FROM ({plan['query']}) AS sales) TO STDOUT WITH (FORMAT binary)"
+    helpers = f"""
+
+SALES_QUERY = {plan['query']!r}
+{f"GROUPS_QUERY = {plan['groups_query']!r}" + chr(10) if plan["groups_query"] else ""}# Kind of every field of the COPY_QUERY rows, in order
+COPY_COLUMNS = {kinds!r}
+COPY_QUERY = {copy_query!r}
+# Signature at the start of the binary COPY header, and the widths of the fixed-size fields
+COPY_SIGNATURE = b"PGCOPY\\n\\xff\\r\\n\\x00"
+COPY_WIDTHS = {{"int": 8, "date": 4}}
+
+
+class CopyMessages(list):
+    \"""
+    File-like sink of copy_expert(): psycopg2 writes every CopyData message, one row, separately.
+    \"""
+    write = list.append
+
+
+def copy_field(rows, offset, dtype):
+    \"""
+    The field of the given dtype at a byte offset of every row of a (rows, row length) byte matrix.
+    \"""
+    width = np.dtype(dtype).itemsize
+    if offset + width > rows.shape[1]:
+        raise ValueError("Truncated COPY row")
+    return np.ascontiguousarray(rows[:, offset:offset + width]).view(dtype).ravel()
+
+
+def decode_layouts(rows, index, offset, names, parts):
+    \"""
+    Decodes the fields `names` starting at a byte offset of rows that share their layout so
+    far, splitting them on the length of every string field. Appends (row numbers, values)
+    pairs to parts.
+    \"""
+    if not names:
+        if offset != rows.shape[1]:
+            raise ValueError("Unexpected bytes at the end of a COPY row")
+        return
+    name, kind = names[0], COPY_COLUMNS[names[0]]
+    lengths = copy_field(rows, offset, ">i4")
+    if kind != "str":
+        width = COPY_WIDTHS[kind]
+        if (lengths != width).any():
+            # A length of -1 is a NULL
+            raise ValueError(f"Unexpected {{name}} field in a COPY row")
+        parts[name].append((index, copy_field(rows, offset + 4, f">i{{width}}")))
+        decode_layouts(rows, index, offset + 4 + width, names[1:], parts)
+        return
+    distinct = np.unique(lengths).tolist()
+    for length in distinct:
+        if length < 0:
+            raise ValueError(f"NULL {{name}} in a COPY row")
+        if len(distinct) == 1:
+            layout, layout_index = rows, index
+        else:
+            selected = lengths == length
+            layout, layout_index = rows[selected], index[selected]
+        values = copy_field(layout, offset + 4, f"S{{length}}") if length else np.zeros(len(layout), dtype="S1")
+        parts[name].append((layout_index, values))
+        decode_layouts(layout, layout_index, offset + 4 + length, names[1:], parts)
+
+
+def copy_strings(values, encoding):
+    \"""
+    Decodes an array of string fields: ASCII bytes are simply widened to code points, other
+    text is decoded from the connection encoding.
+    \"""
+    codes = values.view(np.uint8)
+    if codes.max() < 0x80:
+        return codes.astype(np.uint32).view(f"U{{values.dtype.itemsize}}")
+    return np.char.decode(values, encoding)
+
+
+def decode_copy(messages, encoding="utf-8"):
+    \"""
+    Decodes the messages of a binary COPY of COPY_QUERY into one NumPy array per column, with
+    the values load_columns() would hold. Raises ValueError on anything unexpected.
+    \"""
+    if not messages or not messages[0].startswith(COPY_SIGNATURE):
+        raise ValueError("Not a binary COPY")
+    # The header (signature, flags and extension area) precedes the first row, a field count of -1 follows the last
+    messages[0] = messages[0][19 + int.from_bytes(messages[0][15:19], "big"):]
+    if messages[-1] != b"\\xff\\xff":
+        raise ValueError("Truncated COPY")
+    messages.pop()
+    if messages and not messages[0]:
+        del messages[0]
+    if not messages:
+        return {{name: np.array([]) for name in COPY_COLUMNS}}
+
+    # Rows of one length form a (rows, length) byte matrix, split further by decode_layouts()
+    lengths = np.fromiter(map(len, messages), dtype=np.int64, count=len(messages))
+    order = np.argsort(lengths, kind="stable")
+    parts = {{name: [] for name in COPY_COLUMNS}}
+    for group in np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1):
+        rows = np.frombuffer(b"".join(map(messages.__getitem__, group.tolist())), dtype=np.uint8)
+        rows = rows.reshape(len(group), -1)
+        if (copy_field(rows, 0, ">i2") != len(COPY_COLUMNS)).any():
+            raise ValueError("Unexpected field count in a COPY row")
+        decode_layouts(rows, group, 2, list(COPY_COLUMNS), parts)
+
+    columns = {{}}
+    for name, kind in COPY_COLUMNS.items():
+        index = np.concatenate([index for index, _ in parts[name]])
+        values = np.concatenate([copy_strings(values, encoding) if kind == "str" else values.astype(np.int64)
+                                 for _, values in parts[name]])
+        column = np.empty_like(values)
+        column[index] = values
+        if kind == "date":
+            # Days since 2000-01-01, as datetime.date objects like psycopg2 returns them
+            column = (np.datetime64("2000-01-01") + column.astype("timedelta64[D]")).astype(object)
+        columns[name] = column
+    return columns
+
+
+def copy_columns(conn):
+    \"""
+    Loads the COLUMNS of SALES_QUERY through COPY_QUERY, decoded straight into NumPy arrays.
+    Falls back to the tuple cursor and load_columns() when the server refuses the COPY or
+    its rows do not decode.
+    \"""
+    cur = conn.cursor()
+    # Outside autocommit a failed COPY would abort the transaction, unless rolled back to a savepoint
+    savepoint = not conn.autocommit
+    if savepoint:
+        cur.execute("SAVEPOINT mf_copy")
+    messages = CopyMessages()
+    try:
+        cur.copy_expert(COPY_QUERY, messages)
+    except psycopg2.Error:
+        if savepoint:
+            cur.execute("ROLLBACK TO SAVEPOINT mf_copy")
+        messages = None
+    else:
+        if savepoint:
+            cur.execute("RELEASE SAVEPOINT mf_copy")
+    if messages is not None:
+        try:
+            return decode_copy(messages, psycopg2.extensions.encodings[conn.encoding])
+        except ValueError:
+            pass
+    cur.execute(SALES_QUERY)
+    return load_columns(cur.fetchall(), COLUMNS)
+"""
+    ingest = "columns = copy_columns(conn)"
+    if plan["groups_query"]:
+        ingest = """# GROUPS_QUERY and COPY_QUERY must see the same snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    cur = conn.cursor()
+    cur.execute(GROUPS_QUERY)
+    group_rows = cur.fetchall()
+    """ + ingest
+    return helpers, ingest
+
+
+# File extension -> format of the sales sources of generate_source()
+SOURCE_FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow", ".csv": "csv"}
+
+
+def source_format(source):
+    """
+    Returns the format of a sales source file from its extension: 'parquet', 'arrow'
+    (Arrow IPC file, also .feather) or 'csv'.
+
+    Raises:
+        ValueError: If the extension is not one of SOURCE_FORMATS.
+    """
+    extension = os.path.splitext(source)[1].lower()
+    if extension not in SOURCE_FORMATS:
+        raise ValueError(f"Unknown source format (expected {', '.join(SOURCE_FORMATS)}): {source}")
+    return SOURCE_FORMATS[extension]
+
+
+def source_imports(source):
+    """
+    Returns the modules the source helpers of generate_source() use in the generated program.
+    """
+    if source_format(source) == "csv":
+        return ["csv", "datetime", "itertools"]
+    return ["pyarrow as pa"] + (["pyarrow.parquet as pq"] if source_format(source) == "parquet" else [])
+
+
+def generate_source(plan, source, batch_size=10000, columnar=False):
+    """
+    Generates the code that reads the sales rows from a file instead of Postgres.
+
+    A source class has column_batches(), which yields the referenced columns (plan
+    columns, in row order) of up to `batch_size` rows at a time, and iterates over the
+    row tuples built from them, with the types psycopg2 returns (int, str and
+    datetime.date). The formats are:
+        * Parquet: only the column chunks of the referenced columns are read
+        * Arrow IPC (.arrow/.feather): the file is memory-mapped and its record batches
+          are read in place
+        * CSV with a header line: integer columns are parsed as int, date as ISO dates
+
+    The row tuples feed the python backend. With `columnar` (the NumPy backend), Arrow
+    sources also provide table(), whose columns arrow_columns() turns into NumPy arrays
+    without going through rows (zero-copy for numeric columns without nulls); CSV rows go
+    through the backend's load_columns().
+
+    Parameters:
+        plan (dict): The plan from plan_sales_query() (its queries are not used).
+        source (str): Path of the file, see source_format().
+        batch_size (int): Rows per batch.
+        columnar (bool): Also generate the columnar access of Arrow sources.
+
+    Returns:
+        tuple:
+            - str: Module-level helper code for the generated program
+            - str: Statements inside run() that bind `sales_rows` (for columnar Arrow
+              sources: `columns`, the dict of arrays)
+    """
+    columns = plan["columns"]
+    fmt = source_format(source)
+    helpers = f"""
+
+SOURCE_PATH = {source!r}
+# The referenced sales columns, in row order
+ROW_COLUMNS = {columns!r}
+SOURCE_BATCH = {batch_size}
+"""
+    if fmt == "csv":
+        parsers = ", ".join(f"{name!r}: {'int' if name in INTEGER_COLUMNS else 'datetime.date.fromisoformat'}"
+                            for name in columns if name in INTEGER_COLUMNS or name == "date")
+        helpers += f"""# Parsers of the CSV columns that are not strings
+CSV_PARSERS = {{{parsers}}}
+
+
+class CSVSource:
+    \"""
+    Sales rows of a CSV file with a header line; only the ROW_COLUMNS are kept.
+    \"""
+    def __init__(self, path=SOURCE_PATH):
+        self.path = path
+
+    def column_batches(self):
+        \"""
+        Yields the ROW_COLUMNS of SOURCE_BATCH rows at a time, as lists of parsed values.
+        \"""
+        with open(self.path, newline="") as f:
+            reader = csv.reader(f)
+            header = next(reader, [])
+            missing = [name for name in ROW_COLUMNS if name not in header]
+            if missing:
+                raise ValueError(f"{{self.path}} has no column {{', '.join(missing)}}")
+            positions = [header.index(name) for name in ROW_COLUMNS]
+            while batch := list(itertools.islice(reader, SOURCE_BATCH)):
+                values = list(zip(*batch))
+                yield [list(map(CSV_PARSERS[name], values[pos])) if name in CSV_PARSERS else list(values[pos])
+                       for name, pos in zip(ROW_COLUMNS, positions)]
+
+    def __iter__(self):
+        for batch in self.column_batches():
+            yield from zip(*batch)
+"""
+        return helpers, "sales_rows = list(CSVSource())" if not columnar else "sales_rows = CSVSource()"
+    class_name = "ParquetSource" if fmt == "parquet" else "ArrowSource"
+    if fmt == "parquet":
+        helpers += """
+
+class ParquetSource:
+    \"""
+    Sales rows of a Parquet file; only the column chunks of the ROW_COLUMNS are read.
+    \"""
+    def __init__(self, path=SOURCE_PATH):
+        self.path = path
+
+    def column_batches(self):
+        \"""
+        Yields the ROW_COLUMNS of SOURCE_BATCH rows at a time, as Arrow arrays.
+        \"""
+        for batch in pq.ParquetFile(self.path, memory_map=True).iter_batches(batch_size=SOURCE_BATCH,
+                                                                              columns=ROW_COLUMNS):
+            yield [batch.column(name) for name in ROW_COLUMNS]
+"""
+        table = "pq.read_table(self.path, columns=ROW_COLUMNS, memory_map=True)"
+    else:
+        helpers += """
+
+class ArrowSource:
+    \"""
+    Sales rows of an Arrow IPC file (Feather v2), memory-mapped: the record batches are
+    read in place, without copying them.
+    \"""
+    def __init__(self, path=SOURCE_PATH):
+        self.path = path
+
+    def column_batches(self):
+        \"""
+        Yields the ROW_COLUMNS of every record batch, sliced to SOURCE_BATCH rows, as Arrow arrays.
+        \"""
+        reader = pa.ipc.open_file(pa.memory_map(self.path))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for start in range(0, batch.num_rows, SOURCE_BATCH):
+                part = batch.slice(start, SOURCE_BATCH)
+                yield [part.column(name) for name in ROW_COLUMNS]
+"""
+        table = "pa.ipc.open_file(pa.memory_map(self.path)).read_all().select(ROW_COLUMNS)"
+    helpers += """
+    def __iter__(self):
+        for batch in self.column_batches():
+            yield from zip(*(column.to_pylist() for column in batch))
+"""
+    if not columnar:
+        return helpers, f"sales_rows = list({class_name}())"
+    helpers += f"""
+    def table(self):
+        \"""
+        The ROW_COLUMNS of the whole file as an Arrow table.
+        \"""
+        return {table}
+
+
+def arrow_columns(table):
+    \"""
+    The columns of an Arrow table as NumPy arrays: zero-copy for numeric columns without
+    nulls, dates as datetime.date objects (as psycopg2 returns them).
+    \"""
+    arrays = {{}}
+    for name in table.column_names:
+        array = table.column(name).to_numpy()
+        arrays[name] = array.astype(object) if array.dtype.kind == "M" else array
+    return arrays
+"""
+    return helpers, f"columns = arrow_columns({class_name}().table())"
+
+
+# Modules the snapshot helpers of generate_snapshot_ingest() use in the generated program
+SNAPSHOT_IMPORTS = ["datetime", "hashlib", "json", "mmap", "sys", "tempfile", "from array import array"]
+
+
+def generate_snapshot_ingest(plan, snapshot_dir, version_column=None, batch_size=10000):
+    """
+    Generates ingestion from a local columnar snapshot of the sales table.
+
+    The snapshot is one memory-mapped file per database in `snapshot_dir` holding every
+    sales column: integer columns as fixed-width int64, the others as int32 codes into a
+    dictionary kept in the file header. Each run first probes the table version (its
+    oid, row count and the highest xmin, or the highest value of `version_column`) and
+    only rebuilds the snapshot, streaming the table once, when the version changed. The
+    probe and the rebuild run in one REPEATABLE READ snapshot; the file is written to a
+    temporary name and renamed, so concurrent runs never read a partial snapshot.
+
+    Rows are read straight from the mapped columns, so an unchanged table is scanned
+    without any transfer from the server. The plan must not push down predicates
+    (see plan_sales_query()): the snapshot holds the whole table.
+
+    Parameters:
+        plan (dict): The SQL plan from plan_sales_query().
+        snapshot_dir (str): Directory of the snapshot files.
+        version_column (str): Optional column whose maximum identifies the table version
+            (e.g. a sequence id or a last-modified timestamp), instead of xmin.
+        batch_size (int): Rows fetched per round trip while building a snapshot.
+
+    Returns:
+        tuple:
+            - str: Module-level helper code for the generated program
+            - str: Statements inside run() that bind `sales_rows`
+
+    Raises:
+        ValueError: If the plan pushes down predicates or the version column is not an identifier.
+    """
+    if plan["groups_query"] or " WHERE " in plan["query"]:
+        raise ValueError("a local snapshot needs a plan without pushed-down predicates")
+    if version_column is not None and not re.fullmatch(r"[A-Za-z_]\w*", version_column):
+        raise ValueError(f"Invalid version column: {version_column}")
+    version = version_column or "xmin::text::bigint"
+    helpers = f"""
+
+SNAPSHOT_DIR = {snapshot_dir!r}
+SNAPSHOT_COLUMNS = {SALES_COLUMNS!r}
+SNAPSHOT_INTEGER_COLUMNS = {sorted(INTEGER_COLUMNS)!r}
+SNAPSHOT_MAGIC = b"MFSNAP01"
+VERSION_QUERY = "SELECT 'sales'::regclass::oid, count(*), max({version}) FROM sales"
+ROW_COLUMNS = {plan['columns']!r}
+BATCH_SIZE = {batch_size}
+
+
+def snapshot_path(conn):
+    \"""
+    Path of the snapshot of the sales table of the connection's database.
+    \"""
+    database = f"{{conn.info.host}}:{{conn.info.port}}/{{conn.info.dbname}}"
+    return os.path.join(SNAPSHOT_DIR, f"sales-{{hashlib.sha1(database.encode()).hexdigest()[:16]}}.mfsnap")
+
+
+def build_snapshot(conn, path, version):
+    \"""
+    Streams the sales table once into a new columnar snapshot file.
+    \"""
+    data = {{name: array('q') if name in SNAPSHOT_INTEGER_COLUMNS else array('i') for name in SNAPSHOT_COLUMNS}}
+    dictionaries = {{name: {{}} for name in SNAPSHOT_COLUMNS if name not in SNAPSHOT_INTEGER_COLUMNS}}
+    with conn.cursor(name="mf_sales_snapshot") as cur:
+        cur.itersize = BATCH_SIZE
+        # In date order, so zone maps over the snapshot's rows are selective
+        cur.execute(f"SELECT {{', '.join(SNAPSHOT_COLUMNS)}} FROM sales ORDER BY date")
+        while batch := cur.fetchmany(BATCH_SIZE):
+            for name, values in zip(SNAPSHOT_COLUMNS, zip(*batch)):
+                dictionary = dictionaries.get(name)
+                if dictionary is None:
+                    data[name].extend(values)
+                else:
+                    data[name].extend([dictionary.setdefault(value, len(dictionary)) for value in values])
+
+    header = {{"version": version, "rows": len(data[SNAPSHOT_COLUMNS[0]]), "byteorder": sys.byteorder,
+              "columns": {{}}}}
+    offset = 0
+    for name in SNAPSHOT_COLUMNS:
+        meta = {{"offset": offset, "size": len(data[name]) * data[name].itemsize, "typecode": data[name].typecode}}
+        if name in dictionaries:
+            values = list(dictionaries[name])
+            meta["date"] = any(isinstance(value, datetime.date) for value in values)
+            meta["dictionary"] = [value.isoformat() if meta["date"] and value is not None else value
+                                  for value in values]
+        header["columns"][name] = meta
+        offset += -(-meta["size"] // 8) * 8
+    encoded = json.dumps(header).encode()
+    # Column offsets are relative to the 8-byte aligned end of the header
+    data_start = -(-(16 + len(encoded)) // 8) * 8
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=SNAPSHOT_DIR, prefix="sales-", suffix=".tmp", delete=False) as f:
+        f.write(SNAPSHOT_MAGIC + len(encoded).to_bytes(8, "little") + encoded)
+        f.write(bytes(data_start - f.tell()))
+        for name in SNAPSHOT_COLUMNS:
+            data[name].tofile(f)
+            f.write(bytes(-f.tell() % 8))
+    os.replace(f.name, path)
+
+
+class SalesSnapshot:
+    \"""
+    Memory-mapped snapshot of the sales table; iterating it yields the rows of ROW_COLUMNS,
+    decoded straight from the mapped columns.
+    \"""
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:8] != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a sales snapshot: {{path}}")
+        header_size = int.from_bytes(self.map[8:16], "little")
+        self.header = json.loads(self.map[16:16 + header_size])
+        self.data_start = -(-(16 + header_size) // 8) * 8
+        self.path = path
+        self.version = self.header["version"]
+        if self.header["byteorder"] != sys.byteorder:
+            raise ValueError(f"Snapshot written on another platform: {{path}}")
+
+    def column(self, name):
+        meta = self.header["columns"][name]
+        start = self.data_start + meta["offset"]
+        values = memoryview(self.map)[start:start + meta["size"]].cast(meta["typecode"])
+        if "dictionary" not in meta:
+            return values
+        dictionary = meta["dictionary"]
+        if meta["date"]:
+            dictionary = [None if value is None else datetime.date.fromisoformat(value) for value in dictionary]
+        return map(dictionary.__getitem__, values)
+
+    def __iter__(self):
+        return zip(*[self.column(name) for name in ROW_COLUMNS])
+
+
+def open_snapshot(conn):
+    \"""
+    Opens the local snapshot of the sales table, rebuilding it first when the table
+    version probe does not match the snapshot.
+    \"""
+    # The probe and a rebuild must see the same snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    with conn.cursor() as cur:
+        cur.execute(VERSION_QUERY)
+        version = [str(value) for value in cur.fetchone()]
+    path = snapshot_path(conn)
+    try:
+        snapshot = SalesSnapshot(path)
+        if snapshot.version == version:
+            return snapshot
+    except (FileNotFoundError, ValueError):
+        pass
+    build_snapshot(conn, path, version)
+    return SalesSnapshot(path)
+"""
+    return helpers, "sales_rows = open_snapshot(conn)"
+
+
+def parse_condition(cond):
+    """
+    Parses a sigma or G condition into a Python expression AST.
+
+    The condition is first normalized into Python syntax: attribute references of a
+    grouping variable such as "2.quant" become "row.quant", "x BETWEEN a AND b" becomes
+    "(x >= a and x <= b)", a standalone '=' becomes '==', '<>' becomes '!=' and
+    AND/OR/NOT/IN are lowercased, all outside string literals. Parentheses and IN lists
+    such as "1.state IN ('NY', 'NJ')" are plain Python syntax. ISO date strings compared to the
+    date column are parsed into datetime.date constants.
+
+    Parameters:
+        cond (str): The condition string from the input JSON.
+
+    Returns:
+        ast.expr: The root node of the parsed expression.
+
+    Raises:
+        ValueError: If the condition is not a valid expression.
+    """
+    # String literals are set aside so the rewrites below never touch them ('OR', 'a=b', '2.x')
+    literals = []
+
+    def mask_literal(match):
+        literals.append(match.group())
+        return f"__mf_literal_{len(literals) - 1}__"
+    expr = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", mask_literal, cond)
+    expr = re.sub(r'\b\d+\.([A-Za-z_]\w*)', r'row.\1', expr)
+    # x BETWEEN a AND b (inclusive, as in SQL); the operands are single tokens
+    expr = re.sub(r"([\w.]+)\s+(NOT\s+)?BETWEEN\s+([\w.]+)\s+AND\s+([\w.]+)",
+                  lambda m: f"{'not ' if m.group(2) else ''}({m.group(1)} >= {m.group(3)} and {m.group(1)} <= {m.group(4)})",
+                  expr, flags=re.IGNORECASE)
+    expr = expr.replace("<>", "!=")
+    expr = re.sub(r'(?<![<>=!])=(?![=])', '==', expr)
+    expr = re.sub(r'\b(?:AND|OR|NOT|IN)\b', lambda match: match.group().lower(), expr)
+    expr = re.sub(r'__mf_literal_(\d+)__', lambda match: literals[int(match.group(1))], expr)
+    try:
+        node = ast.parse(expr.strip(), mode="eval").body
+    except SyntaxError as e:
+        raise ValueError(f"Unrecognized condition: {cond}") from e
+    # Rows hold dates as datetime.date: ISO strings compared to the date column become date
+    # constants (whose repr is the generated code "datetime.date(2019, 6, 1)")
+    for sub in ast.walk(node):
+        if isinstance(sub, ast.Compare) and "date" in condition_columns(sub):
+            for constant in ast.walk(sub):
+                if isinstance(constant, ast.Constant) and isinstance(constant.value, str):
+                    try:
+                        constant.value = datetime.date.fromisoformat(constant.value)
+                    except ValueError:
+                        pass
+    return node
+
+
+def split_conjuncts(node):
+    """
+    Returns the top-level 'and' conjuncts of a parsed condition (nested 'and's, e.g. from
+    BETWEEN, are flattened).
+
+    Parameters:
+        node (ast.expr): The parsed condition (see parse_condition()).
+
+    Returns:
+        list: The conjunct nodes, in their original order.
+    """
+    if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And):
+        return [conjunct for value in node.values for conjunct in split_conjuncts(value)]
+    return [node]
+
+
+def reads_aggregates(node):
+    """
+    Returns whether a parsed condition references any aggregate (e.g. avg_quant).
+    """
+    return any(isinstance(sub, ast.Name) and re.fullmatch(AGGREGATE_PATTERN, sub.id) for sub in ast.walk(node))
+
+
+PYTHON_OPERATORS = {
+    ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=",
+    ast.In: "in", ast.NotIn: "not in", ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/",
+}
+
+
+def generate_python_expr(node, columns=SALES_COLUMNS, codes=None):
+    """
+    Compiles a parsed sigma condition into a Python expression for the row-at-a-time scans.
+
+    Row attributes become positional reads such as "row[3]", grouping attributes read
+    the row's own column (the row belongs to the group), aggregates read their column
+    at the group id `g` (avg as a guarded sum / count) and IN lists of constants become
+    set literals, which Python compiles to a constant frozenset.
+
+    With `codes`, the rows hold DICTIONARY_COLUMNS as codes into sorted dictionaries, so
+    comparisons of those columns with strings compare codes: "row[2] == code_0" for
+    '=' and '!=', "row[2] in code_1" for IN, and ordering comparisons against the
+    bisection point of the constant in the dictionary. The constants are only known as
+    codes once the rows are loaded; every one gets a local variable (see
+    encoded_constant()) that the generated program binds before the scans.
+
+    Parameters:
+        node (ast.expr): The parsed condition (see parse_condition()).
+        columns (list): The columns selected by the generated program, in row order.
+        codes (dict): Collects the constants of dictionary-encoded columns; None if the
+            rows hold the values themselves.
+
+    Returns:
+        str: The Python expression.
+
+    Raises:
+        ValueError: If the condition uses an unsupported construct, or compares a
+            dictionary-encoded column in a way codes cannot answer.
+    """
+    def encoded_column(node):
+        # Name of the dictionary-encoded column the node reads, if any
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "row":
+            name = node.attr
+        elif isinstance(node, ast.Name):
+            name = node.id
+        else:
+            return None
+        return name if name in DICTIONARY_COLUMNS else None
+
+    def compile_encoded(node):
+        # Comparison of a dictionary-encoded column with string constants, on codes
+        if len(node.ops) == 1:
+            op, left, right = type(node.ops[0]), node.left, node.comparators[0]
+            if encoded_column(left) is None and op in MIRRORED_OPERATORS:
+                op, left, right = MIRRORED_OPERATORS[op], right, left
+            name = encoded_column(left)
+            if name is not None and isinstance(right, ast.Constant) and isinstance(right.value, str):
+                if op in (ast.Eq, ast.NotEq):
+                    return f"{operand(left, 5)} {PYTHON_OPERATORS[op]} {encoded_constant(codes, 'code_of', name, right.value)}"
+                if op in (ast.Lt, ast.LtE, ast.Gt, ast.GtE):
+                    # x < c  <=>  code(x) < bisect_left(c), x <= c  <=>  code(x) < bisect_right(c), ...
+                    kind = "bisect_left" if op in (ast.Lt, ast.GtE) else "bisect_right"
+                    return f"{operand(left, 5)} {'<' if op in (ast.Lt, ast.LtE) else '>='} {encoded_constant(codes, kind, name, right.value)}"
+            if name is not None and op in (ast.In, ast.NotIn) and isinstance(right, (ast.Tuple, ast.List)) and right.elts \
+                    and all(isinstance(element, ast.Constant) and isinstance(element.value, str) for element in right.elts):
+                values = tuple(element.value for element in right.elts)
+                return f"{operand(left, 5)} {PYTHON_OPERATORS[op]} {encoded_constant(codes, 'codes_of', name, values)}"
+        raise ValueError(f"Comparison cannot be evaluated on dictionary codes: {ast.unparse(node)}")
+
+    def compile_node(node):
+        if isinstance(node, ast.BoolOp):
+            level = precedence(node)
+            return f" {'and' if isinstance(node.op, ast.And) else 'or'} ".join(operand(value, level) for value in node.values)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return f"not {operand(node.operand, 3)}"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return f"-{operand(node.operand, 7)}"
+        if isinstance(node, ast.Compare) and codes is not None:
+            sides = [node.left] + node.comparators
+            names = {encoded_column(side) for side in sides} - {None}
+            strings = any(isinstance(sub, ast.Constant) and isinstance(sub.value, str) for sub in ast.walk(node))
+            # Comparing a column with itself (e.g. 1.cust = cust) works on codes as well
+            if strings or len(names) > 1:
+                return compile_encoded(node)
+        if isinstance(node, ast.Compare):
+            parts = [operand(node.left, 5)]
+            for op, right in zip(node.ops, node.comparators):
+                if type(op) not in PYTHON_OPERATORS:
+                    raise ValueError(f"Unsupported comparison: {ast.unparse(node)}")
+                if isinstance(op, (ast.In, ast.NotIn)) and isinstance(right, (ast.Tuple, ast.List)) \
+                        and right.elts and all(isinstance(element, ast.Constant) for element in right.elts):
+                    parts += [PYTHON_OPERATORS[type(op)], "{" + ", ".join(repr(element.value) for element in right.elts) + "}"]
+                else:
+                    parts += [PYTHON_OPERATORS[type(op)], operand(right, 5)]
+            return " ".join(parts)
+        if isinstance(node, ast.BinOp) and type(node.op) in PYTHON_OPERATORS:
+            level = precedence(node)
+            return f"{operand(node.left, level)} {PYTHON_OPERATORS[type(node.op)]} {operand(node.right, level + 1)}"
+        if isinstance(node, ast.Constant):
+            return repr(node.value)
+        if isinstance(node, (ast.Tuple, ast.List)):
+            return "(" + "".join(compile_node(element) + ", " for element in node.elts) + ")"
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "row":
+            return column_ref(node.attr, columns)
+        if isinstance(node, ast.Name):
+            if re.fullmatch(AGGREGATE_PATTERN, node.id):
+                return transform_condition(node.id)
+            if node.id in SALES_COLUMNS:
+                return column_ref(node.id, columns)
+        raise ValueError(f"Unsupported expression in condition: {ast.unparse(node)}")
+
+    def precedence(node):
+        # Python's binding strength: or < and < not < comparisons < + - < * / < unary minus < atoms
+        if isinstance(node, ast.BoolOp):
+            return 1 if isinstance(node.op, ast.Or) else 2
+        if isinstance(node, ast.UnaryOp):
+            return 3 if isinstance(node.op, ast.Not) else 7
+        if isinstance(node, ast.Compare):
+            return 4
+        if isinstance(node, ast.BinOp):
+            return 5 if isinstance(node.op, (ast.Add, ast.Sub)) else 6
+        return 8
+
+    def operand(node, level):
+        code = compile_node(node)
+        return f"({code})" if precedence(node) < level else code
+    return compile_node(node)
+
+
+# Columns holding integers; ordering comparisons on them mean the same in SQL and Python
+INTEGER_COLUMNS = {"day", "month", "year", "quant"}
+
+# Low-cardinality string columns the dictionary_encoding option replaces by integer codes
+DICTIONARY_COLUMNS = ["cust", "prod", "state"]
+
+# Comparison operator with its operands swapped, e.g. 'NY' < x is x > 'NY'
+MIRRORED_OPERATORS = {ast.Eq: ast.Eq, ast.NotEq: ast.NotEq, ast.Lt: ast.Gt, ast.LtE: ast.GtE,
+                      ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+
+
+def encoded_constant(codes, kind, column, value):
+    """
+    Returns the local variable of the generated program that holds a sigma constant of a
+    dictionary-encoded column, registering it in `codes` on first use.
+
+    Parameters:
+        codes (dict): (kind, column, value) -> variable name, see generate_code_bindings().
+        kind (str): 'code_of' (the value's code), 'codes_of' (the frozenset of the codes
+            of a tuple of values), 'bisect_left' or 'bisect_right' (the value's insertion
+            point in the sorted dictionary).
+        column (str): The dictionary-encoded column.
+        value: The constant.
+
+    Returns:
+        str: The variable name, e.g. "code_0".
+    """
+    return codes.setdefault((kind, column, value), f"code_{len(codes)}")
+
+
+def generate_code_bindings(codes, indent="    "):
+    """
+    Generates the statements that bind the variables of encoded_constant() from the
+    `dictionaries` of the loaded rows.
+
+    Parameters:
+        codes (dict): (kind, column, value) -> variable name.
+        indent (str): Indentation of the statements.
+
+    Returns:
+        str: The statements, one per line.
+    """
+    lines = []
+    for (kind, column, value), name in codes.items():
+        dictionary = f"dictionaries[{column!r}]"
+        if kind == "code_of":
+            lines.append(f"{name} = code_of({dictionary}, {value!r})")
+        elif kind == "codes_of":
+            lines.append(f"{name} = frozenset(code_of({dictionary}, value) for value in {value!r})")
+        else:
+            lines.append(f"{name} = bisect.{kind}({dictionary}, {value!r})")
+    return "".join(f"{indent}{line}\n" for line in lines)
+
+SQL_OPERATORS = {ast.Eq: "=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">="}
+
+
+def condition_columns(node):
+    """
+    Returns the sales columns a parsed sigma condition reads (its "row.<attr>" references).
+
+    Parameters:
+        node (ast.expr): The parsed condition (see parse_condition()).
+
+    Returns:
+        set: Column names.
+    """
+    return {sub.attr for sub in ast.walk(node)
+            if isinstance(sub, ast.Attribute) and isinstance(sub.value, ast.Name) and sub.value.id == "row"}
+
+
+def condition_aggregates(node):
+    """
+    Returns the aggregates a parsed sigma or G condition reads. Only names count, so a
+    string literal such as 'sum_1_quant' is not a reference.
+
+    Parameters:
+        node (ast.expr): The parsed condition (see parse_condition()).
+
+    Returns:
+        set: Aggregate names, e.g. {'avg_quant', 'sum_2_quant'}.
+    """
+    return {sub.id for sub in ast.walk(node) if isinstance(sub, ast.Name) and re.fullmatch(AGGREGATE_PATTERN, sub.id)}
+
+
+def generate_sql_predicate(node):
+    """
+    Translates an aggregate-independent sigma conjunct into an equivalent SQL predicate.
+
+    Only constructs that select exactly the same rows in Postgres and in the generated
+    Python code are translated: and/or, '=' and IN against constants, and ordering
+    comparisons on integer and date columns. Negations and '!=' are not pushed down because SQL
+    drops NULLs where Python keeps them, and string ordering depends on the collation.
+
+    Parameters:
+        node (ast.expr): A conjunct of a parsed sigma condition.
+
+    Returns:
+        str: The SQL predicate, or None if the conjunct cannot be pushed down safely.
+    """
+    def literal(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, datetime.date):
+            return f"'{node.value.isoformat()}'"
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return "'" + node.value.replace("'", "''") + "'"
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return repr(node.value)
+        return None
+
+    def column(node):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+                and node.value.id == "row" and node.attr in SALES_COLUMNS:
+            return node.attr
+        return None
+
+    if isinstance(node, ast.BoolOp):
+        parts = [generate_sql_predicate(value) for value in node.values]
+        if None in parts:
+            return None
+        return f" {'AND' if isinstance(node.op, ast.And) else 'OR'} ".join(f"({part})" for part in parts)
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        op, left, right = node.ops[0], node.left, node.comparators[0]
+        if column(left) is None and column(right) is not None and type(op) in (ast.Eq, ast.Lt, ast.LtE, ast.Gt, ast.GtE):
+            # Put the column on the left: 5 < row.quant is row.quant > 5
+            flipped = {ast.Eq: ast.Eq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+            op, left, right = flipped[type(op)](), right, left
+        name = column(left)
+        if name is None:
+            return None
+        # The constants must have the column's type, or SQL would coerce them differently
+        string_column = name not in INTEGER_COLUMNS
+        if isinstance(op, ast.In) and isinstance(right, (ast.Tuple, ast.List)):
+            values = [literal(element) for element in right.elts]
+            if not values or None in values or any(value.startswith("'") != string_column for value in values):
+                return None
+            return f"{name} IN ({', '.join(values)})"
+        value = literal(right)
+        if value is None or type(op) not in SQL_OPERATORS or value.startswith("'") != string_column:
+            return None
+        # Dates order the same in SQL and Python, strings depend on the collation
+        if not isinstance(op, ast.Eq) and string_column and name != "date":
+            return None
+        return f"{name} {SQL_OPERATORS[type(op)]} {value}"
+    return None
+
+
+def plan_sales_query(input_data, pushdown=True, local=False):
+    """
+    Plans the SQL the generated program issues against the sales table.
+
+    Projection pushdown: only the columns referenced by V, the sigma conditions and the
+    aggregates (quant) are selected.
+
+    Predicate pushdown: when the 0th scan computes no aggregates, the scans only need
+    the rows that can satisfy some grouping variable. The query then gets a WHERE clause
+    equal to the disjunction, over all grouping variables, of the conjunction of their
+    aggregate-independent sigma conjuncts (Q1 reads only NY, NJ and CT rows). Groups
+    still come from the full table, through a separate SELECT DISTINCT of V, so groups
+    without qualifying rows are reported exactly as before. If any grouping variable has
+    no conjunct that can be pushed down safely, no WHERE clause is added.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        pushdown (bool): False selects every column of the full table (no pushdown).
+        local (bool): The rows come from a local snapshot of the whole table (see
+            generate_snapshot_ingest()), so only the projection applies.
+
+    Returns:
+        dict:
+            - "columns": Selected columns, in the order of each row tuple
+            - "query": The SQL query for the scanned rows
+            - "groups_query": SELECT DISTINCT of V when a WHERE clause was pushed
+              down, otherwise None
+    """
+    if not pushdown:
+        return {"columns": list(SALES_COLUMNS),
+                "query": f"SELECT {', '.join(SALES_COLUMNS)} FROM sales",
+                "groups_query": None}
+    _, F_map = generate_mf_class(input_data)
+    sigmas = [parse_condition(cond) for cond in input_data["sigma"]]
+    referenced = set(input_data["V"]) | {"quant"}
+    referenced |= {sketch[1] for agg in input_data["F"] if (sketch := parse_sketch(agg))}
+    for node in sigmas:
+        referenced |= condition_columns(node)
+    columns = [name for name in SALES_COLUMNS if name in referenced]
+    query = f"SELECT {', '.join(columns)} FROM sales"
+
+    disjuncts = []
+    if not F_map["0"] and sigmas and not local:
+        for node in sigmas:
+            conjuncts = node.values if isinstance(node, ast.BoolOp) and isinstance(node.op, ast.And) else [node]
+            pushed = [generate_sql_predicate(conjunct) for conjunct in conjuncts
+                      if not any(isinstance(sub, ast.Name) and re.fullmatch(AGGREGATE_PATTERN, sub.id)
+                                 for sub in ast.walk(conjunct))]
+            pushed = [predicate for predicate in pushed if predicate is not None]
+            if not pushed:
+                # This grouping variable may need any row, so no rows can be filtered out
+                disjuncts = []
+                break
+            disjuncts.append(" AND ".join(pushed) if len(pushed) == 1 else " AND ".join(f"({p})" for p in pushed))
+    if not disjuncts:
+        return {"columns": columns, "query": query, "groups_query": None}
+    unique = list(dict.fromkeys(disjuncts))
+    where = unique[0] if len(unique) == 1 else " OR ".join(f"({d})" for d in unique)
+    return {"columns": columns,
+            "query": f"{query} WHERE {where}",
+            "groups_query": f"SELECT DISTINCT {', '.join(input_data['V'])} FROM sales"}
+
+
+NUMPY_OPERATORS = {
+    ast.Eq: "==", ast.NotEq: "!=", ast.Lt: "<", ast.LtE: "<=", ast.Gt: ">", ast.GtE: ">=",
+    ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/",
+}
+
+
+def numpy_aggregate(agg):
+    """
+    Returns the generated-code expression for an aggregate vector of the NumPy backend.
+
+    Parameters:
+        agg (str): Aggregate name, e.g. 'sum_1_quant' or 'avg_quant'.
+
+    Returns:
+        str: An expression evaluating to one value per group.
+    """
+    if agg.startswith("avg"):
+        return f"avg(mf[{agg.replace('avg', 'sum')!r}], mf[{agg.replace('avg', 'count')!r}])"
+    return f"mf[{agg!r}]"
+
+
+def generate_numpy_expr(node, grouping_keys, per_row):
+    """
+    Compiles a parsed condition into a vectorized NumPy expression.
+
+    Comparisons become element-wise comparisons, and/or/not become &, |, ~ and
+    aggregates become per-group vectors. In a sigma condition (per_row=True) every
+    aggregate is gathered per row through the group-id array `gid`, so e.g.
+    "2.quant > avg_quant" compiles to "columns['quant'] > avg(...)[gid]".
+
+    Parameters:
+        node (ast.expr): The parsed condition (see parse_condition()).
+        grouping_keys (list): Grouping attributes V.
+        per_row (bool): True for sigma masks over rows, False for G over groups.
+
+    Returns:
+        str: The NumPy expression.
+
+    Raises:
+        ValueError: If the condition uses an unsupported construct.
+    """
+    def compile_node(node):
+        if isinstance(node, ast.BoolOp):
+            op = " & " if isinstance(node.op, ast.And) else " | "
+            return op.join(operand(value) for value in node.values)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return f"~{operand(node.operand)}"
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return f"-{operand(node.operand)}"
+        if isinstance(node, ast.Compare):
+            parts = []
+            left = node.left
+            for op, right in zip(node.ops, node.comparators):
+                if isinstance(op, (ast.In, ast.NotIn)):
+                    part = f"np.isin({compile_node(left)}, {compile_node(right)})"
+                    parts.append(part if isinstance(op, ast.In) else f"~{part}")
+                elif type(op) in NUMPY_OPERATORS:
+                    parts.append(f"{operand(left)} {NUMPY_OPERATORS[type(op)]} {operand(right)}")
+                else:
+                    raise ValueError(f"Unsupported comparison: {ast.unparse(node)}")
+                left = right
+            return " & ".join(f"({part})" for part in parts) if len(parts) > 1 else parts[0]
+        if isinstance(node, ast.BinOp) and type(node.op) in NUMPY_OPERATORS:
+            return f"{operand(node.left)} {NUMPY_OPERATORS[type(node.op)]} {operand(node.right)}"
+        if isinstance(node, ast.Constant):
+            return repr(node.value)
+        if isinstance(node, (ast.Tuple, ast.List)):
+            return "[" + ", ".join(compile_node(element) for element in node.elts) + "]"
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "row":
+            if not per_row:
+                raise ValueError(f"Row attribute {node.attr} cannot be used in G")
+            column_ref(node.attr)  # validates the column name
+            return f"columns[{node.attr!r}]"
+        if isinstance(node, ast.Name):
+            if re.fullmatch(AGGREGATE_PATTERN, node.id):
+                return numpy_aggregate(node.id) + ("[gid]" if per_row else "")
+            if node.id in grouping_keys:
+                return f"columns[{node.id!r}]" if per_row else f"group_keys[{node.id!r}]"
+        raise ValueError(f"Unsupported expression in condition: {ast.unparse(node)}")
+
+    def operand(node):
+        # & | ~ bind tighter than comparisons in NumPy, so compound operands are parenthesized
+        code = compile_node(node)
+        return f"({code})" if isinstance(node, (ast.BoolOp, ast.Compare, ast.BinOp, ast.UnaryOp)) else code
+    return compile_node(node)
+
+
+def generate_numpy_aggregate(agg, mask):
+    """
+    Generates the vectorized computation of one aggregate for the NumPy backend.
+
+    Parameters:
+        agg (str): Aggregate name, e.g. 'count_1_quant' or 'max_quant'.
+        mask (str): Row mask of the grouping variable, or None for the 0th scan.
+
+    Returns:
+        str: Statement(s) storing the per-group vector in `mf`.
+    """
+    rows = f"gid[{mask}]" if mask else "gid"
+    quant = f"quant[{mask}]" if mask else "quant"
+    # The 0th scan sees every row of every group, so min/max start from the extreme values;
+    # grouping variable aggregates start from 0 like the MFStructure fields of the row backend
+    if agg.startswith("count"):
+        return f"mf[{agg!r}] = np.bincount({rows}, minlength=n_groups)"
+    if agg.startswith("sum"):
+        # Summed in int64: bincount weights are float64, exact only up to 2 ** 53
+        return f"mf[{agg!r}] = np.zeros(n_groups, dtype=np.int64)\n    np.add.at(mf[{agg!r}], {rows}, {quant})"
+    ufunc = "maximum" if agg.startswith("max") else "minimum"
+    if mask:
+        start = "np.zeros(n_groups, dtype=np.int64)"
+    else:
+        start = f"np.full(n_groups, np.iinfo(np.int64).{'min' if ufunc == 'maximum' else 'max'})"
+    return f"mf[{agg!r}] = {start}\n    np.{ufunc}.at(mf[{agg!r}], {rows}, {quant})"
+
+
+def generate_numpy_code(input_data, stream=None, batch_size=10000, pushdown=True, snapshot=None,
+                        version_column=None, source=None, copy=False):
+    """
+    Generates the source of the MF query program for the NumPy columnar backend.
+
+    Instead of row-at-a-time loops, the program loads the referenced sales columns
+    into NumPy arrays, maps every grouping key to an integer group id, compiles each
+    sigma condition into a boolean row mask and computes aggregates with bincount and
+    ufunc.at reductions. G is evaluated on the aggregate vectors.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        stream (str): Ingestion mode, see generate_ingest().
+        batch_size (int): Rows per round trip in the streaming modes, and rows
+            converted to arrays at a time.
+        pushdown (bool): Push projections and predicates into the SQL, see plan_sales_query().
+        snapshot (str): Read the rows from a local snapshot in this directory, see
+            generate_snapshot_ingest().
+        version_column (str): Version column of the snapshot probe.
+        source (str): Read the columns from this Parquet, Arrow IPC or CSV file, see
+            generate_source().
+        copy (bool): Load the columns with a binary COPY decoded straight into arrays,
+            see generate_copy_ingest().
+
+    Returns:
+        str: The Python source of the generated program.
+    """
+    _, F_map = generate_mf_class(input_data)
+    plan = plan_sales_query(input_data, pushdown, local=bool(snapshot or source))
+    grouping_keys = input_data["V"]
+    G = input_data["G"]
+    final_fields = list(dict.fromkeys(grouping_keys + input_data['S']))
+    sigma_map = {}
+    for cond in input_data["sigma"]:
+        idx = cond.split(".", 1)[0]
+        sigma_map[idx] = cond
+    dag = build_dependency_dag(input_data)
+    stages = plan_scan_stages(dag)
+
+    # Only the grouping attributes, quant and the columns used in sigma are loaded
+    columns = set(grouping_keys) | {"quant"}
+    for cond in sigma_map.values():
+        columns |= condition_columns(parse_condition(cond))
+    column_positions = ", ".join(f"{name!r}: {plan['columns'].index(name)}"
+                                 for name in plan["columns"] if name in columns)
+    group_positions = ", ".join(f"{name!r}: {pos}" for pos, name in enumerate(grouping_keys))
+    if snapshot:
+        ingest_helpers, ingest = generate_snapshot_ingest(plan, snapshot, version_column, batch_size)
+    elif source:
+        ingest_helpers, ingest = generate_source(plan, source, batch_size, columnar=True)
+    elif copy:
+        ingest_helpers, ingest = generate_copy_ingest(plan, [name for name in plan["columns"] if name in columns])
+    else:
+        ingest_helpers, ingest = generate_ingest(plan, stream, batch_size, single_pass=True)
+
+    aggregate_blocks = "\n    ".join(generate_numpy_aggregate(agg, None) for agg in F_map["0"])
+
+    for stage_no, stage in enumerate(stages[1:], start=1):
+        for i in stage:
+            mask = f"mask_{i}"
+            aggregate_blocks += f"""
+
+    # Grouping variable {i} (stage {stage_no}): {sigma_map[str(i)]}
+    {mask} = np.asarray({generate_numpy_expr(parse_condition(sigma_map[str(i)]), grouping_keys, per_row=True)}, dtype=bool)
+    """
+            aggregate_blocks += "\n    ".join(generate_numpy_aggregate(agg, mask) for agg in F_map.get(str(i), []))
+
+    having = f"np.asarray({generate_numpy_expr(parse_condition(G), grouping_keys, per_row=False)}, dtype=bool)" \
+        if G else "np.ones(n_groups, dtype=bool)"
+    output_vectors = set()
+    for field in final_fields:
+        if field.startswith("avg"):
+            output_vectors |= {field.replace("avg", "sum"), field.replace("avg", "count")}
+        elif field not in grouping_keys:
+            output_vectors.add(field)
+    output_vectors = sorted(output_vectors)
+    output_fields = ", ".join(
+        f"{field!r}: group_keys[{field!r}][g]" if field in grouping_keys
+        else f"{field!r}: (out[{field.replace('avg', 'sum')!r}][g] / out[{field.replace('avg', 'count')!r}][g]) "
+             f"if out[{field.replace('avg', 'count')!r}][g] != 0 else 0"
+        if field.startswith("avg") else f"{field!r}: out[{field!r}][g]"
+        for field in final_fields)
+
+    order, limit = parse_order_by(input_data)
+    order_helpers = ""
+    if order == [(key, False) for key in grouping_keys] and limit is None:
+        selection = ""
+        selected = "np.flatnonzero(having)"
+    else:
+        def sort_vector(field):
+            if field in grouping_keys:
+                return f"np.asarray(group_keys[{field!r}])"
+            if field.startswith("avg"):
+                return f"avg(mf[{field.replace('avg', 'sum')!r}], mf[{field.replace('avg', 'count')!r}])"
+            return f"mf[{field!r}]"
+        selection = """
+    selected = np.flatnonzero(having)"""
+        if order:
+            sort_keys = ", ".join(f"{'-' if descending else ''}ranks({sort_vector(field)})[selected]"
+                                  for field, descending in reversed(order))
+            selection = """
+    # ORDER BY: np.lexsort sorts by its last key first, and stably, so ties keep the V order of the group ids""" + selection + f"""
+    selected = selected[np.lexsort([{sort_keys}])]"""
+            order_helpers = """
+
+def ranks(values):
+    \"""
+    Dense rank of every value (0 for the smallest), so any column sorts ascending or descending.
+    \"""
+    return np.unique(values, return_inverse=True)[1]
+"""
+        if limit is not None:
+            selection += f"""
+    selected = selected[:{limit}]"""
+        selected = "selected"
+    # Arrow sources and COPY bind the column arrays directly, the others the rows
+    load = "" if "sales_rows" not in ingest else """
+    columns = load_columns(sales_rows, COLUMNS)"""
+    connect = "" if source else """
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)"""
+    imports = ["itertools", "numpy as np", "os", "psycopg2", "psycopg2.extensions", "tabulate"]
+    if source:
+        imports += source_imports(source)
+    if snapshot:
+        imports += SNAPSHOT_IMPORTS
+    elif "datetime.date(" in aggregate_blocks:
+        imports.append("datetime")
+
+    return f"""
+\"""
+-------------------------------------------------------
+Auto-Generated Program - Multi-Feature Query Processor (NumPy backend)
+Generated by: generator.py
+Author: Sairithik Komuravelly (Team: NoJoinZone)
+Description:
+    This program executes a dynamically constructed MF (Multi-Feature) query
+    over the 'sales' table using columnar NumPy execution: the referenced
+    columns are loaded into arrays, grouping keys are mapped to integer group
+    ids, every sigma condition becomes a boolean row mask and the aggregates
+    (e.g., sum, count, avg, max, min) are computed with vectorized reductions.
+
+    Final output is printed in a formatted table containing the fields
+    specified in the 'S' clause of input.json.
+-------------------------------------------------------
+\"""
+{generate_imports(imports)}
+{ingest_helpers}
+# Positions of the referenced columns within each sales row{" and each GROUPS_QUERY row" if plan["groups_query"] else ""}
+COLUMNS = {{{column_positions}}}
+{f"GROUP_COLUMNS = {{{group_positions}}}" + chr(10) if plan["groups_query"] else ""}LOAD_BATCH = {batch_size}
+
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+def load_columns(rows, positions):
+    \"""
+    Loads the given columns of the rows into NumPy arrays, LOAD_BATCH rows at a time.
+    \"""
+    chunks = {{name: [] for name in positions}}
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, LOAD_BATCH))
+        if not batch:
+            break
+        for name, pos in positions.items():
+            chunks[name].append(np.array([row[pos] for row in batch]))
+    return {{name: np.concatenate(parts) if parts else np.array([]) for name, parts in chunks.items()}}
+
+
+def avg(sums, counts):
+    \"""
+    Per-group average vector, 0 for groups without rows (like the row-at-a-time program).
+    \"""
+    return np.divide(sums, counts, out=np.zeros(len(sums)), where=counts != 0)
+{order_helpers}
+
+def run({"conn=None" if source else "conn"}):
+    \"""
+    {"Runs the MF query over SOURCE_PATH" if source else "Runs the MF query over an open connection"} and returns the output rows as dicts.
+    \"""
+    {ingest}{load}
+    quant = columns['quant']
+    {"group_columns = load_columns(group_rows, GROUP_COLUMNS)" if plan["groups_query"] else "group_columns = columns"}
+
+    # Map every grouping key to an integer group id. np.unique sorts the key values, and
+    # ravel_multi_index keeps that order, so group ids follow the sorted order of V.
+    key_values = [np.unique(group_columns[name]) for name in {grouping_keys!r}]
+    dims = tuple(len(values) for values in key_values)
+    group_ids = np.unique(np.ravel_multi_index(
+        [np.searchsorted(values, group_columns[name]) for name, values in zip({grouping_keys!r}, key_values)], dims))
+    gid = np.searchsorted(group_ids, np.ravel_multi_index(
+        [np.searchsorted(values, columns[name]) for name, values in zip({grouping_keys!r}, key_values)], dims))
+    n_groups = len(group_ids)
+    group_keys = {{name: values[codes].tolist()
+                  for name, values, codes in zip({grouping_keys!r}, key_values, np.unravel_index(group_ids, dims))}}
+
+    mf = {{}} # Aggregate name -> one value per group id
+    # 0th scan aggregates
+    {aggregate_blocks}
+
+    # HAVING is evaluated on the aggregate vectors
+    having = {having}{selection}
+    out = {{name: mf[name].tolist() for name in {output_vectors!r}}}
+    _global = []
+    for g in {selected}.tolist():
+        _global.append({{{output_fields}}})
+    return _global
+
+
+def query():
+    load_dotenv()
+{connect}
+    return tabulate.tabulate(run({"" if source else "conn"}),
+                        headers="keys", tablefmt="psql")
+
+def main():
+    print(query())
+    
+if "__main__" == __name__:
+    main()
+    """
+
+
+# Start method of the worker processes of the generated program
+WORKER_CONTEXT_HELPER = """
+
+def worker_context():
+    \"""
+    Multiprocessing context of the worker processes. Spawned workers import this program by
+    module name, so a program that only exists in memory (exec() of its source) forks them.
+    \"""
+    try:
+        importable = __name__ == "__main__" or importlib.util.find_spec(__name__) is not None
+    except ValueError:
+        # In sys.modules without a spec
+        importable = False
+    return multiprocessing.get_context(None if importable else "fork")
+"""
+
+
+def generate_partitioned_scans(plan, grouping_keys, workers, batch_size=10000, merge_operations=None):
+    """
+    Generates the module-level code that runs mf_scans() over hash partitions of the rows
+    in a pool of worker processes.
+
+    The parent loads the referenced columns into NumPy arrays (strings and dates are
+    dictionary-encoded to integer codes), hashes every row's grouping key to one of
+    `workers` * PARTITIONS_PER_WORKER partitions and copies the columns, ordered by
+    partition, into one shared-memory buffer each. Workers attach to the buffers once,
+    decode their slice of rows and run every scan on it; since a group lives in exactly
+    one partition, the per-partition MF structures are simply concatenated. Over-
+    partitioning and handing out the largest partitions first balances the partitions.
+
+    With merge_operations, a heavy-hitter key (more rows than the average partition) is
+    split: its rows are cut into chunks of the average partition size, each scanned as its
+    own task, and the partial aggregates of its group are combined (see merge_operation()).
+    This needs every grouping variable to see all rows of its group with final
+    aggregates, so it is only possible when no sigma reads an aggregate (a single round of
+    plan_shard_rounds()); otherwise a heavy-hitter group stays in one partition and its
+    scan bounds the run time.
+
+    Parameters:
+        plan (dict): The SQL plan from plan_sales_query().
+        grouping_keys (list): The grouping attributes (V).
+        workers (int): Number of worker processes.
+        batch_size (int): Rows converted to arrays at a time.
+        merge_operations (dict): How the partial states of every MF structure aggregate
+            combine, or None to never split a group.
+
+    Returns:
+        str: Module-level code defining scan_partitions(rows).
+    """
+    columns = plan["columns"]
+    return WORKER_CONTEXT_HELPER + f"""
+
+WORKERS = {workers}
+PARTITIONS_PER_WORKER = 8
+LOAD_BATCH = {batch_size}
+# Positions of the grouping attributes (V) and of the dictionary-encoded columns in a row
+GROUP_POSITIONS = {[columns.index(key) for key in grouping_keys]}
+ENCODED_POSITIONS = {[pos for pos, column in enumerate(columns) if column not in INTEGER_COLUMNS]}
+# How the partial aggregates of a split group combine; None when groups are never split
+MERGE_OPERATIONS = {merge_operations!r}
+
+
+def load_columns(rows):
+    \"""
+    Loads the rows into one NumPy array per column, LOAD_BATCH rows at a time. Encoded
+    columns hold integer codes; returns the columns and their dictionaries (code -> value).
+    \"""
+    dictionaries = {{pos: {{}} for pos in ENCODED_POSITIONS}}
+    chunks = None
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, LOAD_BATCH)):
+        batch_columns = list(zip(*batch))
+        if chunks is None:
+            chunks = [[] for _ in batch_columns]
+        for pos, values in enumerate(batch_columns):
+            if pos in dictionaries:
+                # Only the distinct values of the batch go through the Python dictionary
+                dictionary = dictionaries[pos]
+                distinct, codes = np.unique(np.array(values, dtype=object), return_inverse=True)
+                mapping = np.array([dictionary.setdefault(value, len(dictionary)) for value in distinct.tolist()],
+                                   dtype=np.int32)
+                chunks[pos].append(mapping[codes])
+            else:
+                chunks[pos].append(np.array(values, dtype=np.int64))
+    if chunks is None:
+        return [], {{}}
+    return ([np.concatenate(chunk) for chunk in chunks],
+            {{pos: list(dictionary) for pos, dictionary in dictionaries.items()}})
+
+
+# Per worker process: the attached shared-memory blocks and (column, dictionary) views over them
+_shared_blocks = []
+_partition_columns = []
+
+
+def attach_columns(buffers, n_rows, dictionaries):
+    \"""
+    Worker initializer: maps the shared column buffers and the column dictionaries once per process.
+    \"""
+    global _shared_blocks
+    _shared_blocks = [shared_memory.SharedMemory(name=name) for name, _ in buffers]
+    for pos, (block, (_, dtype)) in enumerate(zip(_shared_blocks, buffers)):
+        column = np.ndarray((n_rows,), dtype=dtype, buffer=block.buf)
+        dictionary = np.array(dictionaries[pos], dtype=object) if pos in dictionaries else None
+        _partition_columns.append((column, dictionary))
+
+
+def scan_partition(start, end):
+    \"""
+    Worker task: rebuilds the rows start..end of the shared columns and runs every scan on them.
+    \"""
+    values = [column[start:end].tolist() if dictionary is None else dictionary[column[start:end]].tolist()
+              for column, dictionary in _partition_columns]
+    return mf_scans(list(zip(*values)))
+
+
+def merge_split_groups(mf, part):
+    \"""
+    Adds the groups of a task over heavy-hitter rows to mf, combining the partial
+    aggregates of the groups another task already returned.
+    \"""
+    for g, key in enumerate(part.keys):
+        m = mf.index.get(key)
+        if m is None:
+            mf.index[key] = len(mf.keys)
+            mf.keys.append(key)
+            for agg in MERGE_OPERATIONS:
+                getattr(mf, agg).append(getattr(part, agg)[g])
+            continue
+        for agg, operation in MERGE_OPERATIONS.items():
+            column, value = getattr(mf, agg), getattr(part, agg)[g]
+            if operation == "add":
+                column[m] += value
+            elif operation == "merge":
+                column[m].merge(value)
+            elif (value < column[m]) if operation == "min" else (value > column[m]):
+                column[m] = value
+
+
+def scan_partitions(rows):
+    \"""
+    Hash-partitions the rows by grouping key and runs mf_scans() on every partition in
+    WORKERS processes; returns the concatenation of the per-partition MF structures, with
+    the groups of split heavy-hitter keys merged.
+    \"""
+    columns, dictionaries = load_columns(rows)
+    mf = MFStructure()
+    mf.allocate()
+    if not columns:
+        return mf
+    n_rows = len(columns[0])
+    n_partitions = WORKERS * PARTITIONS_PER_WORKER
+    # Multiplicative hash of the grouping key (codes of encoded columns), wrapping in uint64
+    key_hash = np.zeros(n_rows, dtype=np.uint64)
+    for pos in GROUP_POSITIONS:
+        key_hash = key_hash * np.uint64(1000003) + columns[pos].astype(np.uint64)
+    partition = ((key_hash * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)) % np.uint64(n_partitions)
+    partition = partition.astype(np.intp)
+    if MERGE_OPERATIONS is not None:
+        # A key with more rows than the average partition would pin one worker: its rows
+        # go to extra tasks of that many rows each, after the hash partitions
+        share = -(-n_rows // n_partitions)
+        _, inverse, counts = np.unique(key_hash, return_inverse=True, return_counts=True)
+        hot = counts[inverse.ravel()] > share
+        if hot.any():
+            partition[hot] = n_partitions + (np.cumsum(hot)[hot] - 1) // share
+    order = np.argsort(partition, kind="stable")
+    sizes = np.bincount(partition, minlength=n_partitions)
+    ends = np.cumsum(sizes)
+    # Tasks starting here scan heavy-hitter rows
+    split_start = int(ends[n_partitions - 1])
+    # Largest partitions first, so the last tasks to finish are small ones
+    tasks = sorted(((int(end - size), int(end)) for size, end in zip(sizes, ends) if size),
+                   key=lambda task: task[0] - task[1])
+
+    blocks = []
+    try:
+        for column in columns:
+            block = shared_memory.SharedMemory(create=True, size=max(column.nbytes, 1))
+            blocks.append(block)
+            np.ndarray(column.shape, dtype=column.dtype, buffer=block.buf)[:] = column[order]
+        buffers = [(block.name, column.dtype.str) for block, column in zip(blocks, columns)]
+        del columns, order
+        with concurrent.futures.ProcessPoolExecutor(max_workers=WORKERS, mp_context=worker_context(),
+                                                    initializer=attach_columns,
+                                                    initargs=(buffers, n_rows, dictionaries)) as pool:
+            for (start, _), part in zip(tasks, pool.map(scan_partition, *zip(*tasks))):
+                if start >= split_start:
+                    merge_split_groups(mf, part)
+                else:
+                    mf.extend(part)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return mf
+"""
+
+
+def estimate_group_bytes(input_data, F_map):
+    """
+    Estimates the memory one group of the MF structure takes in the generated program.
+
+    A group is its grouping key tuple (with a string object per string attribute), an
+    entry of the index dict, a slot of the keys list, the int object of its group id,
+    8 bytes per array('q') aggregate column and the bound of every sketch aggregate.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        F_map (dict): Aggregates per scan, from generate_mf_class().
+
+    Returns:
+        int: Estimated bytes per group.
+    """
+    key_tuple = 40 + 8 * len(input_data["V"])
+    key_values = sum(32 if key in INTEGER_COLUMNS or key == "date" else 56 for key in input_data["V"])
+    index_entry, keys_slot, group_id = 64, 8, 28
+    aggregates = 8 * sum(len(aggs) for aggs in F_map.values())
+    # Registers, about 3 * KLL_K int objects and list slots, or HH_COUNTERS dict entries (plus the objects)
+    sketch_bytes = {"count_distinct": (1 << HLL_PRECISION) + 120, "quantile": 3 * KLL_K * 40 + 200,
+                    "top": HH_COUNTERS * 100 + 300}
+    aggregates += sum(sketch_bytes[sketch[0]] for aggs in F_map.values() for agg in aggs if (sketch := parse_sketch(agg)))
+    return key_tuple + key_values + index_entry + keys_slot + group_id + aggregates
+
+
+def generate_output_key(input_data, option):
+    """
+    Generates output_key(row), the sort key of an output row (a dict of the fields of V
+    and S) in the order of the spec's "O" field, with the grouping key as tie-breaker.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        option (str): The option that sorts output rows, named in the error.
+
+    Returns:
+        str: The function definition, or "" when the output is not sorted.
+
+    Raises:
+        ValueError: If ORDER BY uses a field the output rows do not have.
+    """
+    grouping_keys = input_data["V"]
+    final_fields = list(dict.fromkeys(grouping_keys + input_data["S"]))
+    order, _ = parse_order_by(input_data)
+    if order is None:
+        return ""
+    group_key = "(" + ", ".join(f"row[{key!r}]" for key in grouping_keys) + ("," if len(grouping_keys) == 1 else "") + ")"
+    values = []
+    for field, descending in order:
+        if field not in final_fields:
+            raise ValueError(f"{option} needs the ORDER BY fields in S or V: {field}")
+        value = f"row[{field!r}]"
+        if descending:
+            value = f"Descending({value})" if field in grouping_keys and field not in INTEGER_COLUMNS else f"-{value}"
+        values.append(value)
+    return f"""
+
+def output_key(row):
+    \"""
+    Sort key of an output row in ORDER BY order (the order of mf_output()).
+    \"""
+    return ({"".join(value + ", " for value in values)}{group_key})
+"""
+
+
+def generate_memory_budget(input_data, plan, budget_mib, group_bytes, batch_size=10000):
+    """
+    Generates the external (partitioned) execution of a memory-budgeted program (see the
+    memory_budget option of generate_code()).
+
+    run() first counts the distinct grouping keys. When the MF structure of that many
+    groups (at `group_bytes` each) would exceed the budget, the table is streamed once
+    through a server-side cursor and its rows are hash-partitioned by grouping key into
+    temporary files, with twice as many partitions as the budget strictly needs so a
+    partition stays within it despite an uneven hash. Every pass of the query then runs
+    on one partition at a time, reading its rows back from the file one batch at a time,
+    as a partition may hold far more rows than groups; a group lives in exactly one
+    partition, so the partitions' outputs (each already filtered by G and in output
+    order) are merged into the final output. The peak RSS and the bytes spilled are
+    reported.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        plan (dict): The SQL plan from plan_sales_query().
+        budget_mib (int): Memory budget of the MF structure, in MiB.
+        group_bytes (int): Estimated bytes per group, see estimate_group_bytes().
+        batch_size (int): Rows per round trip and per pickled spill batch.
+
+    Returns:
+        str: Module-level helper code for the generated program.
+
+    Raises:
+        ValueError: If ORDER BY uses a field the output rows do not have.
+    """
+    grouping_keys = input_data["V"]
+    order, limit = parse_order_by(input_data)
+    output_key = generate_output_key(input_data, "memory_budget")
+    merge = "itertools.chain.from_iterable(outputs)" if order is None else "heapq.merge(*outputs, key=output_key)"
+    groups = """
+        group_paths, spilled = spill_partitions(stream_rows(conn, GROUPS_QUERY), n_partitions,
+                                                list(range(len(GROUP_POSITIONS))), directory, "groups")
+        spill_bytes += spilled""" if plan["groups_query"] else ""
+    return READ_SPILL_HELPER + f"""
+
+MEMORY_BUDGET = {budget_mib} * 1024 * 1024
+# Estimated bytes per group of the MF structure (key tuple and values, index entry, keys slot, group id, aggregates)
+GROUP_BYTES = {group_bytes}
+MAX_GROUPS = max(1, MEMORY_BUDGET // GROUP_BYTES)
+GROUP_COUNT_QUERY = {f"SELECT count(*) FROM (SELECT DISTINCT {', '.join(grouping_keys)} FROM sales) AS groups"!r}
+# Positions of the grouping attributes (V) in a row
+GROUP_POSITIONS = {[plan["columns"].index(key) for key in grouping_keys]}
+SPILL_BATCH = {batch_size}
+last_memory = None
+_cursor_names = itertools.count()
+
+
+def stream_rows(conn, query):
+    \"""
+    Streams the rows of a query through a server-side (named) cursor, SPILL_BATCH rows per round trip.
+    \"""
+    with conn.cursor(name=f"mf_budget_scan_{{next(_cursor_names)}}") as cur:
+        cur.itersize = SPILL_BATCH
+        cur.execute(query)
+        yield from cur
+
+
+def spill_partitions(rows, n_partitions, key_positions, directory, name):
+    \"""
+    Hash-partitions rows by their grouping key into n_partitions files of pickled batches.
+    Returns the file paths and the number of bytes written.
+    \"""
+    paths = [os.path.join(directory, f"{{name}}-{{p}}.spill") for p in range(n_partitions)]
+    files = [open(path, "wb") for path in paths]
+    buffers = [[] for _ in paths]
+    key = operator.itemgetter(*key_positions)
+    try:
+        for row in rows:
+            p = hash(key(row)) % n_partitions
+            buffers[p].append(row)
+            if len(buffers[p]) == SPILL_BATCH:
+                pickle.dump(buffers[p], files[p], pickle.HIGHEST_PROTOCOL)
+                buffers[p] = []
+        for p, buffer in enumerate(buffers):
+            if buffer:
+                pickle.dump(buffer, files[p], pickle.HIGHEST_PROTOCOL)
+    finally:
+        for f in files:
+            f.close()
+    return paths, sum(os.path.getsize(path) for path in paths)
+
+
+class SpilledPartition:
+    \"""
+    Re-iterable view of one partition file: every pass streams its pickled batches back, so
+    only one batch of rows is in memory besides the MF structure of the partition.
+    \"""
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        return read_batches(self.path)
+
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows: the memory report has no peak RSS there
+    resource = None
+
+
+def memory_report(mode, n_groups, partitions=1, spill_bytes=0):
+    \"""
+    Summary of a budgeted run: execution mode, groups, partitions, bytes spilled and peak
+    RSS (None without the resource module).
+    \"""
+    peak = None
+    if resource is not None:
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024
+    return {{"mode": mode, "groups": n_groups, "max_groups": MAX_GROUPS, "partitions": partitions,
+            "spill_bytes": spill_bytes, "peak_rss_bytes": peak}}
+
+
+def report_memory(report):
+    \"""
+    Prints the memory report of the last run to stderr.
+    \"""
+    print(f"{{report['mode']}} execution: {{report['groups']:,}} groups (budget {{report['max_groups']:,}}), "
+          f"{{report['partitions']}} partition{{'s' if report['partitions'] != 1 else ''}}, "
+          f"{{report['spill_bytes'] / 2 ** 20:.1f}} MiB spilled, peak RSS "
+          + (f"{{report['peak_rss_bytes'] / 2 ** 20:.1f}} MiB" if report["peak_rss_bytes"] is not None else "unknown"),
+          file=sys.stderr)
+{output_key}
+
+def run_external(conn, n_groups):
+    \"""
+    Runs the MF query one hash partition of the groups at a time and merges the outputs.
+    Returns the output rows and the memory report.
+    \"""
+    n_partitions = -(-2 * n_groups // MAX_GROUPS)
+    # The scans of the table{" and of GROUPS_QUERY" if plan["groups_query"] else ""} must see one snapshot
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    outputs = []
+    with tempfile.TemporaryDirectory(prefix="mf_spill_") as directory:
+        sales_paths, spill_bytes = spill_partitions(stream_rows(conn, SALES_QUERY), n_partitions, GROUP_POSITIONS,
+                                                    directory, "sales"){groups}
+        for p, path in enumerate(sales_paths):
+            mf = mf_scans(SpilledPartition(path){", SpilledPartition(group_paths[p])" if plan["groups_query"] else ""})
+            outputs.append(mf_output(mf))
+            del mf
+    output_rows = {f"list(itertools.islice({merge}, {limit}))" if limit is not None else f"list({merge})"}
+    return output_rows, memory_report("external", n_groups, n_partitions, spill_bytes)
+"""
+
+
+def plan_shard_rounds(input_data):
+    """
+    Assigns the grouping variables to the rounds of sharded execution.
+
+    A round is one pass over every shard's rows, after which the coordinator merges the
+    shards' partial aggregates. A grouping variable whose sigma reads no aggregate runs
+    in round 0 together with the 0th scan; one whose sigma reads aggregates runs in the
+    round after the last one computing them, once they have been merged and broadcast.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json (its sigma conditions must
+            be acyclic, see plan_scan_stages()).
+
+    Returns:
+        list: The grouping variable indices of every round, in execution order.
+    """
+    reads = {int(cond.split(".", 1)[0]):
+             {aggregate_scan_index(agg) for agg in condition_aggregates(parse_condition(cond))}
+             for cond in input_data["sigma"]}
+    level = {0: 0}
+
+    def visit(i):
+        if i not in level:
+            level[i] = 1 + max(visit(d) for d in reads[i]) if reads.get(i) else 0
+        return level[i]
+
+    rounds = [[] for _ in range(1 + max((visit(i) for i in range(1, input_data["n"] + 1)), default=0))]
+    for i in range(1, input_data["n"] + 1):
+        rounds[level[i]].append(i)
+    return rounds
+
+
+def merge_operation(agg):
+    """
+    Returns how the partial states of an aggregate from several shards combine: 'add'
+    (sums and counts), 'min', 'max' or 'merge' (sketch aggregates, see generate_sketches()).
+    """
+    if parse_sketch(agg):
+        return "merge"
+    if agg.startswith("min"):
+        return "min"
+    if agg.startswith("max"):
+        return "max"
+    return "add"
+
+
+def generate_sharded(input_data, F_map, plan, shards, ingest, group_key, zeroth_scan, base_bindings):
+    """
+    Generates the sharded execution of a program over several sales databases with the
+    same schema (see the shards option of generate_code()).
+
+    Every shard runs in its own process, which connects to its database, fetches its rows
+    once and keeps them for every round (see plan_shard_rounds()). Round 0 builds the
+    shard's groups with their 0th scan aggregates and computes the grouping variables
+    whose sigma reads no aggregate. The coordinator merges the shards' partial states by
+    grouping key (sums and counts add up, min/max combine, sketches merge). Each later
+    round broadcasts the merged MF structure to the shards, which compute the grouping
+    variables depending on it over their rows, and merges their columns again.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        F_map (dict): Aggregates per scan, from generate_mf_class().
+        plan (dict): The SQL plan from plan_sales_query().
+        shards (list): Connection targets: database names (with the USER and PASSWORD of
+            .env) or libpq connection strings.
+        ingest (str): The statements of generate_ingest() binding a shard's sales_rows
+            (and group_rows) from conn.
+        group_key (str): Expression of the row's grouping key tuple.
+        zeroth_scan (str): The 0th scan statements of mf_scans().
+        base_bindings (str): The bindings of the 0th scan columns of mf_scans().
+
+    Returns:
+        str: Module-level code defining mf_sharded(loaders) and fetch_shard(target).
+    """
+    columns = plan["columns"]
+    rounds = plan_shard_rounds(input_data)
+    sigma_map = {cond.split(".", 1)[0]: cond for cond in input_data["sigma"]}
+    round_aggregates = [[agg for i in gvs for agg in F_map[str(i)]] for gvs in rounds]
+    operations = {agg: merge_operation(agg) for aggs in round_aggregates for agg in aggs}
+    gv_bindings = "".join(f"\n    {agg} = mf.{agg}" for aggs in round_aggregates for agg in aggs)
+
+    passes = ""
+    for number, gvs in enumerate(rounds):
+        if not gvs:
+            continue
+        gv_blocks = [(i, sigma_conjuncts(sigma_map[str(i)], columns),
+                      generate_updates(F_map.get(str(i), []), columns) or ["pass"]) for i in gvs]
+        gv_list = ("grouping variables " if len(gvs) > 1 else "grouping variable ") + ", ".join(map(str, gvs))
+        passes += f"""    {"if" if not passes else "elif"} round_number == {number}:
+        # Round {number}: {gv_list}
+{generate_fused_scan(gv_blocks, group_key, indent="        ")}"""
+
+    combine = []
+    for agg in F_map["0"]:
+        operation = merge_operation(agg)
+        if operation == "merge":
+            combine.append(f"mf.{agg}[m].merge(part.{agg}[g])")
+        elif operation == "add":
+            combine.append(f"mf.{agg}[m] += part.{agg}[g]")
+        else:
+            combine.append(f"if part.{agg}[g] {'<' if operation == 'min' else '>'} mf.{agg}[m]: mf.{agg}[m] = part.{agg}[g]")
+    append = [f"mf.{agg}.append(part.{agg}[g])" for agg in F_map["0"]]
+    return WORKER_CONTEXT_HELPER + f"""
+
+SHARDS = {list(shards)!r}
+# Grouping variables of every round, their aggregates and how partial states of them combine
+ROUNDS = {rounds!r}
+ROUND_AGGREGATES = {round_aggregates!r}
+MERGE_OPERATIONS = {operations!r}
+
+
+def connect(target):
+    \"""
+    Opens a connection to a shard: a libpq connection string, or a database name reached
+    with the USER and PASSWORD of .env.
+    \"""
+    if "=" not in target:
+        target = "dbname=" + target + " user=" + os.getenv('USER') + " password=" + os.getenv('PASSWORD')
+    return psycopg2.connect(target)
+
+
+def fetch_shard(target):
+    \"""
+    Shard loader: fetches the rows of one shard's sales table over its own connection.
+    \"""
+    conn = connect(target)
+    try:
+        {ingest.replace(chr(10) + "    ", chr(10) + "        ")}
+        return sales_rows, {"group_rows" if plan["groups_query"] else "None"}
+    finally:
+        conn.close()
+
+
+def shard_round(sales_rows, group_rows, round_number, mf=None):
+    \"""
+    Runs one round over a shard's rows. Round 0 builds the shard's own MF structure;
+    later rounds compute their grouping variables into mf, the merged MF structure of
+    every shard, whose aggregates of the round are still 0. Returns the MF structure.
+    \"""
+    if mf is None:
+        mf = MFStructure()
+    index = mf.index
+    keys = mf.keys{base_bindings}
+    if round_number == 0:
+    {zeroth_scan.replace(chr(10), chr(10) + "    ").rstrip()}
+        mf.allocate(){gv_bindings}
+{passes or "    pass" + chr(10)}    return mf
+
+
+def run_shard(load, pipe):
+    \"""
+    Shard process: loads the shard's rows once and sends the MF structure of round 0, then
+    runs every round it receives with the merged MF structure and sends back the round's
+    columns, until it receives None. An exception is sent to the coordinator instead.
+    \"""
+    try:
+        sales_rows, group_rows = load()
+        pipe.send(shard_round(sales_rows, group_rows, 0))
+        while (message := pipe.recv()) is not None:
+            round_number, mf = message
+            mf = shard_round(sales_rows, group_rows, round_number, mf)
+            pipe.send([getattr(mf, agg) for agg in ROUND_AGGREGATES[round_number]])
+    except Exception as error:
+        pipe.send(error)
+    finally:
+        pipe.close()
+
+
+def receive(pipe):
+    \"""
+    Receives a shard's result, raising the exception of a failed shard.
+    \"""
+    result = pipe.recv()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def merge_groups(mf, part):
+    \"""
+    Folds the groups of a shard's round 0 MF structure into mf: new grouping keys are
+    appended with their 0th scan aggregates, the aggregates of known ones are combined.
+    Returns the group id in mf of every group of part.
+    \"""
+    group_ids = []
+    for g, key in enumerate(part.keys):
+        m = mf.index.get(key)
+        if m is None:
+            mf.index[key] = m = len(mf.keys)
+            mf.keys.append(key){"".join(chr(10) + "            " + line for line in append)}{'''
+        else:''' + "".join(chr(10) + "            " + line for line in combine) if combine else ""}
+        group_ids.append(m)
+    return group_ids
+
+
+def merge_columns(mf, round_number, partials, group_ids=None):
+    \"""
+    Combines a shard's partial columns of a round into mf; partial[g] belongs to group
+    group_ids[g] of mf (to group g when the shard computed into the merged groups).
+    \"""
+    for agg, partial in zip(ROUND_AGGREGATES[round_number], partials):
+        column = getattr(mf, agg)
+        operation = MERGE_OPERATIONS[agg]
+        for m, value in zip(group_ids if group_ids is not None else range(len(partial)), partial):
+            if operation == "add":
+                column[m] += value
+            elif operation == "merge":
+                column[m].merge(value)
+            elif (value < column[m]) if operation == "min" else (value > column[m]):
+                column[m] = value
+
+
+def mf_sharded(loaders):
+    \"""
+    Runs the scans over several shards, one process per loader (a callable returning the
+    shard's sales_rows and group_rows), and returns the merged MF structure.
+    \"""
+    context = worker_context()
+    pipes, processes = [], []
+    try:
+        for load in loaders:
+            pipe, shard_pipe = context.Pipe()
+            process = context.Process(target=run_shard, args=(load, shard_pipe), daemon=True)
+            process.start()
+            shard_pipe.close()
+            pipes.append(pipe)
+            processes.append(process)
+        parts = [receive(pipe) for pipe in pipes]
+        mf = MFStructure()
+        group_ids = [merge_groups(mf, part) for part in parts]
+        mf.allocate()
+        for part, ids in zip(parts, group_ids):
+            merge_columns(mf, 0, [getattr(part, agg) for agg in ROUND_AGGREGATES[0]], ids)
+        del parts
+        for round_number in range(1, len(ROUNDS)):
+            # Broadcast the merged aggregates of the earlier rounds; the sigma of this round reads them
+            for pipe in pipes:
+                pipe.send((round_number, mf))
+            for pipe in pipes:
+                merge_columns(mf, round_number, receive(pipe))
+        return mf
+    finally:
+        for pipe in pipes:
+            try:
+                pipe.send(None)
+            except OSError:
+                pass   # the shard process has already exited
+            pipe.close()
+        for process in processes:
+            process.join()
+"""
+
+
+# Interval arithmetic and three-valued logic of G in the approximate mode (see generate_interval_expr())
+INTERVAL_HELPERS = """
+
+UNBOUNDED = (-math.inf, math.inf)
+
+
+def iv_add(a, b):
+    return (a[0] + b[0], a[1] + b[1])
+
+
+def iv_sub(a, b):
+    return (a[0] - b[1], a[1] - b[0])
+
+
+def iv_mul(a, b):
+    # 0 * inf counts as 0: a bound at 0 stays 0 whatever the other factor
+    products = [x * y if x and y else 0.0 for x in a for y in b]
+    return (min(products), max(products))
+
+
+def iv_div(a, b):
+    if b[0] <= 0 <= b[1]:
+        return UNBOUNDED
+    return iv_mul(a, (1 / b[1], 1 / b[0]))
+
+
+def iv_compare(a, op, b):
+    \"""
+    Compares two intervals: True or False when the comparison holds for every pair of
+    values in them, None (uncertain) when the intervals straddle each other.
+    \"""
+    if op in (">", ">="):
+        a, b, op = b, a, "<" if op == ">" else "<="
+    if op == "<":
+        return True if a[1] < b[0] else False if a[0] >= b[1] else None
+    if op == "<=":
+        return True if a[1] <= b[0] else False if a[0] > b[1] else None
+    equal = True if a[0] == a[1] == b[0] == b[1] else False if a[1] < b[0] or b[1] < a[0] else None
+    return equal if op == "==" or equal is None else not equal
+
+
+def all3(values):
+    values = list(values)
+    return False if False in values else None if None in values else True
+
+
+def any3(values):
+    values = list(values)
+    return True if True in values else None if None in values else False
+
+
+def not3(value):
+    return None if value is None else not value
+"""
+
+
+INTERVAL_OPERATORS = {ast.Add: "iv_add", ast.Sub: "iv_sub", ast.Mult: "iv_mul", ast.Div: "iv_div"}
+
+
+def generate_interval_expr(node):
+    """
+    Compiles a parsed G condition into a three-valued expression over confidence
+    intervals, for the approximate mode (see INTERVAL_HELPERS).
+
+    Every aggregate reads its interval, the (low, high) tuple bound to `<name>_iv`,
+    numeric constants are point intervals and arithmetic is interval arithmetic. A
+    comparison is True or False when it holds for every value of its intervals and
+    None (uncertain) when they straddle the threshold; and/or/not follow Kleene's
+    three-valued logic.
+
+    Parameters:
+        node (ast.expr): The parsed G condition (see parse_condition()).
+
+    Returns:
+        tuple:
+            - str: The Python expression, evaluating to True, False or None
+            - set: The aggregates it reads
+
+    Raises:
+        ValueError: If G uses anything but aggregates, numbers, arithmetic, comparisons
+            and and/or/not.
+    """
+    if isinstance(node, ast.BoolOp):
+        parts = [generate_interval_expr(value) for value in node.values]
+        helper = "all3" if isinstance(node.op, ast.And) else "any3"
+        return f"{helper}(({', '.join(expr for expr, _ in parts)},))", set().union(*(names for _, names in parts))
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+        expr, names = generate_interval_expr(node.operand)
+        return f"not3({expr})", names
+    if isinstance(node, ast.Compare):
+        operands = [generate_interval_expr(operand) for operand in [node.left] + node.comparators]
+        tests = [f"iv_compare({operands[k][0]}, {PYTHON_OPERATORS[type(op)]!r}, {operands[k + 1][0]})"
+                 for k, op in enumerate(node.ops) if type(op) in SQL_OPERATORS or isinstance(op, ast.NotEq)]
+        if len(tests) != len(node.ops):
+            raise ValueError(f"Unsupported comparison in G for approximate mode: {ast.unparse(node)}")
+        names = set().union(*(names for _, names in operands))
+        return (tests[0] if len(tests) == 1 else f"all3(({', '.join(tests)},))"), names
+    if isinstance(node, ast.BinOp) and type(node.op) in INTERVAL_OPERATORS:
+        (left, left_names), (right, right_names) = generate_interval_expr(node.left), generate_interval_expr(node.right)
+        return f"{INTERVAL_OPERATORS[type(node.op)]}({left}, {right})", left_names | right_names
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        expr, names = generate_interval_expr(node.operand)
+        return f"iv_sub((0, 0), {expr})", names
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return f"({node.value!r}, {node.value!r})", set()
+    if isinstance(node, ast.Name) and re.fullmatch(AGGREGATE_PATTERN, node.id):
+        return f"{node.id}_iv", {node.id}
+    raise ValueError(f"Unsupported expression in G for approximate mode: {ast.unparse(node)}")
+
+
+def generate_approximate(input_data, F_map, plan, sample_percent, sample_method="row", time_budget=None,
+                         error_target=None, confidence=0.95, dictionary_encoded=False):
+    """
+    Generates the estimation of the approximate mode (see the approximate option of
+    generate_code()).
+
+    The query runs on a sample of the table: every row (sample_method 'row', TABLESAMPLE
+    BERNOULLI) or every page (sample_method 'block', TABLESAMPLE SYSTEM) is kept with
+    probability fraction = percent / 100. mf_estimates() scales the sums and counts by
+    1 / fraction (the Horvitz-Thompson estimator) and gives each sum, count and avg the
+    half-width of its normal confidence interval in a `<field>_ci` column: for a sum
+    Z * sqrt((1 - fraction) * sumsq) / fraction, from the sample's sum of squares (the
+    sumsq_* columns), and for an avg, a ratio of two such sums, the delta method bound
+    Z * sqrt((1 - fraction) * sum of squared deviations) / count. min/max are the
+    sample's, bounds of the true value on one side. Block samples keep whole pages, so
+    their intervals are too narrow when rows of a group are clustered on pages.
+
+    G is evaluated on the intervals (see generate_interval_expr()): groups that certainly
+    fail are dropped, groups whose intervals straddle a threshold are kept with
+    `having` set to 'uncertain'.
+
+    With a time budget or an error target, run() keeps refining (online aggregation):
+    every round doubles the sample percentage (with the same seed, so every sample
+    contains the previous one) and prints the round's estimates to stderr, until the
+    largest relative half-width of the output is within the error target, the next round
+    would exceed the time budget, or the whole table was read.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        F_map (dict): Aggregates per scan, from generate_mf_class() (with the sumsq_* columns).
+        plan (dict): The SQL plan from plan_sales_query().
+        sample_percent (float): Percentage of the table sampled by the first round.
+        sample_method (str): 'row' or 'block'.
+        time_budget (float): Seconds the online rounds may take.
+        error_target (float): Largest relative half-width of the intervals, e.g. 0.02.
+        confidence (float): Confidence level of the intervals.
+        dictionary_encoded (bool): The grouping keys hold codes of DICTIONARY_COLUMNS.
+
+    Returns:
+        str: Module-level helper code, including mf_estimates().
+
+    Raises:
+        ValueError: If G cannot be evaluated on intervals, or ORDER BY uses a field the
+            output rows do not have.
+    """
+    grouping_keys = input_data["V"]
+    decoded = [key for key in grouping_keys if key in DICTIONARY_COLUMNS] if dictionary_encoded else []
+    final_fields = list(dict.fromkeys(grouping_keys + input_data["S"]))
+    order, limit = parse_order_by(input_data)
+    having, having_names = generate_interval_expr(parse_condition(input_data["G"])) if input_data["G"] else (None, set())
+    aggregates = [field for field in final_fields if field not in grouping_keys]
+    aggregates += sorted(having_names - set(aggregates))
+    estimates = []
+    for agg in aggregates:
+        kind = agg.split("_", 1)[0]
+        if kind in ("sum", "count"):
+            squares = "sumsq" + agg[3:] if kind == "sum" else agg
+            estimates += [f"{agg}_est = {agg}[g] * scale",
+                          f"{agg}_ci = z_spread * math.sqrt({squares}[g])"]
+        elif kind == "avg":
+            sums, counts, squares = agg.replace("avg", "sum", 1), agg.replace("avg", "count", 1), agg.replace("avg", "sumsq", 1)
+            estimates += [f"{agg}_est = {sums}[g] / {counts}[g] if {counts}[g] else 0",
+                          f"{agg}_ci = z_finite * math.sqrt(max(0.0, {squares}[g] - {agg}_est * {sums}[g])) / {counts}[g] if {counts}[g] else None"]
+        else:
+            estimates.append(f"{agg}_est = {agg}[g]")
+    for agg in sorted(having_names):
+        kind = agg.split("_", 1)[0]
+        if kind in ("sum", "count"):
+            interval = f"({agg}_est - {agg}_ci, {agg}_est + {agg}_ci)"
+        elif kind == "avg":
+            interval = f"({agg}_est - {agg}_ci, {agg}_est + {agg}_ci) if {agg}_ci is not None else UNBOUNDED"
+        elif kind == "max":
+            # The sample's max is a lower bound of the group's max
+            interval = f"({agg}_est, {agg}_est if exact else math.inf)"
+        else:
+            interval = f"({agg}_est if exact else -math.inf, {agg}_est)"
+        estimates.append(f"{agg}_iv = {interval}")
+    if having:
+        estimates += [f"having = {having}",
+                      "if having is False:",
+                      "    continue"]
+    projection = []
+    for field in final_fields:
+        if field in decoded:
+            projection.append(f"'{field}': {field}_dictionary[key[{grouping_keys.index(field)}]]")
+        elif field in grouping_keys:
+            projection.append(f"'{field}': key[{grouping_keys.index(field)}]")
+        else:
+            projection.append(f"'{field}': {field}_est")
+            if field.split("_", 1)[0] in ("sum", "count", "avg"):
+                projection.append(f"'{field}_ci': {field}_ci")
+    if having:
+        projection.append("'having': 'yes' if having else 'uncertain'")
+    intervals = [f"({field}_est, {field}_ci)" for field in final_fields
+                 if field not in grouping_keys and field.split("_", 1)[0] in ("sum", "count", "avg")]
+    errors = f"""
+        for estimate, half_width in ({", ".join(intervals)},):
+            if estimate and half_width is not None:
+                max_error = max(max_error, half_width / abs(estimate))""" if intervals else ""
+    if order is None:
+        ordering = f"""
+    output_rows = output_rows[:{limit}]""" if limit is not None else ""
+    elif limit is not None:
+        ordering = f"""
+    output_rows = heapq.nsmallest({limit}, output_rows, key=output_key)"""
+    else:
+        ordering = """
+    output_rows.sort(key=output_key)"""
+    bindings = "".join(f"\n    {agg} = mf.{agg}" for aggs in F_map.values() for agg in aggs)
+    bindings += "".join(f"\n    {key}_dictionary = mf.dictionaries[{key!r}]" for key in decoded)
+    body = "".join(f"\n        {line}" for line in estimates)
+    method = {"row": "BERNOULLI", "block": "SYSTEM"}[sample_method]
+    sample_query = plan["query"].replace(" FROM sales", f" FROM sales TABLESAMPLE {method} (%s) REPEATABLE (%s)", 1)
+    return f"""
+
+SAMPLE_QUERY = {sample_query!r}
+SAMPLE_PERCENT = {float(sample_percent)!r}
+CONFIDENCE = {confidence!r}
+# Standard normal quantile of the two-sided CONFIDENCE interval
+Z = statistics.NormalDist().inv_cdf(0.5 + CONFIDENCE / 2)
+TIME_BUDGET = {time_budget!r}
+ERROR_TARGET = {error_target!r}
+ONLINE = {time_budget is not None or error_target is not None}
+last_approximation = None
+{INTERVAL_HELPERS}{generate_output_key(input_data, "approximate")}
+
+def mf_estimates(mf, fraction):
+    \"""
+    Scales the aggregates of an MF structure computed over a sample holding each row with
+    probability fraction up to the whole table, with the half-width of their CONFIDENCE
+    interval, applies G to the intervals and projects S.
+    Returns the output rows and the largest relative half-width among them.
+    \"""
+    index = mf.index{bindings}
+    exact = fraction >= 1
+    scale = 1 / fraction
+    # Horvitz-Thompson standard error factors of a sum over a Bernoulli sample
+    z_finite = Z * math.sqrt(1 - fraction)
+    z_spread = z_finite / fraction
+    output_rows = []
+    max_error = 0.0
+    for key, g in index.items():{body}
+        output_rows.append({{
+            {", ".join(projection)}
+        }}){errors}
+    if not output_rows:
+        max_error = math.inf{ordering}
+    return output_rows, max_error
+
+
+def report_round(progress, output_rows=None):
+    \"""
+    Prints the progress of an approximate run to stderr, with the estimates of an
+    intermediate online aggregation round.
+    \"""
+    print(f"round {{progress['round']}}: {{progress['sample_percent']:g}}% sample ({{progress['sample_rows']:,}} rows), "
+          f"largest relative error ±{{progress['max_relative_error']:.2%}} after {{progress['seconds']:.2f}}s",
+          file=sys.stderr)
+    if output_rows is not None:
+        print(tabulate.tabulate(output_rows, headers="keys", tablefmt="psql"), file=sys.stderr)
+"""
+
+
+def generate_incremental(input_data, plan, state_path, watermark_column=None):
+    """
+    Generates the incremental maintenance of the MF structure.
+
+    The program persists the MF structure in `state_path` together with a watermark: the
+    highest value of `watermark_column` (default: the xmin of the rows) it has seen. On
+    the next run only the rows above the watermark are read and folded in by
+    mf_refresh():
+        * 0th scan aggregates and grouping variables whose sigma references no aggregate
+          are distributive, so the new rows update them directly
+        * a grouping variable whose sigma references aggregates (e.g. "2.quant > avg_quant")
+          is recomputed, over every row of the group, only for the groups where one of
+          those aggregates changed
+
+    The refresh assumes sales is append-only. The state also records the table's row
+    count: if it is not the old count plus the new rows (rows were updated or deleted),
+    the program recomputes everything instead.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        plan (dict): The SQL plan from plan_sales_query(local=True) (no pushed-down predicates).
+        state_path (str): File holding the persisted MF structure and watermark.
+        watermark_column (str): Monotonic column identifying new rows, instead of xmin.
+
+    Returns:
+        tuple:
+            - str: Module-level code defining mf_refresh() and refresh_or_compute()
+            - str: Statements inside run() that bind `mf`
+
+    Raises:
+        ValueError: If the watermark column is not an identifier.
+    """
+    if watermark_column is not None and not re.fullmatch(r"[A-Za-z_]\w*", watermark_column):
+        raise ValueError(f"Invalid watermark column: {watermark_column}")
+    _, F_map = generate_mf_class(input_data)
+    columns = plan["columns"]
+    grouping_keys = input_data["V"]
+    group_key = "(" + ", ".join(column_ref(key, columns) for key in grouping_keys) + ("," if len(grouping_keys) == 1 else "") + ")"
+    sigma_map = {cond.split(".", 1)[0]: cond for cond in input_data["sigma"]}
+    stages = plan_scan_stages(build_dependency_dag(input_data))
+    gv_fields = [agg for i in range(1, input_data["n"] + 1) for agg in F_map[str(i)]]
+    # Aggregates referenced by each grouping variable's sigma, by the scan computing them
+    references = {i: {aggregate_scan_index(agg) for agg in condition_aggregates(parse_condition(sigma_map[str(i)]))}
+                  for i in range(1, input_data["n"] + 1) if str(i) in sigma_map}
+    watermark = watermark_column or "xmin::text::bigint"
+    select = f"SELECT {', '.join(columns)}, {watermark} FROM sales"
+
+    # One pass over the new rows: the 0th scan and every aggregate-independent grouping variable
+    folded = [i for i in sorted(references) if not references[i] and F_map[str(i)]]
+    fold = ""
+    for i in folded:
+        fold += f"""
+        # Grouping variable {i}
+        if {transform_sigma(sigma_map[str(i)], columns)}:
+            {(chr(10) + "            ").join(generate_updates(F_map[str(i)], columns))}
+            changed_{i}.add(g)"""
+    new_group = generate_new_group(F_map["0"], columns) + [f"{agg}.append(0)" for agg in gv_fields]
+    def values(i):
+        return "(" + ", ".join(f"{agg}[g]" for agg in F_map[str(i)]) + ("," if len(F_map[str(i)]) == 1 else "") + ")"
+    recompute = ""
+    for stage in stages[1:]:
+        dependent = [i for i in stage if references.get(i) and F_map[str(i)]]
+        if not dependent:
+            continue
+        recompute += f"""
+    # Grouping variable{'s' if len(dependent) > 1 else ''} {', '.join(map(str, dependent))}: recomputed over all rows of the groups whose referenced aggregates changed"""
+        for i in dependent:
+            fields = F_map[str(i)]
+            recompute += f"""
+    dirty_{i} = {' | '.join(f'changed_{d}' for d in sorted(references[i]))}
+    before_{i} = {{g: {values(i)} for g in dirty_{i}}}
+    for g in dirty_{i}:
+        {(chr(10) + "        ").join(f"{agg}[g] = 0" for agg in fields)}"""
+        recompute += f"""
+    for row in fetch_group_rows([keys[g] for g in {' | '.join(f'dirty_{i}' for i in dependent)}]):
+        g = index[{group_key}]"""
+        for i in dependent:
+            recompute += f"""
+        # Grouping variable {i}
+        if g in dirty_{i} and {transform_sigma(sigma_map[str(i)], columns)}:
+            {(chr(10) + "            ").join(generate_updates(F_map[str(i)], columns))}"""
+        for i in dependent:
+            recompute += f"""
+    changed_{i} = {{g for g in dirty_{i} if {values(i)} != before_{i}[g]}}"""
+        recompute += f"""
+    # In the other groups the referenced aggregates are unchanged, so the new rows are folded in
+    for row in new_rows:
+        g = index[{group_key}]"""
+        for i in dependent:
+            recompute += f"""
+        # Grouping variable {i}
+        if g not in dirty_{i} and {transform_sigma(sigma_map[str(i)], columns)}:
+            {(chr(10) + "            ").join(generate_updates(F_map[str(i)], columns))}
+            changed_{i}.add(g)"""
+        recompute += "\n"
+
+    bindings = "".join(f"\n    {agg} = mf.{agg}" for agg in F_map["0"] + gv_fields)
+    changed = "\n    ".join(f"changed_{i} = set()" for i in range(0, input_data["n"] + 1))
+    helpers = f"""
+
+STATE_PATH = {state_path!r}
+# Identifies the query, so a state file written for another query is never reused
+PLAN_ID = {plan_key(input_data, {"watermark": watermark})!r}
+# Every row carries its watermark value as an extra last column
+FULL_QUERY = {select!r}
+NEW_ROWS_QUERY = {select + f" WHERE {watermark} > %s"!r}
+# One array parameter per grouping attribute, so the groups are matched with a semi-join
+GROUP_ROWS_QUERY = {select + f" WHERE ({', '.join(grouping_keys)}) IN (SELECT * FROM unnest({', '.join(['%s'] * len(grouping_keys))}))"!r}
+COUNT_QUERY = 'SELECT count(*) FROM sales'
+
+
+def mf_refresh(mf, new_rows, fetch_group_rows):
+    \"""
+    Folds rows appended to sales into the MF structure. fetch_group_rows(keys) returns
+    every row of the given groups.
+    \"""
+    index = mf.index
+    keys = mf.keys{bindings}
+    # Groups whose aggregates of each scan changed (for the 0th scan: groups with new rows)
+    {changed}
+    for row in new_rows:
+        key = {group_key}
+        g = index.get(key)
+        if g is None:
+            g = len(keys)
+            index[key] = g
+            keys.append(key)
+            {(chr(10) + "            ").join(new_group or ["pass"])}
+        else:
+            {(chr(10) + "            ").join(generate_updates(F_map["0"], columns) or ["pass"])}
+        changed_0.add(g){fold}
+{recompute}
+
+def save_state(mf, watermark, n_rows):
+    \"""
+    Persists the MF structure with its watermark; written to a temporary file and renamed.
+    \"""
+    state = {{"plan": PLAN_ID, "watermark": watermark, "rows": n_rows, "keys": mf.keys,
+             "columns": {{name: getattr(mf, name) for name in MFStructure.__slots__[2:]}}}}
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(STATE_PATH)), delete=False) as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f.name, STATE_PATH)
+
+
+def load_state():
+    \"""
+    Loads the persisted state of this query, or returns None.
+    \"""
+    try:
+        with open(STATE_PATH, "rb") as f:
+            state = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    if state.get("plan") != PLAN_ID:
+        return None
+    mf = MFStructure()
+    mf.keys.extend(state["keys"])
+    mf.index.update((key, g) for g, key in enumerate(mf.keys))
+    for name, column in state["columns"].items():
+        setattr(mf, name, column)
+    state["mf"] = mf
+    return state
+
+
+def refresh_or_compute(cur):
+    \"""
+    Refreshes the persisted MF structure with the rows above its watermark, or computes
+    it from scratch when there is no usable state; persists the result.
+    \"""
+    state = load_state()
+    cur.execute(COUNT_QUERY)
+    n_rows = cur.fetchone()[0]
+    if state is not None:
+        if state["watermark"] is None:
+            cur.execute(FULL_QUERY)
+        else:
+            cur.execute(NEW_ROWS_QUERY, (state["watermark"],))
+        new_rows = cur.fetchall()
+        # Otherwise rows were updated or deleted since the state was saved
+        if state["rows"] + len(new_rows) == n_rows:
+            def fetch_group_rows(group_keys):
+                if not group_keys:
+                    return []
+                cur.execute(GROUP_ROWS_QUERY, [list(values) for values in zip(*group_keys)])
+                return cur.fetchall()
+            mf = state["mf"]
+            mf_refresh(mf, new_rows, fetch_group_rows)
+            save_state(mf, max((row[-1] for row in new_rows), default=state["watermark"]), n_rows)
+            return mf
+    cur.execute(FULL_QUERY)
+    sales_rows = cur.fetchall()
+    mf = mf_scans(sales_rows)
+    save_state(mf, max((row[-1] for row in sales_rows), default=None), len(sales_rows))
+    return mf
+"""
+    body = """# The row count, new rows and group rows must all come from one snapshot of the table
+    conn.set_session(isolation_level=psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    mf = refresh_or_compute(conn.cursor())"""
+    return helpers, body
+
+
+def parse_order_by(input_data):
+    """
+    Parses the optional ORDER BY ("O") and LIMIT ("L") fields of a query specification.
+
+    "O" is a list of "field [ASC|DESC]" items over the grouping attributes and the
+    aggregates of F, e.g. ["sum_1_quant DESC", "cust"]. Without "O" the output is in
+    grouping key order (ORDER BY V); an empty list leaves the groups unsorted. "L" is
+    the maximum number of output rows.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+
+    Returns:
+        tuple:
+            - list: (field, descending) pairs, or None if the output is not sorted
+            - int: The limit, or None
+
+    Raises:
+        ValueError: If an item is malformed, orders by an unknown field or a top_ sketch, or the
+            limit is negative.
+    """
+    items = input_data.get("O")
+    if items is None:
+        order = [(key, False) for key in input_data["V"]]
+    elif not items:
+        order = None
+    else:
+        order = []
+        for item in items:
+            parts = item.split()
+            if len(parts) not in (1, 2) or (len(parts) == 2 and parts[1].upper() not in ("ASC", "DESC")):
+                raise ValueError(f"Invalid ORDER BY item: {item!r}")
+            if parts[0] not in input_data["V"] and parts[0] not in input_data["F"]:
+                raise ValueError(f"ORDER BY field is neither a grouping attribute nor an aggregate of F: {parts[0]}")
+            if parts[0].startswith("top_"):
+                raise ValueError(f"ORDER BY a most frequent value (top_) aggregate is not supported: {parts[0]}")
+            order.append((parts[0], len(parts) == 2 and parts[1].upper() == "DESC"))
+    limit = input_data.get("L")
+    if limit is not None:
+        limit = int(limit)
+        if limit < 0:
+            raise ValueError(f"LIMIT must not be negative: {limit}")
+    return order, limit
+
+
+# Sort key wrapper of the generated output for descending values that cannot be negated
+DESCENDING_HELPER = """
+
+class Descending:
+    \"""
+    Sort key wrapper that reverses the order of its value (e.g. a string sorted DESC).
+    \"""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+"""
+
+
+def generate_output(input_data, F_map, function_name="mf_output", dictionary_encoded=False):
+    """
+    Generates the function that applies G to an MF structure and projects S, in grouping
+    key order or in the order of the spec's "O" and "L" fields (see parse_order_by()).
+
+    Only the groups that pass G are ordered. With a limit, the first L groups come from
+    a bounded heap (heapq.nsmallest) instead of a sort of every group, so only those
+    groups are projected; without an order the groups are not sorted at all. Ties are
+    broken by the grouping key, so the output is deterministic. Descending values are
+    negated in the sort key, or wrapped in Descending (see DESCENDING_HELPER) when
+    they are strings or dates.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+        F_map (dict): Aggregates per scan, from generate_mf_class().
+        function_name (str): Name of the generated function.
+        dictionary_encoded (bool): The grouping keys hold codes of DICTIONARY_COLUMNS,
+            decoded through mf.dictionaries for the output.
+
+    Returns:
+        str: The function definition.
+
+    Raises:
+        ValueError: If the ORDER BY or LIMIT fields are invalid.
+    """
+    grouping_keys = input_data["V"]
+    decoded = [key for key in grouping_keys if key in DICTIONARY_COLUMNS] if dictionary_encoded else []
+    G_condition = transform_condition(input_data["G"]) if input_data["G"] else True
+    final_fields = list(dict.fromkeys(grouping_keys + input_data['S']))
+    order, limit = parse_order_by(input_data)
+    # Bind the MF structure's columns to locals so the loop indexes them without attribute lookups
+    base_bindings = "".join(f"\n    {agg} = mf.{agg}" for agg in F_map["0"])
+    gv_bindings = "".join(f"\n    {agg} = mf.{agg}" for i in range(1, input_data["n"] + 1) for agg in F_map[str(i)])
+    dictionary_bindings = "".join(f"\n    {key}_dictionary = mf.dictionaries[{key!r}]" for key in decoded)
+    projection = ', '.join([
+        f"'{field}': {field}_dictionary[key[{grouping_keys.index(field)}]]" if field in decoded else
+        f"'{field}': key[{grouping_keys.index(field)}]" if field in grouping_keys else
+        f"'{field}': {sketch_value(field)}" if re.fullmatch(SKETCH_PATTERN, field) else
+        f"'{field}': ({field.replace('avg','sum')}[g] / {field.replace('avg','count')}[g]) if {field.replace('avg','count')}[g] != 0 else 0"
+        if 'avg' in field.lower() else f"'{field}': {field}[g]"
+        for field in final_fields
+    ])
+    if order == [(key, False) for key in grouping_keys] and limit is None:
+        return f"""
+
+def {function_name}(mf):
+    \"""
+    Applies G to the groups of the MF structure and projects S, in grouping key order.
+    \"""
+    index = mf.index{base_bindings}{gv_bindings}{dictionary_bindings}
+    _global = []
+    # Build the sorted view of the groups once, only for the final output{" (codes sort like their values)" if decoded else ""}
+    for key, g in sorted(index.items()):
+        if {G_condition}:
+            _global.append({{
+            {projection}
+    }})
+    return _global
+"""
+
+    def sort_value(field, descending):
+        if field in grouping_keys:
+            value = f"key[{grouping_keys.index(field)}]"
+            if descending and field not in INTEGER_COLUMNS and field not in decoded:
+                return f"Descending({value})"
+        elif re.fullmatch(SKETCH_PATTERN, field):
+            value = sketch_value(field)
+        elif field.startswith("avg"):
+            value = f"({field.replace('avg', 'sum')}[g] / {field.replace('avg', 'count')}[g] if {field.replace('avg', 'count')}[g] != 0 else 0)"
+        else:
+            value = f"{field}[g]"
+        return f"-{value}" if descending else value
+
+    groups = f"((key, g) for key, g in index.items() if {G_condition})"
+    order_key = ""
+    if order is None:
+        description = "in the order the groups were found (no ORDER BY)"
+        selection = f"itertools.islice({groups}, {limit})" if limit is not None else groups
+    else:
+        if order == [(key, False) for key in grouping_keys]:
+            key_argument = ""
+        else:
+            # The grouping key last, as the tie-breaker
+            order_key = f"""
+    def order_key(group):
+        key, g = group
+        return ({", ".join(sort_value(field, descending) for field, descending in order)}, key)
+"""
+            key_argument = ", key=order_key"
+        by = ", ".join(field + (" DESC" if descending else "") for field, descending in order)
+        if limit is not None:
+            description = f"the first {limit} by {by}, from a bounded heap instead of a sort of every group"
+            selection = f"heapq.nsmallest({limit}, {groups}{key_argument})"
+        else:
+            description = f"sorted by {by}"
+            selection = f"sorted({groups}{key_argument})"
+    return f"""
+
+def {function_name}(mf):
+    \"""
+    Applies G to the groups of the MF structure and projects S, {"in ORDER BY order" if order else "unsorted"}{f", at most {limit} rows" if limit is not None else ""}.
+    \"""
+    index = mf.index{base_bindings}{gv_bindings}{dictionary_bindings}{order_key}
+    _global = []
+    # The groups passing G, {description}
+    for key, g in {selection}:
+        _global.append({{
+            {projection}
+    }})
+    return _global
+"""
+
+
+def generate_dictionary_encoding(columns, group_positions, row_width, key_width):
+    """
+    Generates the dictionary encoding of the generated program (see the
+    dictionary_encoding option of generate_code()).
+
+    Once the rows are loaded, every value of a low-cardinality string column is replaced
+    by a small integer code: its position in the column's sorted dictionary of distinct
+    values. Rows then share small ints instead of holding one string object each, the
+    grouping keys hash and compare as tuples of ints, and, since codes order like the
+    values, sorting the groups by their codes sorts them by their values. The output
+    decodes the grouping keys through the dictionaries. The rows are re-built by one
+    comprehension specialized to the row layout.
+
+    Parameters:
+        columns (dict): Encoded column -> its position in the row tuples.
+        group_positions (dict): Encoded column -> its position in the grouping key
+            tuples of GROUPS_QUERY (empty without one).
+        row_width (int): Number of columns of the row tuples.
+        key_width (int): Number of grouping attributes (V).
+
+    Returns:
+        str: Module-level helper code for the generated program.
+    """
+    def encoded_tuple(positions, width, name):
+        by_position = {position: column for column, position in positions.items()}
+        values = [f"{by_position[k]}_codes[{name}[{k}]]" if k in by_position else f"{name}[{k}]" for k in range(width)]
+        return "(" + ", ".join(values) + ("," if width == 1 else "") + ")"
+
+    group_encoding = f"""
+    if group_rows is not None:
+        group_rows = [{encoded_tuple(group_positions, key_width, "key")} for key in group_rows]""" if group_positions else ""
+    code_maps = "".join(f"\n    {name}_codes = {{value: code for code, value in enumerate(dictionaries[{name!r}])}}"
+                        for name in columns)
+    return f"""
+# Dictionary-encoded columns -> their position in the row tuples (and in the group keys)
+ENCODED_COLUMNS = {columns!r}
+ENCODED_GROUP_COLUMNS = {group_positions!r}
+
+
+def encode_rows(rows, group_rows=None):
+    \"""
+    Replaces the values of ENCODED_COLUMNS (and ENCODED_GROUP_COLUMNS of group_rows) by
+    their code in the column's sorted dictionary. Returns the encoded rows, the encoded
+    group rows and column -> dictionary.
+    \"""
+    dictionaries = {{}}
+    for name, position in ENCODED_COLUMNS.items():
+        values = set(map(operator.itemgetter(position), rows))
+        if group_rows and name in ENCODED_GROUP_COLUMNS:
+            values.update(map(operator.itemgetter(ENCODED_GROUP_COLUMNS[name]), group_rows))
+        dictionaries[name] = sorted(values){code_maps}
+    rows = [{encoded_tuple(columns, row_width, "row")} for row in rows]{group_encoding}
+    return rows, group_rows, dictionaries
+
+
+def code_of(dictionary, value):
+    \"""
+    Returns the code of value in a sorted dictionary, or -1 (no row's code) if it does not occur.
+    \"""
+    code = bisect.bisect_left(dictionary, value)
+    return code if code < len(dictionary) and dictionary[code] == value else -1
+"""
+
+
+def generate_bitmap_expr(node, codes=None):
+    """
+    Translates a row-only sigma conjunct into an expression over the bitmap index.
+
+    Equality and IN against constants become bitmaps.get(column, value) (an IN list is
+    the OR of its values' bitmaps), and/or become & and |.
+
+    Parameters:
+        node (ast.expr): A conjunct of a parsed sigma condition.
+        codes (dict): With dictionary-encoded rows, the index is keyed by codes and the
+            constants of those columns become code variables (see encoded_constant()).
+
+    Returns:
+        tuple: The expression and the set of columns it reads, or None if the conjunct
+            cannot be answered from the index.
+    """
+    def column(node):
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+                and node.value.id == "row" and node.attr in SALES_COLUMNS:
+            return node.attr
+        return None
+
+    def value(name, constant):
+        if codes is not None and name in DICTIONARY_COLUMNS and isinstance(constant, str):
+            return encoded_constant(codes, "code_of", name, constant)
+        return repr(constant)
+
+    if isinstance(node, ast.BoolOp):
+        parts = [generate_bitmap_expr(value, codes) for value in node.values]
+        if None in parts:
+            return None
+        op = " & " if isinstance(node.op, ast.And) else " | "
+        return "(" + op.join(expr for expr, _ in parts) + ")", set().union(*(columns for _, columns in parts))
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+        op, left, right = node.ops[0], node.left, node.comparators[0]
+        if isinstance(op, ast.Eq) and column(left) is None:
+            left, right = right, left
+        name = column(left)
+        if name is None:
+            return None
+        if isinstance(op, ast.Eq) and isinstance(right, ast.Constant):
+            return f"bitmaps.get({name!r}, {value(name, right.value)})", {name}
+        if isinstance(op, ast.In) and isinstance(right, (ast.Tuple, ast.List)) and right.elts \
+                and all(isinstance(element, ast.Constant) for element in right.elts):
+            values = [f"bitmaps.get({name!r}, {value(name, element.value)})" for element in right.elts]
+            return (values[0] if len(values) == 1 else "(" + " | ".join(values) + ")"), {name}
+    return None
+
+
+def generate_bitmap_index(columns, persisted=False, dictionary_encoded=False):
+    """
+    Generates the bitmap index of the generated program (see the bitmap_index option of
+    generate_code()).
+
+    For every distinct value of an indexed column, the ids of the rows holding it are the
+    set bits of one Python int, so combining predicates with and/or is a single big
+    integer & or |. The index is built once over the loaded rows without a Python-level
+    loop per row: every row becomes one character (the code of its value) and
+    str.translate() turns that string into the bit string of each value. Columns with
+    more than MAX_BITMAP_VALUES distinct values are not indexed, and the passes over
+    them scan every row.
+
+    Parameters:
+        columns (dict): Indexed column -> its position in the row tuples.
+        persisted (bool): The rows come from a local snapshot; the index is then saved next
+            to the snapshot file and reused as long as the snapshot version is unchanged.
+        dictionary_encoded (bool): The rows are dictionary-encoded, so a persisted index
+            (keyed by the values) is re-keyed by their codes after loading.
+
+    Returns:
+        str: Module-level helper code for the generated program.
+    """
+    encoded_method = """
+    def encoded(self, dictionaries):
+        \"""
+        Returns the index keyed by the codes of the values of dictionary-encoded columns.
+        \"""
+        return BitmapIndex({name: {code_of(dictionaries[name], value): bits for value, bits in values.items()}
+                            if name in dictionaries else values for name, values in self.bitmaps.items()})
+""" if persisted and dictionary_encoded else ""
+    helpers = f"""
+# Columns of the bitmap index -> their position in the row tuples
+BITMAP_COLUMNS = {columns!r}
+MAX_BITMAP_VALUES = 1024
+# Maps the characters of a bit string to the bytes of an itertools.compress() selector
+BIT_SELECTORS = bytes.maketrans(b"01", b"\\x00\\x01")
+
+
+class BitmapIndex:
+    \"""
+    Bitmap index of low-cardinality columns: column -> value -> bitmap of the row ids
+    holding that value.
+    \"""
+    def __init__(self, bitmaps):
+        self.bitmaps = bitmaps
+
+    @classmethod
+    def build(cls, columns):
+        \"""
+        Builds the index from column -> list of its values, in row order.
+        \"""
+        bitmaps = {{}}
+        for name, values in columns.items():
+            codes = {{value: chr(code) for code, value in enumerate(dict.fromkeys(values))}}
+            if len(codes) > MAX_BITMAP_VALUES:
+                continue
+            # Row id i is character i from the right, i.e. bit i of the parsed bit string
+            encoded = "".join(map(codes.__getitem__, values))[::-1]
+            zeros = dict.fromkeys(map(ord, codes.values()), "0")
+            bitmaps[name] = {{value: int(encoded.translate({{**zeros, ord(code): "1"}}) or "0", 2)
+                             for value, code in codes.items()}}
+        return cls(bitmaps)
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls.build({{name: [row[position] for row in rows] for name, position in BITMAP_COLUMNS.items()}})
+
+    def covers(self, *names):
+        \"""
+        Returns whether every given column is indexed.
+        \"""
+        return all(name in self.bitmaps for name in names)
+
+    def get(self, name, value):
+        return self.bitmaps[name].get(value, 0)
+{encoded_method}
+
+def bitmap_rows(rows, bits):
+    \"""
+    Returns an iterator over the rows whose id is set in bits.
+    \"""
+    return itertools.compress(rows, format(bits, "b")[::-1].encode().translate(BIT_SELECTORS))
+"""
+    if persisted:
+        helpers += """
+
+def load_bitmaps(snapshot):
+    \"""
+    Loads the bitmap index saved next to the snapshot, building the columns it lacks (and
+    saving the result) when the snapshot changed or another query indexed other columns.
+    \"""
+    path = snapshot.path + ".bitmaps"
+    saved = {"version": snapshot.version, "columns": [], "bitmaps": {}}
+    try:
+        with open(path, "rb") as f:
+            loaded = pickle.load(f)
+        if loaded["version"] == snapshot.version:
+            saved = loaded
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError):
+        pass
+    missing = [name for name in BITMAP_COLUMNS if name not in saved["columns"]]
+    if missing:
+        saved["bitmaps"].update(BitmapIndex.build({name: list(snapshot.column(name)) for name in missing}).bitmaps)
+        # Columns over MAX_BITMAP_VALUES are recorded too, so they are not rebuilt every run
+        saved["columns"] += missing
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+            pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+    return BitmapIndex({name: saved["bitmaps"][name] for name in BITMAP_COLUMNS if name in saved["bitmaps"]})
+"""
+    return helpers
+
+
+# Columns with zone maps: ordered columns that sigma typically restricts by ranges
+ZONE_COLUMNS = ["day", "month", "year", "quant", "date"]
+ZONE_BLOCK_SIZE = 4096
+
+
+def generate_zone_expr(node):
+    """
+    Translates a row-only sigma conjunct into a test on the zone map of a block of rows.
+
+    The test is an expression over `z`, the block's column -> (min, max) ranges. It is
+    False only when no row of the block can satisfy the conjunct: comparisons of a zone
+    column to a constant test the range, and/or combine, and anything else is assumed
+    to match (an 'and' keeps its translatable parts).
+
+    Parameters:
+        node (ast.expr): A conjunct of a parsed sigma condition.
+
+    Returns:
+        tuple: The expression and the set of columns it reads, or None if the conjunct
+            never rules out a block.
+    """
+    if isinstance(node, ast.BoolOp):
+        parts = [generate_zone_expr(value) for value in node.values]
+        if isinstance(node.op, ast.And):
+            parts = [part for part in parts if part is not None]
+            if not parts:
+                return None
+        elif None in parts:
+            return None
+        op = " and " if isinstance(node.op, ast.And) else " or "
+        return "(" + op.join(expr for expr, _ in parts) + ")", set().union(*(columns for _, columns in parts))
+    if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+        return None
+    op, left, right = node.ops[0], node.left, node.comparators[0]
+    flipped = {ast.Eq: ast.Eq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+    if not condition_columns(left) and condition_columns(right) and type(op) in flipped:
+        op, left, right = flipped[type(op)](), right, left
+    if not (isinstance(left, ast.Attribute) and isinstance(left.value, ast.Name) and left.value.id == "row"
+            and left.attr in ZONE_COLUMNS):
+        return None
+    name = left.attr
+
+    def constant(node):
+        # The constant must compare with the column's values, or the range test would raise
+        if not isinstance(node, ast.Constant):
+            return None
+        if name == "date":
+            return repr(node.value) if isinstance(node.value, datetime.date) else None
+        if isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+            return repr(node.value)
+        return None
+
+    low, high = f"z[{name!r}][0]", f"z[{name!r}][1]"
+    if isinstance(op, ast.In) and isinstance(right, (ast.Tuple, ast.List)) and right.elts:
+        values = [constant(element) for element in right.elts]
+        if None in values:
+            return None
+        test = " or ".join(f"{low} <= {value} <= {high}" for value in values)
+    else:
+        value = constant(right)
+        tests = {ast.Eq: f"{low} <= {value} <= {high}", ast.Lt: f"{low} < {value}", ast.LtE: f"{low} <= {value}",
+                 ast.Gt: f"{high} > {value}", ast.GtE: f"{high} >= {value}"}
+        if value is None or type(op) not in tests:
+            return None
+        test = tests[type(op)]
+    # Blocks without a range for the column (e.g. NULLs) are never skipped
+    return f"({name!r} not in z or {test})", {name}
+
+
+def generate_zone_maps(columns, block_size):
+    """
+    Generates the zone maps of the generated program (see the zone_maps option of
+    generate_code()): per block of BLOCK_SIZE consecutive rows, the minimum and maximum
+    of every column in ZONE_COLUMNS. The rows are loaded in date order, so the blocks
+    cover narrow date ranges and passes with time predicates skip most of them.
+
+    Parameters:
+        columns (dict): Column with a zone map -> its position in the row tuples.
+        block_size (int): Rows per block.
+
+    Returns:
+        str: Module-level helper code for the generated program.
+    """
+    return f"""
+# Columns with zone maps -> their position in the row tuples
+ZONE_COLUMNS = {columns!r}
+BLOCK_SIZE = {block_size}
+
+
+class ZoneMap:
+    \"""
+    Fixed-size blocks of the rows with the (min, max) range of every ZONE_COLUMNS column.
+    \"""
+    def __init__(self, rows):
+        self.rows = rows
+        self.blocks = []   # (start, end, column -> (min, max))
+        for start in range(0, len(rows), BLOCK_SIZE):
+            block = rows[start:start + BLOCK_SIZE]
+            values = list(zip(*block))
+            ranges = {{}}
+            for name, position in ZONE_COLUMNS.items():
+                try:
+                    ranges[name] = (min(values[position]), max(values[position]))
+                except TypeError:
+                    # NULLs do not compare; the block is never skipped on this column
+                    pass
+            self.blocks.append((start, start + len(block), ranges))
+
+    def rows_where(self, may_match):
+        \"""
+        Returns an iterator over the rows of the blocks whose ranges may_match() accepts.
+        \"""
+        return itertools.chain.from_iterable(self.rows[start:end] for start, end, ranges in self.blocks
+                                             if may_match(ranges))
+
+    def bitmap(self, may_match):
+        \"""
+        Returns the bitmap (see BitmapIndex) of the rows of the blocks whose ranges may_match() accepts.
+        \"""
+        bits = 0
+        for start, end, ranges in self.blocks:
+            if may_match(ranges):
+                bits |= ((1 << (end - start)) - 1) << start
+        return bits
+"""
+
+
+def generate_fused_scan(gv_blocks, group_key, profile=False, indent="    ", rows="sales_rows"):
+    """
+    Generates one pass over sales_rows that feeds several grouping variables.
+
+    The conjuncts of every sigma that only read the row are tested before the row's
+    group is looked up. When every grouping variable has such a conjunct, the rows none
+    of them accepts skip the lookup entirely; a grouping variable whose sigma only reads
+    aggregates needs the lookup for every row.
+
+    Parameters:
+        gv_blocks (list): (grouping variable, conjuncts from sigma_conjuncts(), update
+            statements) triples.
+        group_key (str): Expression of the row's grouping key tuple.
+        profile (bool): Count the rows (rows_scanned), the group lookups (lookups) and the
+            rows passing the k-th conjunct of grouping variable i (sigma_<i>_<k>), with one
+            nested if per conjunct.
+        indent (str): Indentation of the for statement.
+        rows (str): The iterable of rows the pass visits.
+
+    Returns:
+        str: The for loop.
+    """
+    def guarded(i, conjuncts, body, depth, offset=0):
+        # Wraps body in the checks of conjuncts (numbered from offset in the counters)
+        if not conjuncts:
+            return [depth + line for line in body]
+        if not profile:
+            return [f"{depth}if {' and '.join(expr for _, expr, _ in conjuncts)}:"] + [depth + "    " + line for line in body]
+        lines = []
+        for k, (_, expr, _) in enumerate(conjuncts, start=offset):
+            lines += [f"{depth}if {expr}:", f"{depth}    sigma_{i}_{k} += 1"]
+            depth += "    "
+        return lines + [depth + line for line in body]
+
+    lookup = (["lookups += 1"] if profile else []) + [f"g = index[{group_key}]  # O(1) lookup of the row's group id"]
+    split = [(i, [c for c in conjuncts if not c[2]], [c for c in conjuncts if c[2]], updates)
+             for i, conjuncts, updates in gv_blocks]
+    body = indent + "    "
+    lines = [f"{indent}for row in {rows}:"] + ([body + "rows_scanned += 1"] if profile else [])
+    if len(split) == 1 and split[0][1]:
+        i, row_only, dependent, updates = split[0]
+        lines += guarded(i, row_only, lookup + guarded(i, dependent, updates, "", len(row_only)), body)
+    elif all(row_only for _, row_only, _, _ in split):
+        # Row-only conjuncts first: the group is only looked up if some grouping variable accepts the row
+        for i, row_only, _, _ in split:
+            if profile:
+                lines += [f"{body}accept_{i} = False"] + guarded(i, row_only, [f"accept_{i} = True"], body)
+            else:
+                lines.append(f"{body}accept_{i} = {' and '.join(expr for _, expr, _ in row_only)}")
+        lines.append(f"{body}if {' or '.join(f'accept_{i}' for i, _, _, _ in split)}:")
+        lines += [body + "    " + line for line in lookup]
+        for i, row_only, dependent, updates in split:
+            lines.append(f"{body}    # Grouping variable {i}")
+            if dependent and not profile:
+                lines.append(f"{body}    if accept_{i} and {' and '.join(expr for _, expr, _ in dependent)}:")
+                lines += [body + "        " + line for line in updates]
+            else:
+                lines.append(f"{body}    if accept_{i}:")
+                lines += guarded(i, dependent, updates, body + "        ", len(row_only))
+    else:
+        lines += [body + line for line in lookup]
+        for i, row_only, dependent, updates in split:
+            lines.append(f"{body}# Grouping variable {i}")
+            lines += guarded(i, row_only + dependent, updates, body)
+    return "\n".join(lines) + "\n"
+
+
+def generate_profile_helpers(profile_path=None):
+    """
+    Generates the helpers of an instrumented program (see the profile option of
+    generate_code()): profile_pass() summarizes one pass over the rows and
+    report_profile() writes the profile of a run.
+
+    Parameters:
+        profile_path (str): Write the profile as JSON to this file instead of printing
+            it as a plan tree to stderr.
+
+    Returns:
+        str: Module-level helper code for the generated program.
+    """
+    return f"""
+PROFILE_PATH = {profile_path!r}
+# Profile of the last run(), see report_profile()
+last_profile = None
+
+
+def profile_pass(number, grouping_variables, started, rows, lookups, sigma=None):
+    \"""
+    Summarizes one pass over the rows. sigma maps a grouping variable to the number of rows
+    that passed each of its conjuncts, in evaluation order; the selectivity of a conjunct is
+    relative to the rows that passed the conjuncts before it.
+    \"""
+    scan = {{"pass": number, "grouping_variables": grouping_variables,
+            "seconds": time.perf_counter() - started, "rows": rows, "lookups": lookups}}
+    if sigma:
+        scan["sigma"] = {{}}
+        for gv, conjuncts in sigma.items():
+            previous = rows
+            scan["sigma"][gv] = []
+            for condition, passed in conjuncts:
+                scan["sigma"][gv].append({{"condition": condition, "rows": passed,
+                                          "selectivity": passed / previous if previous else None}})
+                previous = passed
+    return scan
+
+
+def report_profile(profile):
+    \"""
+    Writes a run's profile as JSON to PROFILE_PATH, or as a plan tree to stderr.
+    \"""
+    profile["total_seconds"] = sum(profile.get(step, 0) for step in
+                                   ("fetch_seconds", "compute_seconds", "output_seconds", "tabulate_seconds"))
+    if PROFILE_PATH:
+        with open(PROFILE_PATH, "w") as f:
+            json.dump(profile, f, indent=2)
+        return
+    lines = [f"MF query  {{profile['total_seconds']:.4f}}s",
+             f"├─ fetch  {{profile['fetch_seconds']:.4f}}s"
+             + ("  (streamed: rows are also fetched during the passes)" if profile["streamed"] else ""),
+             f"├─ compute  {{profile['compute_seconds']:.4f}}s  {{profile['groups']}} groups"]
+    for n, scan in enumerate(profile["passes"]):
+        branch, stem = ("└─", "   ") if n == len(profile["passes"]) - 1 else ("├─", "│  ")
+        lines.append(f"│  {{branch}} pass {{scan['pass']}} (grouping variable{{'s' if len(scan['grouping_variables']) > 1 else ''}} {{', '.join(map(str, scan['grouping_variables']))}})"
+                     f"  {{scan['seconds']:.4f}}s  {{scan['rows']}} rows  {{scan['lookups']}} lookups")
+        for gv, conjuncts in scan.get("sigma", {{}}).items():
+            for k, conjunct in enumerate(conjuncts):
+                selectivity = "n/a" if conjunct["selectivity"] is None else f"{{conjunct['selectivity']:.1%}}"
+                lines.append(f"│  {{stem}}   {{'sigma ' + gv + ':' if k == 0 else 'and':>9}} {{conjunct['condition']}}"
+                             f"  {{conjunct['rows']}} rows ({{selectivity}})")
+    rate = "n/a" if profile["having_pass_rate"] is None else f"{{profile['having_pass_rate']:.1%}}"
+    lines.append(f"{{'├─' if 'tabulate_seconds' in profile else '└─'}} having/output  {{profile['output_seconds']:.4f}}s"
+                 f"  {{profile['groups']}} groups -> {{profile['output_rows']}} rows ({{rate}})")
+    if "tabulate_seconds" in profile:
+        lines.append(f"└─ tabulate  {{profile['tabulate_seconds']:.4f}}s")
+    print("\\n".join(lines), file=sys.stderr)
+"""
+
+
+def generate_batch_code(specs, stream=None, batch_size=10000, pushdown=True, snapshot=None, version_column=None):
+    """
+    Generates one program that runs a batch of MF queries over shared scans of sales.
+
+    The table is fetched once, with the union of the columns the queries reference.
+    Physical pass k (0 for the 0th scans) then feeds every query that has a k-th scan
+    stage (see plan_scan_stages()), so the batch costs one pass per dependency level
+    of its deepest query instead of one fetch and a set of passes per query. Every
+    query keeps its own MF structure (class MFStructure_<q>), and its generated locals
+    are prefixed with q<q>_ so the queries can share a loop.
+
+    Parameters:
+        specs (list): The query specifications, each with the fields of input.json.
+        stream (str): Ingestion mode, see generate_ingest().
+        batch_size (int): Rows per round trip in the streaming modes.
+        pushdown (bool): Only select the referenced columns (predicates are not pushed
+            down, the queries need different rows).
+        snapshot (str): Read the rows from a local snapshot, see generate_snapshot_ingest().
+        version_column (str): Version column of the snapshot probe.
+
+    Returns:
+        str: The Python source of the generated program; run(conn) returns one list of
+            output rows per query, in the order of specs.
+
+    Raises:
+        ValueError: If the batch is empty.
+    """
+    if not specs:
+        raise ValueError("A query batch needs at least one query specification")
+    referenced = set()
+    for spec in specs:
+        referenced |= set(plan_sales_query(spec, pushdown, local=True)["columns"])
+    columns = [name for name in SALES_COLUMNS if name in referenced]
+    plan = {"columns": columns, "query": f"SELECT {', '.join(columns)} FROM sales", "groups_query": None}
+    if snapshot:
+        ingest_helpers, ingest = generate_snapshot_ingest(plan, snapshot, version_column, batch_size)
+    else:
+        ingest_helpers, ingest = generate_ingest(plan, stream, batch_size)
+
+    classes, outputs, setup, allocate = "", "", "", ""
+    levels = []   # pass number -> code of every query's part of that pass
+    for q, spec in enumerate(specs, start=1):
+        class_code, F_map = generate_mf_class(spec, f"MFStructure_{q}")
+        classes += class_code
+        outputs += generate_output(spec, F_map, f"mf_output_{q}")
+        fields = [agg for aggs in F_map.values() for agg in aggs]
+        def qualify(code):
+            # Prefix the query's aggregate columns, so they do not clash with other queries'
+            return re.sub(r"\b(" + "|".join(fields) + r")\b", rf"q{q}_\1", code) if fields else code
+        group_key = "(" + ", ".join(column_ref(key, columns) for key in spec["V"]) + ("," if len(spec["V"]) == 1 else "") + ")"
+        sigma_map = {cond.split(".", 1)[0]: cond for cond in spec["sigma"]}
+        stages = plan_scan_stages(build_dependency_dag(spec))
+        while len(levels) < len(stages):
+            levels.append([])
+
+        setup += f"""
+    mf_{q} = MFStructure_{q}()
+    q{q}_index = mf_{q}.index
+    q{q}_keys = mf_{q}.keys""" + "".join(f"\n    q{q}_{agg} = mf_{q}.{agg}" for agg in F_map["0"])
+        allocate += f"""
+    mf_{q}.allocate()""" + "".join(f"\n    q{q}_{agg} = mf_{q}.{agg}" for i in range(1, spec["n"] + 1) for agg in F_map[str(i)])
+        levels[0].append(f"""        # Query {q}: 0th scan
+        key = {group_key}
+        if key not in q{q}_index:
+            q{q}_index[key] = len(q{q}_keys)
+            q{q}_keys.append(key)
+""" if not F_map["0"] else f"""        # Query {q}: 0th scan
+        key = {group_key}
+        g = q{q}_index.get(key)
+        if g is None:
+            q{q}_index[key] = len(q{q}_keys)
+            q{q}_keys.append(key)
+            {qualify((chr(10) + "            ").join(generate_new_group(F_map["0"], columns) or ["pass"]))}
+        else:
+            {qualify((chr(10) + "            ").join(generate_updates(F_map["0"], columns) or ["pass"]))}
+""")
+        for level, stage in enumerate(stages[1:], start=1):
+            part = f"""        # Query {q}: grouping variable{'s' if len(stage) > 1 else ''} {', '.join(map(str, stage))}
+        g = q{q}_index[{group_key}]
+"""
+            for i in stage:
+                part += f"""        if {qualify(transform_sigma(sigma_map[str(i)], columns))}:
+            {qualify((chr(10) + "            ").join(generate_updates(F_map[str(i)], columns) or ["pass"]))}
+"""
+            levels[level].append(part)
+
+    passes = ""
+    for level, parts in enumerate(levels):
+        passes += f"""
+    # Pass {level}: feeds {len(parts)} quer{'ies' if len(parts) > 1 else 'y'}
+    for row in sales_rows:
+{"".join(parts)}"""
+        if level == 0:
+            passes += allocate + "\n"
+
+    return f"""
+\"""
+-------------------------------------------------------
+Auto-Generated Program - Multi-Feature Query Processor (query batch)
+Generated by: generator.py
+Author: Sairithik Komuravelly (Team: NoJoinZone)
+Description:
+    This program executes a batch of {len(specs)} MF (Multi-Feature) queries over the
+    'sales' table. The table is fetched once and every pass over it feeds all the
+    queries that need that pass; each query's results are returned separately.
+-------------------------------------------------------
+\"""
+{generate_imports(["os", "psycopg2", "psycopg2.extensions", "tabulate", "from array import array"]
+                  + (["itertools"] if stream else []) + (["pickle", "tempfile"] if stream == "spill" else [])
+                  + (SNAPSHOT_IMPORTS if snapshot else []) + (["datetime"] if "datetime.date(" in passes else [])
+                  + (["heapq"] if "heapq." in outputs else []) + (["itertools"] if "itertools." in outputs else []))}
+
+{classes}{ingest_helpers}{DESCENDING_HELPER if "Descending(" in outputs else ""}
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+
+def mf_scans(sales_rows):
+    \"""
+    Runs the scans of every query, one pass over sales_rows per dependency level, and
+    returns the MF structures in query order.
+    \"""{setup}
+{passes}
+    return [{", ".join(f"mf_{q}" for q in range(1, len(specs) + 1))}]
+{outputs}
+
+def run(conn):
+    \"""
+    Runs the batch over an open connection and returns one list of output rows per query.
+    \"""
+    {ingest}
+    mfs = mf_scans(sales_rows)
+    return [{", ".join(f"mf_output_{q}(mfs[{q - 1}])" for q in range(1, len(specs) + 1))}]
+
+
+def query():
+    load_dotenv()
+
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)
+    return "\\n\\n".join(tabulate.tabulate(rows, headers="keys", tablefmt="psql") for rows in run(conn))
+
+def main():
+    print(query())
+    
+if "__main__" == __name__:
+    main()
+    """
+
+
+def generate_code(input_data, concurrent_stages=False, stream=None, batch_size=10000, backend="python",
+                  pushdown=True, workers=None, snapshot=None, version_column=None, incremental=None,
+                  watermark_column=None, profile=None, bitmap_index=False, zone_maps=False,
+                  dictionary_encoding=False, memory_budget=None, approximate=None, sample_method="row",
+                  time_budget=None, error_target=None, confidence=0.95, shards=None, source=None, copy=False):
+    """
+    Generates the source of the MF query program for a query specification.
+
+    The program:
+        * Performs the 0th scan on the 'sales' table to build the groups
+        * Computes grouping variable aggregates, one fused scan per DAG stage
+        * Applies any specified 'having' condition
+        * Outputs the selected attributes
+
+    F may also hold sketch aggregates with a fixed memory bound per group (see
+    parse_sketch() and generate_sketches()): count_distinct_[i_]col, median_[i_]col,
+    p<NN>_[i_]col and top_[i_]col.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json. A list of query
+            specifications generates a batch program, see generate_batch_code().
+        concurrent_stages (bool): Run the grouping variables of a stage as concurrent
+            threads (one scan each) instead of one fused scan.
+        stream (str): Ingestion mode, see generate_ingest().
+        batch_size (int): Rows per round trip in the streaming modes.
+        backend (str): 'python' for row-at-a-time scans, 'numpy' for the columnar
+            engine of generate_numpy_code().
+        pushdown (bool): Push projections and predicates into the SQL, see plan_sales_query().
+        workers (int): Run the scans over hash partitions of the rows in this many
+            processes, see generate_partitioned_scans().
+        snapshot (str): Read the rows from a local snapshot in this directory instead of
+            querying the table, see generate_snapshot_ingest().
+        version_column (str): Column whose maximum identifies the table version for the
+            snapshot probe (default: xmin).
+        incremental (str): Persist the MF structure in this file and only fold in new rows
+            on later runs, see generate_incremental().
+        watermark_column (str): Monotonic column identifying new rows (default: xmin).
+        profile (bool or str): Instrument the program: run() records the time of the fetch,
+            of every pass and of the output, the rows scanned and group lookups per pass,
+            the rows passing each sigma conjunct and the HAVING pass rate, and query()
+            also times tabulate and reports it all (see generate_profile_helpers()) as a
+            plan tree on stderr, or as JSON to the file named by a string. Without it
+            the program has no instrumentation at all.
+        bitmap_index (bool): Build a bitmap index (see generate_bitmap_index()) of the
+            columns that sigma compares to constants with '=' or IN. A pass whose
+            grouping variables all have such a conjunct only visits the rows the index
+            selects. With a snapshot, the index is saved next to it.
+        zone_maps (bool): Load the rows in date order and keep zone maps (see
+            generate_zone_maps()) of the columns sigma compares to constants with
+            ranges; a pass whose grouping variables all have such a conjunct skips the
+            blocks that cannot satisfy it.
+        dictionary_encoding (bool): Replace the values of cust, prod and state by integer
+            codes once the rows are loaded (see generate_dictionary_encoding()): grouping,
+            sigma and sorting work on the codes, with the sigma constants resolved to codes
+            before the scans, and only the output decodes them.
+        memory_budget (int): Memory budget of the MF structure in MiB. When the distinct
+            grouping keys would not fit, the rows are spilled to temporary files
+            hash-partitioned by grouping key and the query runs one partition at a time
+            (see generate_memory_budget()). The mode, spill volume and peak RSS are
+            reported on stderr.
+        approximate (float): Run the query on a TABLESAMPLE of this percentage of the
+            table and report the sums, counts and avgs scaled to the whole table with
+            confidence intervals (see generate_approximate()).
+        sample_method (str): 'row' (BERNOULLI) or 'block' (SYSTEM) sampling.
+        time_budget (float): Keep doubling the sample (online aggregation) while the next
+            round fits in this many seconds.
+        error_target (float): Keep doubling the sample until every interval's half-width
+            is within this fraction of its estimate.
+        confidence (float): Confidence level of the intervals.
+        shards (list): Run the query over several sales databases with the same schema,
+            given as database names or libpq connection strings: every shard scans its
+            own rows in its own process and the coordinator merges their partial
+            aggregates (see generate_sharded()). run() then takes the list of targets
+            instead of a connection.
+        source (str): Read the sales rows from this Parquet, Arrow IPC (.arrow/.feather)
+            or CSV file instead of Postgres, only the referenced columns (see
+            generate_source()). run() then takes no connection.
+        copy (bool): On the numpy backend, load the columns with a binary COPY decoded
+            straight into arrays instead of fetching row tuples (see generate_copy_ingest()),
+            falling back to the tuple cursor when the COPY fails or does not decode.
+
+    Returns:
+        str: The Python source of the generated program.
+
+    Raises:
+        ValueError: If the backend is unknown or does not support the requested options.
+    """
+    if snapshot and stream:
+        raise ValueError("snapshot and stream are mutually exclusive")
+    if profile and (isinstance(input_data, list) or backend != "python" or concurrent_stages or workers
+                    or incremental):
+        raise ValueError("profile is only supported for a single query on the python backend, "
+                         "without concurrent_stages, workers or incremental")
+    if (bitmap_index or zone_maps) and (isinstance(input_data, list) or backend != "python" or stream or workers
+                                        or incremental):
+        raise ValueError("bitmap_index and zone_maps are only supported for a single query on the python "
+                         "backend, without stream, workers or incremental")
+    if memory_budget is not None and (isinstance(input_data, list) or backend != "python" or stream or workers
+                                      or incremental or snapshot or profile or bitmap_index or zone_maps
+                                      or dictionary_encoding):
+        # The partitions are streamed back from their files, like the stream modes
+        raise ValueError("memory_budget is only supported for a single query on the python backend, "
+                         "without stream, workers, incremental, snapshot, profile, bitmap_index, zone_maps "
+                         "or dictionary_encoding")
+    if memory_budget is not None and memory_budget < 1:
+        raise ValueError("memory_budget must be at least 1 MiB")
+    if approximate is not None and (isinstance(input_data, list) or backend != "python" or stream or workers
+                                    or incremental or snapshot or profile or memory_budget is not None):
+        raise ValueError("approximate is only supported for a single query on the python backend, "
+                         "without stream, workers, incremental, snapshot, profile or memory_budget")
+    if approximate is None and (time_budget is not None or error_target is not None):
+        raise ValueError("time_budget and error_target need approximate")
+    if approximate is not None:
+        if not 0 < approximate <= 100:
+            raise ValueError("approximate must be a sample percentage in (0, 100]")
+        if sample_method not in ("row", "block"):
+            raise ValueError(f"Unknown sample method: {sample_method}")
+        if (time_budget is not None and time_budget <= 0) or (error_target is not None and error_target <= 0):
+            raise ValueError("time_budget and error_target must be positive")
+        if not 0 < confidence < 1:
+            raise ValueError("confidence must be between 0 and 1")
+        if any(re.match(r"(?:sum|count)_", sub.id) for cond in input_data["sigma"]
+               for sub in ast.walk(parse_condition(cond)) if isinstance(sub, ast.Name)):
+            # The scans would compare rows to the sample's (unscaled) sums and counts
+            raise ValueError("approximate does not support sigma conditions on sum or count aggregates")
+    sketches = [sketch for spec in (input_data if isinstance(input_data, list) else [input_data])
+                for agg in spec["F"] if (sketch := parse_sketch(agg))]
+    if sketches and (isinstance(input_data, list) or backend != "python" or incremental or approximate is not None):
+        raise ValueError("sketch aggregates are only supported for a single query on the python backend, "
+                         "without incremental or approximate")
+    if dictionary_encoding and any(kind == "top" and column in DICTIONARY_COLUMNS for kind, column, _ in sketches):
+        raise ValueError("top_ aggregates of cust, prod or state cannot be combined with dictionary_encoding")
+    if shards is not None and (isinstance(input_data, list) or backend != "python" or concurrent_stages or stream
+                               or workers or snapshot or incremental or profile or bitmap_index or zone_maps
+                               or dictionary_encoding or memory_budget is not None or approximate is not None):
+        raise ValueError("shards is only supported for a single query on the python backend, without "
+                         "concurrent_stages, stream, workers, snapshot, incremental, profile, bitmap_index, "
+                         "zone_maps, dictionary_encoding, memory_budget or approximate")
+    if shards is not None and not shards:
+        raise ValueError("shards needs at least one connection target")
+    if source and (isinstance(input_data, list) or stream or snapshot or incremental or memory_budget is not None
+                   or approximate is not None or shards is not None):
+        raise ValueError("source is only supported for a single query, without stream, snapshot, incremental, "
+                         "memory_budget, approximate or shards")
+    if source:
+        source_format(source)
+    if copy and (isinstance(input_data, list) or backend != "numpy" or stream or snapshot or source):
+        raise ValueError("copy is only supported for a single query on the numpy backend, without stream, "
+                         "snapshot or source")
+    if dictionary_encoding and (isinstance(input_data, list) or backend != "python" or stream or workers
+                                or incremental):
+        raise ValueError("dictionary_encoding is only supported for a single query on the python backend, "
+                         "without stream, workers or incremental")
+    if isinstance(input_data, list):
+        if backend != "python" or concurrent_stages or workers or incremental:
+            raise ValueError("a query batch only supports the stream, pushdown and snapshot options")
+        return generate_batch_code(input_data, stream=stream, batch_size=batch_size, pushdown=pushdown,
+                                   snapshot=snapshot, version_column=version_column)
+    if incremental and (stream or snapshot or workers):
+        raise ValueError("incremental cannot be combined with stream, snapshot or workers")
+    if backend == "numpy":
+        if concurrent_stages or workers or incremental:
+            raise ValueError("concurrent_stages, workers and incremental are only supported by the python backend")
+        return generate_numpy_code(input_data, stream=stream, batch_size=batch_size, pushdown=pushdown,
+                                   snapshot=snapshot, version_column=version_column, source=source, copy=copy)
+    if backend != "python":
+        raise ValueError(f"Unknown backend: {backend}")
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1")
+    scanned_input = input_data
+    if approximate is not None:
+        # The sums of squares of the summed values, for the confidence intervals
+        squares = [agg.replace("avg", "sumsq", 1) if agg.startswith("avg") else agg.replace("sum", "sumsq", 1)
+                   for agg in input_data["F"] if agg.startswith(("sum", "avg"))]
+        scanned_input = dict(input_data, F=input_data["F"] + squares)
+    mf_class_code, F_map = generate_mf_class(scanned_input, dictionary_encoded=dictionary_encoding)
+    # A sample covers all groups alike, so only the projection is pushed down
+    plan = plan_sales_query(input_data, pushdown,
+                            local=bool(snapshot or incremental or source or approximate is not None))
+    if zone_maps and not snapshot:
+        # Clustered on date, so the zone map blocks cover narrow time ranges (snapshots are stored in date order)
+        plan = dict(plan, query=plan["query"] + " ORDER BY date")
+    columns = plan["columns"]
+    if snapshot:
+        ingest_helpers, ingest = generate_snapshot_ingest(plan, snapshot, version_column, batch_size)
+    elif incremental:
+        ingest_helpers, ingest = generate_incremental(input_data, plan, incremental, watermark_column)
+    elif source:
+        ingest_helpers, ingest = generate_source(plan, source, batch_size)
+    else:
+        # With workers the parent reads the rows once, into the shared column buffers
+        ingest_helpers, ingest = generate_ingest(plan, stream, batch_size, single_pass=bool(workers))
+    if sketches:
+        ingest_helpers += generate_sketches({kind for kind, _, _ in sketches})
+    grouping_keys  = input_data["V"]
+    # Hash key of a row's group: the tuple of its grouping attribute values (V)
+    group_key = "(" + ", ".join([column_ref(key, columns) for key in grouping_keys]) + ("," if len(grouping_keys) == 1 else "") + ")"
+    sigma_map = {}
+    for cond in input_data["sigma"]:
+        idx = cond.split(".", 1)[0]
+        sigma_map[idx] = cond
+    dag = build_dependency_dag(input_data)
+    stages = plan_scan_stages(dag)
+    # Sigma constants of dictionary-encoded columns -> their code variables, see encoded_constant()
+    codes = {} if dictionary_encoding else None
+    # Grouping variable -> bitmap index expression of its row-only '='/IN conjuncts
+    bitmap_exprs = {}
+    if bitmap_index:
+        for i, cond in sigma_map.items():
+            parts = [generate_bitmap_expr(node, codes) for node in split_conjuncts(parse_condition(cond))
+                     if not reads_aggregates(node)]
+            parts = [part for part in parts if part is not None]
+            if parts:
+                bitmap_exprs[int(i)] = (" & ".join(expr for expr, _ in parts), set().union(*(names for _, names in parts)))
+    # Grouping variable -> zone map test of its row-only range conjuncts
+    zone_exprs = {}
+    if zone_maps:
+        for i, cond in sigma_map.items():
+            parts = [generate_zone_expr(node) for node in split_conjuncts(parse_condition(cond))
+                     if not reads_aggregates(node)]
+            parts = [part for part in parts if part is not None]
+            if parts:
+                zone_exprs[int(i)] = (" and ".join(expr for expr, _ in parts), set().union(*(names for _, names in parts)))
+    indexed_columns = set()
+    zone_columns = set()
+
+    def pass_rows(stage, indent="    "):
+        # Binds pass_rows to the rows the pass visits: the bitmap selection and/or the blocks
+        # the zone maps cannot rule out when every grouping variable of the pass has one,
+        # otherwise every row
+        bitmap = all(i in bitmap_exprs for i in stage)
+        zones = all(i in zone_exprs for i in stage)
+        if zones:
+            zone_columns.update(*(zone_exprs[i][1] for i in stage))
+            may_match = "lambda z: " + (zone_exprs[stage[0]][0] if len(stage) == 1 else
+                                        " or ".join(f"({zone_exprs[i][0]})" for i in stage))
+        if bitmap:
+            names = sorted(set().union(*(bitmap_exprs[i][1] for i in stage)))
+            indexed_columns.update(names)
+            selection = " | ".join(bitmap_exprs[i][0] for i in stage)
+            if zones:
+                selection = f"({selection}) & zones.bitmap({may_match})"
+            fallback = f"zones.rows_where({may_match})" if zones else "sales_rows"
+            code = f"bitmap_rows(sales_rows, {selection}) if bitmaps.covers({', '.join(map(repr, names))}) else {fallback}"
+        elif zones:
+            code = f"zones.rows_where({may_match})"
+        else:
+            return "sales_rows", ""
+        return "pass_rows", f"""{indent}# Only the rows {"the bitmap index selects" if bitmap else "of the blocks the zone maps cannot rule out"} for the row-only conjuncts of sigma
+{indent}pass_rows = {code}
+"""
+
+    scan_blocks = ""
+    for stage_no, stage in enumerate(stages[1:], start=1):
+        gv_blocks = []
+        for i in stage:
+            conjuncts = sigma_conjuncts(sigma_map[str(i)], columns, codes)
+            updates = generate_updates(F_map.get(str(i), []), columns)
+            gv_blocks.append((i, conjuncts, updates or ["pass"]))
+        gv_list = ("grouping variables " if len(gv_blocks) > 1 else "grouping variable ") + ", ".join(str(i) for i, _, _ in gv_blocks)
+        rows, selection = pass_rows(stage)
+        if concurrent_stages and len(gv_blocks) > 1:
+            # One thread per grouping variable; each one only writes its own aggregate columns
+            scan_blocks += f"""
+    # Scan {stage_no}: {gv_list} run concurrently (they only depend on earlier scans)
+"""
+            for block in gv_blocks:
+                rows, selection = pass_rows([block[0]], "        ")
+                scan_blocks += f"""    def scan_gv_{block[0]}():
+{selection}{generate_fused_scan([block], group_key, indent="        ", rows=rows)}"""
+            scan_blocks += f"""    with concurrent.futures.ThreadPoolExecutor(max_workers={len(gv_blocks)}) as pool:
+        for future in [{", ".join(f"pool.submit(scan_gv_{i})" for i, _, _ in gv_blocks)}]:
+            future.result()
+"""
+        elif profile:
+            counters = "".join(f"{chr(10)}    sigma_{i}_{k} = 0" for i, conjuncts, _ in gv_blocks for k in range(len(conjuncts)))
+            sigma_counts = ", ".join(
+                f"'{i}': [" + ", ".join(f"({text!r}, sigma_{i}_{k})" for k, (text, _, _) in enumerate(conjuncts)) + "]"
+                for i, conjuncts, _ in gv_blocks)
+            scan_blocks += f"""
+    # Scan {stage_no}: {gv_list}{' fused into one pass (they only depend on earlier scans)' if len(gv_blocks) > 1 else ''}
+    pass_start = time.perf_counter()
+    rows_scanned = 0
+    lookups = 0{counters}
+{selection}{generate_fused_scan(gv_blocks, group_key, profile=True, rows=rows)}    passes.append(profile_pass({stage_no}, {list(stage)}, pass_start, rows_scanned, lookups, {{{sigma_counts}}}))
+"""
+        else:
+            scan_blocks += f"""
+    # Scan {stage_no}: {gv_list}{' fused into one pass (they only depend on earlier scans)' if len(gv_blocks) > 1 else ''}
+{selection}{generate_fused_scan(gv_blocks, group_key, rows=rows)}"""
+
+    # Rows-based 0th scan; with a groups query it is only used for row partitions (see workers)
+    rows_zeroth_scan = f"""for row in sales_rows:
+        key = {group_key}
+        if key not in index:
+            index[key] = len(keys)
+            keys.append(key)
+""" if not F_map["0"] else f"""for row in sales_rows:
+        key = {group_key}
+        g = index.get(key)
+        if g is None:
+            # New group: its id is the next position in every column
+            index[key] = len(keys)
+            keys.append(key)
+            {(chr(10) + "            ").join(generate_new_group(F_map["0"], columns) or ["pass"])}
+        else:
+            {(chr(10) + "            ").join(generate_updates(F_map["0"], columns) or ["pass"])}
+"""
+    if profile:
+        rows_zeroth_scan = rows_zeroth_scan.replace("for row in sales_rows:\n", "for row in sales_rows:\n        rows_scanned += 1\n", 1)
+    if plan["groups_query"]:
+        zeroth_scan = f"""    # First scan: there are no 0th g.v aggregates, so the groups come straight from GROUPS_QUERY
+    # (sales_rows only holds the rows matching the pushed-down sigma predicates)
+    if group_rows is not None:
+        for key in group_rows:
+            index[key] = len(keys)
+            keys.append(key)
+    else:
+        {rows_zeroth_scan.replace(chr(10) + "    ", chr(10) + "        ")}
+"""
+    else:
+        zeroth_scan = f"""    # First scan: populate the groups and compute 0th g.v aggregates
+    {rows_zeroth_scan}"""
+    if profile:
+        zeroth_scan = f"""    pass_start = time.perf_counter()
+    rows_scanned = 0
+{zeroth_scan}    passes.append(profile_pass(0, [0], pass_start, rows_scanned, rows_scanned))
+"""
+
+    # Bind the MF structure's columns to locals so the scans index them without attribute lookups
+    base_bindings = "".join(f"\n    {agg} = mf.{agg}" for agg in F_map["0"])
+    gv_bindings = "".join(f"\n    {agg} = mf.{agg}" for i in range(1, input_data["n"] + 1) for agg in F_map[str(i)])
+    if dictionary_encoding:
+        encoded = {name: columns.index(name) for name in DICTIONARY_COLUMNS if name in columns}
+        group_positions = {name: grouping_keys.index(name) for name in encoded
+                           if name in grouping_keys} if plan["groups_query"] else {}
+        ingest_helpers += generate_dictionary_encoding(encoded, group_positions, len(columns), len(grouping_keys))
+    if indexed_columns:
+        ingest_helpers += generate_bitmap_index({name: columns.index(name) for name in sorted(indexed_columns)},
+                                                persisted=bool(snapshot), dictionary_encoded=dictionary_encoding)
+    if zone_columns:
+        ingest_helpers += generate_zone_maps({name: columns.index(name) for name in sorted(zone_columns)},
+                                             ZONE_BLOCK_SIZE)
+    if snapshot and (indexed_columns or zone_columns):
+        ingest = """snapshot = open_snapshot(conn)
+    # The passes select rows by row id or block, so the rows are materialized
+    sales_rows = list(snapshot)""" + ("""
+    bitmaps = load_bitmaps(snapshot)""" if indexed_columns else "")
+    if dictionary_encoding:
+        ingest += f"""
+    sales_rows, {"group_rows" if plan["groups_query"] else "_"}, dictionaries = encode_rows(sales_rows{", group_rows" if plan["groups_query"] else ""})"""
+        if indexed_columns and snapshot:
+            ingest += """
+    bitmaps = bitmaps.encoded(dictionaries)"""
+    # Only the constants of the passes that are generated (a bitmap expression may go unused)
+    codes = {key: name for key, name in (codes or {}).items() if re.search(rf"\b{name}\b", scan_blocks)}
+    code_bindings = ("\n    # The sigma constants of the dictionary-encoded columns, as codes\n"
+                     + generate_code_bindings(codes).rstrip()) if codes else ""
+    scans = f"""
+def mf_scans(sales_rows, group_rows=None{", passes=None" if profile else ""}{", bitmaps=None" if indexed_columns else ""}{", dictionaries=None" if dictionary_encoding else ""}):
+    \"""
+    Runs the 0th scan and every grouping variable scan over sales_rows and returns the MF structure.{'''
+    The profile of every pass is appended to passes.''' if profile else ""}{'''
+    sales_rows (and group_rows) are dictionary-encoded with dictionaries (encoded here when not given).''' if dictionary_encoding else ""}{'''
+    bitmaps is the bitmap index of sales_rows (built when not given).''' if indexed_columns else ""}
+    \"""
+    mf = MFStructure(){'''
+    if dictionaries is None:
+        sales_rows, group_rows, dictionaries = encode_rows(sales_rows, group_rows)
+    mf.dictionaries = dictionaries''' if dictionary_encoding else ""}{'''
+    if passes is None:
+        passes = []''' if profile else ""}{'''
+    if bitmaps is None:
+        bitmaps = BitmapIndex.from_rows(sales_rows)''' if indexed_columns else ""}{'''
+    zones = ZoneMap(sales_rows)''' if zone_columns else ""}{code_bindings}
+    index = mf.index   # grouping key tuple (V) -> group id, O(1) lookup per row
+    keys = mf.keys{base_bindings}
+{zeroth_scan}    # Logic to compute grouping_variable aggregates
+    mf.allocate(){gv_bindings}
+    {scan_blocks}
+    return mf
+"""
+    if approximate is None:
+        scans += generate_output(input_data, F_map, dictionary_encoded=dictionary_encoding)
+    scan_arguments = (", bitmaps=bitmaps" if indexed_columns and snapshot else "") \
+        + (", dictionaries=dictionaries" if dictionary_encoding else "")
+    if workers:
+        # Heavy-hitter groups can be split when their scans read no aggregates
+        merge_operations = {agg: merge_operation(agg) for aggs in F_map.values() for agg in aggs} \
+            if len(plan_shard_rounds(input_data)) == 1 else None
+        scans += generate_partitioned_scans(plan, grouping_keys, workers, batch_size, merge_operations)
+        body = """
+    mf = scan_partitions(sales_rows)"""
+        if plan["groups_query"]:
+            body += """
+    # Groups without any row matching the pushed-down predicates
+    mf.add_groups(group_rows)"""
+    elif incremental:
+        body = ""
+    else:
+        body = f"""
+    mf = mf_scans(sales_rows{", group_rows" if plan["groups_query"] else ""}{scan_arguments})"""
+    output = """
+    return mf_output(mf)"""
+    tabulate_output = """return tabulate.tabulate(run(conn),
+                        headers="keys", tablefmt="psql")"""
+    run_signature = "conn"
+    run_docstring = "Runs the MF query over an open connection and returns the output rows as dicts."
+    connect = """
+    user = os.getenv('USER')
+    password = os.getenv('PASSWORD')
+    dbname = os.getenv('DBNAME')
+
+    conn = psycopg2.connect("dbname="+dbname+" user="+user+" password="+password)"""
+    if shards is not None:
+        ingest_helpers += generate_sharded(input_data, F_map, plan, shards, ingest, group_key, zeroth_scan,
+                                           base_bindings)
+        ingest = """mf = mf_sharded([functools.partial(fetch_shard, target) for target in targets])"""
+        body = ""
+        run_signature = "targets=SHARDS"
+        run_docstring = ("Runs the MF query over the shards (connection targets) and returns the output rows\n"
+                         "    as dicts.")
+        connect = ""
+        tabulate_output = """return tabulate.tabulate(run(),
+                        headers="keys", tablefmt="psql")"""
+    if memory_budget is not None:
+        ingest_helpers += generate_memory_budget(input_data, plan, memory_budget,
+                                                 estimate_group_bytes(input_data, F_map), batch_size)
+        ingest = """global last_memory
+    with conn.cursor() as cur:
+        cur.execute(GROUP_COUNT_QUERY)
+        n_groups = cur.fetchone()[0]
+    # The count only sizes the execution, it need not share the scans' snapshot
+    conn.rollback()
+    if n_groups > MAX_GROUPS:
+        # The MF structure would exceed MEMORY_BUDGET: run one partition of the groups at a time
+        output_rows, last_memory = run_external(conn, n_groups)
+        return output_rows
+    """ + ingest
+        output = """
+    output_rows = mf_output(mf)
+    last_memory = memory_report("in-memory", n_groups)
+    return output_rows"""
+        tabulate_output = """output_rows = run(conn)
+    report_memory(last_memory)
+    return tabulate.tabulate(output_rows,
+                        headers="keys", tablefmt="psql")"""
+    if approximate is not None:
+        ingest_helpers += generate_approximate(input_data, F_map, plan, approximate, sample_method, time_budget,
+                                               error_target, confidence, dictionary_encoding)
+        encode = """
+        sales_rows, _, dictionaries = encode_rows(sales_rows)""" if dictionary_encoding else ""
+        ingest = f"""global last_approximation
+    started = time.perf_counter()
+    # One seed for every round, so each (larger) sample contains the previous one
+    seed = random.randrange(2 ** 31)
+    percent = SAMPLE_PERCENT
+    for round_number in itertools.count(1):
+        round_started = time.perf_counter()
+        with conn.cursor() as cur:
+            cur.execute(SAMPLE_QUERY, (percent, seed))
+            sales_rows = cur.fetchall(){encode}
+        mf = mf_scans(sales_rows{scan_arguments})
+        output_rows, max_error = mf_estimates(mf, percent / 100)
+        now = time.perf_counter()
+        last_approximation = {{"round": round_number, "sample_percent": percent, "sample_rows": len(sales_rows),
+                              "max_relative_error": max_error, "seconds": now - started}}
+        # The next round reads twice the rows, so it should take about twice as long
+        if (not ONLINE or percent >= 100 or (ERROR_TARGET is not None and max_error <= ERROR_TARGET)
+                or (TIME_BUDGET is not None and now - started + 2 * (now - round_started) > TIME_BUDGET)):
+            return output_rows
+        report_round(last_approximation, output_rows)
+        percent = min(100.0, percent * 2)"""
+        body = output = ""
+        tabulate_output = """output_rows = run(conn)
+    report_round(last_approximation)
+    return tabulate.tabulate(output_rows,
+                        headers="keys", tablefmt="psql")"""
+    if profile:
+        ingest_helpers += generate_profile_helpers(profile if isinstance(profile, str) else None)
+        ingest = """global last_profile
+    started = time.perf_counter()
+    """ + ingest
+        body = f"""
+    fetched = time.perf_counter()
+    passes = []
+    mf = mf_scans(sales_rows{", group_rows" if plan["groups_query"] else ""}, passes=passes{scan_arguments})"""
+        output = f"""
+    computed = time.perf_counter()
+    output_rows = mf_output(mf)
+    last_profile = {{
+        "fetch_seconds": fetched - started,
+        "streamed": {bool(stream)},
+        "passes": passes,
+        "compute_seconds": computed - fetched,
+        "groups": len(mf.keys),
+        "output_rows": len(output_rows),
+        "having_pass_rate": len(output_rows) / len(mf.keys) if mf.keys else None,
+        "output_seconds": time.perf_counter() - computed,
+    }}
+    return output_rows"""
+        tabulate_output = """output_rows = run(conn)
+    started = time.perf_counter()
+    table = tabulate.tabulate(output_rows, headers="keys", tablefmt="psql")
+    last_profile["tabulate_seconds"] = time.perf_counter() - started
+    report_profile(last_profile)
+    return table"""
+
+    if source:
+        run_signature = "conn=None"
+        run_docstring = "Runs the MF query over SOURCE_PATH and returns the output rows as dicts."
+        connect = ""
+        tabulate_output = tabulate_output.replace("run(conn)", "run()")
+
+    imports = ["os", "psycopg2", "psycopg2.extensions", "tabulate", "from array import array"]
+    if concurrent_stages:
+        imports.append("concurrent.futures")
+    if stream:
+        imports.append("itertools")
+    if stream == "spill":
+        imports += ["pickle", "tempfile"]
+    if snapshot:
+        imports += SNAPSHOT_IMPORTS
+    if incremental:
+        imports += ["pickle", "tempfile"]
+    if workers:
+        imports += ["concurrent.futures", "importlib.util", "itertools", "multiprocessing", "numpy as np",
+                    "from multiprocessing import shared_memory"]
+    if profile:
+        imports += ["json", "sys", "time"]
+    if indexed_columns or zone_columns:
+        imports.append("itertools")
+    if indexed_columns and snapshot:
+        imports.append("pickle")
+    if "datetime.date(" in scans:
+        imports.append("datetime")
+    if dictionary_encoding:
+        imports += ["bisect", "operator"]
+    if "heapq." in scans:
+        imports.append("heapq")
+    if "itertools." in scans:
+        imports.append("itertools")
+    if "Descending(" in scans + ingest_helpers:
+        ingest_helpers += DESCENDING_HELPER
+    if memory_budget is not None:
+        imports += ["heapq", "itertools", "operator", "pickle", "sys", "tempfile"]
+    if any(kind == "count_distinct" for kind, _, _ in sketches):
+        imports += ["functools", "hashlib", "math"]
+    if any(kind == "quantile" for kind, _, _ in sketches):
+        imports += ["bisect", "itertools", "random"]
+    if shards is not None:
+        imports += ["functools", "importlib.util", "multiprocessing"]
+    if source:
+        imports += source_imports(source)
+    if approximate is not None:
+        imports += ["itertools", "math", "random", "statistics", "sys", "time"]
+        if "heapq." in ingest_helpers:
+            imports.append("heapq")
+
+    tmp = f"""
+\"""
+-------------------------------------------------------
+Auto-Generated Program - Multi-Feature Query Processor
+Generated by: generator.py
+Author: Sairithik Komuravelly (Team: NoJoinZone)
+Description:
+    This program executes a dynamically constructed MF (Multi-Feature) query
+    over the 'sales' table. It performs multiple scans to evaluate conditions
+    associated with each grouping variable and computes the required aggregates
+    (e.g., sum, count, avg, max, min).
+
+    The logic is based on enhanced SQL-like processing without using joins,
+    in accordance with the CS562 Project specifications and relevant research.
+
+    Final output is printed in a formatted table containing the fields
+    specified in the 'S' clause of input.json.
+-------------------------------------------------------
+\"""
+{generate_imports(imports)}
+
+{mf_class_code}{ingest_helpers}
+# DO NOT EDIT THIS FILE, IT IS GENERATED BY generator.py
+{scans}
+
+def run({run_signature}):
+    \"""
+    {run_docstring}
+    \"""
+    {ingest}{body}{output}
+
+
+def query():
+    load_dotenv()
+{connect}
+    {tabulate_output}
+
+def main():
+    print(query())
+    
+if "__main__" == __name__:
+    main()
+    """
+    return tmp
+
+
+@functools.lru_cache(maxsize=None)
+def generator_source():
+    """
+    Returns the source of this generator, part of every plan key so programs generated
+    by another version of it are never reused.
+    """
+    with open(__file__, "rb") as f:
+        return f.read()
+
+
+# Plan key -> compiled program module, memoized for the lifetime of the process
+_compiled_programs = {}
+# Directory on sys.path with the source of every compiled program, see program_directory()
+_program_dir = None
+
+
+def program_directory():
+    """
+    Returns the directory holding a copy of the source of every program compiled by this
+    process, created on first use, put on sys.path and removed at exit. Worker processes
+    started with spawn get the parent's sys.path, so they can import a program by module
+    name to unpickle its functions.
+    """
+    global _program_dir
+    if _program_dir is None:
+        _program_dir = tempfile.mkdtemp(prefix="mf_programs_")
+        atexit.register(shutil.rmtree, _program_dir, True)
+        sys.path.append(_program_dir)
+    return _program_dir
+
+
+def compile_mf_query(input_data, cache=None, **options):
+    """
+    Compiles the MF query program of a query specification into an in-memory module.
+
+    Modules are memoized per process by plan key (see plan_cache.plan_key()). With a
+    PlanCache, bytecode compiled by earlier runs is loaded from it and new programs
+    are added to it; module.__file__ is then the cached source.
+
+    Parameters:
+        input_data (dict): The MF query specification (the fields of input.json).
+        cache (PlanCache): Optional on-disk plan cache.
+        **options: Generation options of generate_code().
+
+    Returns:
+        module: The program; module.run(conn) returns its output rows.
+    """
+    key = plan_key(input_data, options, generator_source())
+    module = _compiled_programs.get(key)
+    if module is not None:
+        return module
+    code = cache.load(key) if cache else None
+    source = None
+    if code is None:
+        source = generate_code(input_data, **options)
+        if cache:
+            cache.put(key, source)
+            code = cache.load(key)
+        if code is None:
+            code = compile(source, f"<mf program {key[:12]}>", "exec")
+    name = f"_mf_program_{key[:16]}"
+    # The module runs the compiled (or cached) code, spawned worker processes import the copy
+    path = os.path.join(program_directory(), name + ".py")
+    if source is None:
+        shutil.copyfile(cache.source_path(key), path)
+    else:
+        with open(path, "w") as f:
+            f.write(source)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_file_location(name, path))
+    if cache:
+        module.__file__ = cache.source_path(key)
+    # Registered so worker processes (see generate_partitioned_scans() and generate_sharded())
+    # started with fork can unpickle its functions
+    sys.modules[module.__name__] = module
+    exec(code, module.__dict__)
+    _compiled_programs[key] = module
+    return module
+
+
+def run_mf_query(input_data, connection=None, cache=None, **options):
+    """
+    Runs an MF query in the calling process, without writing or starting a program.
+
+    Parameters:
+        input_data (dict): The MF query specification (the fields of input.json), or a list
+            of them to run as one batch with shared scans.
+        connection: An open psycopg2 connection with no transaction in progress. The query
+            runs in its own read-only transaction, which is rolled back, and the session
+            settings of the connection are restored afterwards. When omitted, a connection
+            is opened from the USER, PASSWORD and DBNAME environment variables (or .env)
+            and closed afterwards. A sharded query (see the shards option of generate_code())
+            connects to its shards itself and takes no connection, and a query over a source
+            file needs none.
+        cache (PlanCache): Optional on-disk plan cache, see compile_mf_query().
+        **options: Generation options of generate_code().
+
+    Returns:
+        list: One dict per output row, mapping the fields of V and S to their values, in
+            grouping key order. For a list of specifications (a batch), one such list per query.
+
+    Raises:
+        ValueError: If the connection has a transaction in progress, or is given for a
+            sharded query.
+    """
+    program = compile_mf_query(input_data, cache, **options)
+    if options.get("source"):
+        # The rows come from a file
+        return program.run()
+    if options.get("shards") is not None:
+        if connection is not None:
+            raise ValueError("run_mf_query() connects to the shards of a sharded query itself")
+        # USER and PASSWORD for the shards given as database names
+        load_dotenv(find_dotenv(usecwd=True))
+        return program.run()
+    if connection is None:
+        load_dotenv(find_dotenv(usecwd=True))
+        connection = psycopg2.connect("dbname=" + os.getenv('DBNAME') + " user=" + os.getenv('USER')
+                                      + " password=" + os.getenv('PASSWORD'))
+        try:
+            return program.run(connection)
+        finally:
+            connection.close()
+    if connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        raise ValueError("run_mf_query() needs a connection without a transaction in progress")
+    isolation_level, readonly, autocommit = connection.isolation_level, connection.readonly, connection.autocommit
+    # Server-side cursors and snapshots need a transaction
+    connection.autocommit = False
+    try:
+        return program.run(connection)
+    finally:
+        connection.rollback()
+        connection.set_session(isolation_level="DEFAULT" if isolation_level is None else isolation_level,
+                               readonly="DEFAULT" if readonly is None else readonly,
+                               autocommit=autocommit)
+
+
+def main(argv=None):
+    """
+    Main driver function that orchestrates the MF query code generation process.
+
+    This function:
+    - Reads the input JSON file ('input.json') containing the MF query specification
+      (or a list of them, run as one batch)
+    - Runs it in-process with run_mf_query(), which generates and compiles the program
+      only when the plan cache (see plan_cache.py) does not have it yet
+    - Copies the program to '_generated.py' and prints the output table
+
+    Parameters:
+        argv (list): Command line arguments (defaults to sys.argv[1:]).
+    """
+    parser = argparse.ArgumentParser(description="Generate and run the MF query described by input.json")
+    parser.add_argument("--backend", choices=["python", "numpy"], default="python",
+                        help="generate row-at-a-time Python scans or the NumPy columnar engine")
+    parser.add_argument("--concurrent-stages", action="store_true",
+                        help="run the independent grouping variables of each scan stage in concurrent threads")
+    parser.add_argument("--no-pushdown", action="store_true",
+                        help="select every column of the full sales table instead of pushing "
+                             "projections and sigma predicates into the SQL query")
+    parser.add_argument("--stream", choices=["restream", "spill"],
+                        help="stream sales through a server-side cursor instead of fetchall(): "
+                             "re-stream it for every scan or spill a local copy on the first scan")
+    parser.add_argument("--batch-size", type=int, default=10000,
+                        help="rows fetched per round trip when streaming (default: 10000)")
+    parser.add_argument("--workers", type=int,
+                        help="run the scans over hash partitions of the rows in this many processes")
+    parser.add_argument("--snapshot", metavar="DIR",
+                        help="scan a local memory-mapped snapshot of sales kept in DIR, rebuilt only "
+                             "when the table changed")
+    parser.add_argument("--snapshot-version-column", metavar="COLUMN",
+                        help="column whose maximum identifies the table version (default: xmin)")
+    parser.add_argument("--incremental", metavar="STATE_FILE",
+                        help="persist the MF structure in STATE_FILE and on later runs only fold in "
+                             "the rows added since (sales must be append-only)")
+    parser.add_argument("--watermark-column", metavar="COLUMN",
+                        help="monotonic column identifying new rows for --incremental (default: xmin)")
+    parser.add_argument("--bitmap-index", action="store_true",
+                        help="index the columns sigma compares to constants with bitmaps, so passes only "
+                             "visit the qualifying rows (saved next to the --snapshot when given)")
+    parser.add_argument("--zone-maps", action="store_true",
+                        help="fetch sales in date order and skip the blocks of rows whose day/month/year/"
+                             "quant/date ranges cannot satisfy the row-only conditions of sigma")
+    parser.add_argument("--dictionary-encoding", action="store_true",
+                        help="encode cust, prod and state as integer codes once loaded, so grouping, sigma "
+                             "and sorting compare small ints (decoded only for the output)")
+    parser.add_argument("--memory-budget", type=int, metavar="MIB",
+                        help="memory budget of the MF structure; when the groups would exceed it the rows are "
+                             "spilled hash-partitioned by V and the query runs one partition at a time")
+    parser.add_argument("--approximate", type=float, metavar="PERCENT",
+                        help="run the query on a sample of PERCENT%% of sales and report sums, counts and avgs "
+                             "scaled to the whole table with confidence intervals")
+    parser.add_argument("--sample-method", choices=["row", "block"],
+                        help="sample rows (TABLESAMPLE BERNOULLI, default) or whole pages (SYSTEM)")
+    parser.add_argument("--time-budget", type=float, metavar="SECONDS",
+                        help="with --approximate, keep doubling the sample while the next round fits in SECONDS")
+    parser.add_argument("--error-target", type=float, metavar="FRACTION",
+                        help="with --approximate, keep doubling the sample until every interval is within "
+                             "FRACTION of its estimate (e.g. 0.02)")
+    parser.add_argument("--confidence", type=float,
+                        help="confidence level of the --approximate intervals (default: 0.95)")
+    parser.add_argument("--source", metavar="PATH",
+                        help="read sales from a Parquet, Arrow IPC (.arrow/.feather) or CSV file instead of "
+                             "Postgres, only the referenced columns")
+    parser.add_argument("--copy", action="store_true",
+                        help="with --backend numpy, load the columns through a binary COPY decoded straight "
+                             "into arrays instead of fetching row tuples")
+    parser.add_argument("--shards", nargs="+", metavar="TARGET",
+                        help="run the query over several sales databases (database names or libpq connection "
+                             "strings), one process per shard, and merge their partial aggregates")
+    parser.add_argument("--profile", nargs="?", const=True, metavar="JSON_FILE",
+                        help="instrument the program and report per-pass times, rows, sigma selectivities "
+                             "and the HAVING pass rate as a plan tree on stderr (or as JSON to JSON_FILE)")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help=f"directory of the compiled plan cache (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_MAX_BYTES // (1024 * 1024),
+                        help="size bound of the plan cache in MiB, least recently used plans are evicted first")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always regenerate the program and run _generated.py")
+    args = parser.parse_args(argv)
+
+    input_data = read_json("input.json")
+    options = {"concurrent_stages": args.concurrent_stages, "stream": args.stream,
+               "batch_size": args.batch_size, "backend": args.backend,
+               "pushdown": not args.no_pushdown, "workers": args.workers,
+               "snapshot": args.snapshot, "version_column": args.snapshot_version_column,
+               "incremental": args.incremental, "watermark_column": args.watermark_column}
+    if args.bitmap_index:
+        options["bitmap_index"] = True
+    if args.zone_maps:
+        options["zone_maps"] = True
+    if args.dictionary_encoding:
+        options["dictionary_encoding"] = True
+    if args.memory_budget is not None:
+        options["memory_budget"] = args.memory_budget
+    if args.shards:
+        options["shards"] = args.shards
+    if args.source:
+        options["source"] = args.source
+    if args.copy:
+        options["copy"] = True
+    for option in ("approximate", "sample_method", "time_budget", "error_target", "confidence"):
+        if getattr(args, option) is not None:
+            options[option] = getattr(args, option)
+    if args.profile:
+        # Only passed when set, so programs without these options keep their plan keys
+        options["profile"] = args.profile
 
-    # Write the generated code to a file
-    open("_generated.py", "w").write(tmp)
-    # Execute the generated code
-    subprocess.run([sys.executable, "_generated.py"])
+    if args.no_cache:
+        # Write the generated code to a file
+        open("_generated.py", "w").write(generate_code(input_data, **options))
+        # Execute the generated code
+        subprocess.run([sys.executable, "_generated.py"])
+        return
 
+    cache = PlanCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    program = compile_mf_query(input_data, cache, **options)
+    # Keep a readable copy of the program; replaced atomically so concurrent runs never see a partial file
+    with open(program.__file__) as f:
+        source = f.read()
+    with tempfile.NamedTemporaryFile("w", dir=".", prefix="_generated.", suffix=".tmp", delete=False) as f:
+        f.write(source)
+    os.replace(f.name, "_generated.py")
+    rows = run_mf_query(input_data, cache=cache, **options)
+    if isinstance(input_data, list):
+        # A batch: one table per query
+        print("\n\n".join(tabulate.tabulate(query_rows, headers="keys", tablefmt="psql") for query_rows in rows))
+    elif args.profile:
+        started = time.perf_counter()
+        table = tabulate.tabulate(rows, headers="keys", tablefmt="psql")
+        program.last_profile["tabulate_seconds"] = time.perf_counter() - started
+        program.report_profile(program.last_profile)
+        print(table)
+    elif args.approximate is not None:
+        program.report_round(program.last_approximation)
+        print(tabulate.tabulate(rows, headers="keys", tablefmt="psql"))
+    elif args.memory_budget is not None:
+        program.report_memory(program.last_memory)
+        print(tabulate.tabulate(rows, headers="keys", tablefmt="psql"))
+    else:
+        print(tabulate.tabulate(rows, headers="keys", tablefmt="psql"))
 
 if "__main__" == __name__:
     main()
@@ -0,0 +1,209 @@
+"""
+-------------------------------------------------------
+plan_cache.py - Compiled MF Query Plan Cache
+Author: Sairithik Komuravelly (Team: NoJoinZone)
+Description:
+    Caches generated MF query programs so that repeat runs of the same query skip
+    code generation and compilation entirely.
+
+    Every entry is keyed by a canonical hash of the query specification (S, n, V,
+    F, sigma, G), the generation options, the generator's own source and the
+    Python bytecode version. An entry is the generated module (<key>.py) and its
+    compiled bytecode (<key>.pyc). Files are written to a temporary name and
+    atomically renamed, so concurrent generations never see a partial entry and
+    never collide. The cache is bounded in size: least recently used entries are
+    evicted first.
+-------------------------------------------------------
+"""
+import hashlib
+import json
+import marshal
+import os
+import py_compile
+import sys
+import tempfile
+
+DEFAULT_CACHE_DIR = ".mf_cache"
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Size of the pyc header (magic, flags, hash/mtime, size) in front of the marshalled code
+PYC_HEADER_SIZE = 16
+
+
+def normalize_spec(input_data):
+    """
+    Builds the canonical form of a query specification.
+
+    S, V and the ORDER BY list O keep their order (they decide the output columns and
+    the sort order); the order of F and sigma does not affect the generated program, so
+    they are sorted; stray whitespace around conditions is ignored. O and the LIMIT L
+    are only part of the canonical form when given.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json.
+
+    Returns:
+        dict: The canonical specification.
+    """
+    spec = {
+        "S": list(input_data["S"]),
+        "n": int(input_data["n"]),
+        "V": list(input_data["V"]),
+        "F": sorted(set(input_data["F"])),
+        "sigma": sorted(cond.strip() for cond in input_data["sigma"]),
+        "G": (input_data.get("G") or "").strip(),
+    }
+    if input_data.get("O") is not None:
+        spec["O"] = [" ".join(item.split()) for item in input_data["O"]]
+    if input_data.get("L") is not None:
+        spec["L"] = int(input_data["L"])
+    return spec
+
+
+def plan_key(input_data, options=None, generator_source=b""):
+    """
+    Computes the cache key of a query plan.
+
+    Parameters:
+        input_data (dict): The parsed contents of input.json, or a list of them (a batch).
+        options (dict): The generation options (backend, stream mode, ...).
+        generator_source (bytes): Source of the code generator, so a changed
+            generator never reuses programs generated by an older version.
+
+    Returns:
+        str: A hex SHA-256 digest.
+    """
+    if isinstance(input_data, list):
+        spec = [normalize_spec(query) for query in input_data]
+    else:
+        spec = normalize_spec(input_data)
+    canonical = json.dumps({"spec": spec, "options": options or {},
+                            "python": sys.implementation.cache_tag},
+                           sort_keys=True, separators=(",", ":"))
+    digest = hashlib.sha256(canonical.encode())
+    digest.update(hashlib.sha256(generator_source).digest())
+    return digest.hexdigest()
+
+
+class PlanCache:
+    """
+    Directory of generated programs and their bytecode, evicted in LRU order once the
+    total size exceeds max_bytes. Recency is the modification time of the .pyc file,
+    refreshed on every hit.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def source_path(self, key):
+        return os.path.join(self.cache_dir, key + ".py")
+
+    def bytecode_path(self, key):
+        return os.path.join(self.cache_dir, key + ".pyc")
+
+    def get(self, key):
+        """
+        Looks up a compiled plan and marks it as most recently used.
+
+        Parameters:
+            key (str): The plan key from plan_key().
+
+        Returns:
+            str: Path of the .pyc file, or None on a miss.
+        """
+        path = self.bytecode_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, source):
+        """
+        Stores a generated program and its compiled bytecode, then evicts least recently
+        used entries until the cache fits in max_bytes (the new entry is always kept).
+
+        Parameters:
+            key (str): The plan key from plan_key().
+            source (str): The generated program.
+
+        Returns:
+            str: Path of the .pyc file.
+
+        Raises:
+            py_compile.PyCompileError: If the generated program does not compile.
+        """
+        source_path = self.source_path(key)
+        self._write_atomic(source_path, source.encode())
+        # Compile to a private name first; the bytecode does not check the source on load
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".pyc.tmp")
+        os.close(fd)
+        try:
+            py_compile.compile(source_path, cfile=tmp, dfile=source_path, doraise=True,
+                               invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+            os.replace(tmp, self.bytecode_path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.evict(keep=key)
+        return self.bytecode_path(key)
+
+    def load(self, key):
+        """
+        Loads the code object of a cached plan without compiling anything.
+
+        Parameters:
+            key (str): The plan key from plan_key().
+
+        Returns:
+            code: The module code object, or None on a miss.
+        """
+        path = self.get(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return marshal.loads(f.read()[PYC_HEADER_SIZE:])
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits in max_bytes.
+
+        Parameters:
+            keep (str): Key of an entry that must not be evicted.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext != ".pyc":
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                size = stat.st_size + os.path.getsize(self.source_path(key))
+            except FileNotFoundError:
+                # Evicted or still being written by a concurrent run
+                continue
+            entries.append((stat.st_mtime, key, size))
+            total += size
+        for _, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            for path in (self.bytecode_path(key), self.source_path(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+
+    def _write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
@@ -21,7 +21,28 @@ Description:
 -------------------------------------------------------
 """
 
+import datetime
+import functools
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import struct
+import sys
+import types
+
+import psycopg2
+import pytest
+import tabulate
+from dotenv import load_dotenv
+
 from generator import main as generator
+from generator import build_dependency_dag, plan_scan_stages
+from generator import generate_numpy_expr, parse_condition, plan_sales_query
+from generator import compile_mf_query, generate_code, generate_copy_ingest, read_json, run_mf_query
+from plan_cache import PlanCache, plan_key
+from benchmark import generate_sales, read_test_queries, write_arrow, write_csv
 from _generated import query as _generated
 from sql import query as sql
 
@@ -56,5 +77,664 @@ def test_generator():
 
     print("✅ Test passed: Output from generated code matches SQL query output.")
 
+def test_run_mf_query():
+    """
+    The in-process API returns the rows the generated program prints.
+    """
+    rows = run_mf_query(read_json("input.json"))
+    assert normalize_output(tabulate.tabulate(rows, headers="keys", tablefmt="psql")) == \
+        normalize_output(_generated())
+
+def test_query_batch():
+    """
+    A batch returns, per query, the rows of running that query on its own.
+    """
+    q1 = read_json("input.json")
+    q2 = {"S": ["cust", "prod", "avg_quant", "avg_1_quant"], "n": 1, "V": ["cust", "prod"],
+          "F": ["avg_quant", "avg_1_quant"], "sigma": ["1.quant > avg_quant"], "G": "avg_1_quant > 2 * avg_quant"}
+    assert run_mf_query([q1, q2]) == [run_mf_query(q1), run_mf_query(q2)]
+
+def test_snapshot(tmp_path):
+    """
+    Scans of the local snapshot, freshly built or reused, return the rows of a scan of the table.
+    """
+    spec = read_json("input.json")
+    rows = run_mf_query(spec)
+    assert run_mf_query(spec, snapshot=str(tmp_path)) == rows
+    assert run_mf_query(spec, snapshot=str(tmp_path)) == rows
+    assert len(list(tmp_path.iterdir())) == 1
+
+class FakeConnection:
+    """
+    Answers the queries of a generated program from lists of rows, without a server.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+
+    def set_session(self, **kwargs):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self.tables)
+
+
+class FakeCursor:
+    """
+    Cursor of a FakeConnection.
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.rows = None
+
+    def execute(self, query):
+        self.rows = self.tables[query]
+
+    def fetchall(self):
+        return list(self.rows)
+
+
+def test_stream_modes(monkeypatch):
+    """
+    Re-streaming the table for every scan, spilling it on the first scan (read back by the
+    concurrent scans of a stage) and streaming it once for a single-pass program give the
+    output of fetchall().
+    """
+    q5 = {"S": ["cust", "avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"], "n": 3, "V": ["cust"],
+          "F": ["avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "sigma": ["1.state = 'NY'",
+                    "2.state = 'NJ' and 2.quant > avg_quant",
+                    "3.state = 'CT' and 3.quant < avg_2_quant"],
+          "G": ""}
+    rng = random.Random(562)
+    rows = [(rng.choice(["Sam", "Bloom", "Emily", "Helen"]), rng.choice(["NY", "NJ", "CT", "PA"]),
+             rng.randint(1, 1000)) for _ in range(2000)]
+    expected = None
+    for options in ({}, {"stream": "restream"}, {"stream": "spill"}, {"stream": "spill", "concurrent_stages": True},
+                    {"stream": "spill", "workers": 2}):
+        program = compile_mf_query(q5, batch_size=100, **options)
+        conn = FakeConnection({program.SALES_QUERY: rows})
+        streamed = []
+        if options:
+            def stream_sales(conn, query=program.SALES_QUERY):
+                streamed.append(query)
+                yield from conn.tables[query]
+            monkeypatch.setattr(program, "stream_sales", stream_sales)
+        output = program.run(conn)
+        expected = expected or output
+        assert output == expected, options
+        # Three passes: the 0th scan, grouping variables 1 and 2, grouping variable 3
+        passes = {"restream": 3, "spill": 1, None: 0}[options.get("stream")]
+        assert len(streamed) == (1 if "workers" in options else passes), options
+    assert len(expected) == 4
+
+
+def test_plan_scan_stages():
+    """
+    Grouping variables that only depend on already-computed aggregates share a scan.
+    """
+    q1 = {"n": 3, "sigma": ["1.state = 'NY'", "2.state = 'NJ'", "3.state = 'CT'"], "G": ""}
+    q5 = {"n": 3, "sigma": ["1.state = 'NY'",
+                            "2.state = 'NJ' and 2.quant > avg_quant",
+                            "3.state = 'CT' and 3.quant < avg_2_quant"],
+          "G": "avg_2_quant > 500 and max_3_quant > avg_quant"}
+    assert plan_scan_stages(build_dependency_dag(q1)) == [[0], [1, 2, 3]]
+    assert plan_scan_stages(build_dependency_dag(q5)) == [[0], [1, 2], [3]]
+    assert build_dependency_dag(q5) == {0: set(), 1: {0}, 2: {0}, 3: {0, 2}}
+    # String constants naming an aggregate are not references
+    q6 = {"n": 2, "sigma": ["1.state = 'NY'", "2.prod = 'sum_2_quant' or 2.prod = 'count_1_quant'"], "G": ""}
+    assert build_dependency_dag(q6) == {0: set(), 1: {0}, 2: {0}}
+    assert plan_scan_stages(build_dependency_dag(q6)) == [[0], [1, 2]]
+
+def test_numpy_conditions():
+    """
+    Sigma conditions compile to row masks, G compiles to a mask over the aggregate vectors.
+    """
+    sigma = parse_condition("2.state = 'NJ' and 2.quant > avg_quant")
+    having = parse_condition("sum_1_quant > 2 * sum_2_quant or max_3_quant > avg_quant")
+    assert generate_numpy_expr(sigma, ["cust"], per_row=True) == (
+        "(columns['state'] == 'NJ') & (columns['quant'] > avg(mf['sum_quant'], mf['count_quant'])[gid])")
+    assert generate_numpy_expr(having, ["cust"], per_row=False) == (
+        "(mf['sum_1_quant'] > (2 * mf['sum_2_quant'])) | (mf['max_3_quant'] > avg(mf['sum_quant'], mf['count_quant']))")
+
+def test_plan_sales_query():
+    """
+    Only referenced columns are selected; aggregate-independent sigma conjuncts are pushed
+    into a WHERE clause only when the 0th scan needs no aggregates.
+    """
+    q1 = {"n": 2, "V": ["cust"], "F": ["count_1_quant", "max_2_quant"], "G": "",
+          "sigma": ["1.state = 'NY' and 1.year > 2017", "2.state = 'NJ' and 2.quant > avg_1_quant"]}
+    plan = plan_sales_query(q1)
+    assert plan["columns"] == ["cust", "year", "state", "quant"]
+    assert plan["query"] == ("SELECT cust, year, state, quant FROM sales "
+                             "WHERE ((state = 'NY') AND (year > 2017)) OR (state = 'NJ')")
+    assert plan["groups_query"] == "SELECT DISTINCT cust FROM sales"
+    q1["F"].append("avg_quant")
+    assert plan_sales_query(q1)["query"] == "SELECT cust, year, state, quant FROM sales"
+    assert plan_sales_query(q1)["groups_query"] is None
+
+def test_partitioned_scans():
+    """
+    Running the scans over hash partitions in worker processes gives the same groups and
+    aggregates as one mf_scans() over all rows, including a heavy-hitter customer.
+    """
+    q5 = {"S": ["cust", "prod", "avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "n": 3, "V": ["cust", "prod"],
+          "F": ["avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "sigma": ["1.state = 'NY'",
+                    "2.state = 'NJ' and 2.quant > avg_quant",
+                    "3.state = 'CT' and 3.quant < avg_2_quant"],
+          "G": "max_3_quant > avg_quant"}
+    module = types.ModuleType("_partitioned_q5")
+    sys.modules[module.__name__] = module  # worker tasks are pickled by reference
+    exec(generate_code(q5, workers=3), module.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice(["Sam"] * 20 + ["Bloom", "Emily", "Helen", "Knuth"]),
+             rng.choice(["Apple", "Eggs", "Milk"]), rng.choice(["NY", "NJ", "CT", "PA"]),
+             rng.randint(1, 1000)) for _ in range(5000)]
+    assert module.mf_output(module.scan_partitions(rows)) == module.mf_output(module.mf_scans(rows))
+    # Its sigma conditions read avg_quant and avg_2_quant, so the heavy hitter stays in one partition
+    assert module.MERGE_OPERATIONS is None
+
+
+def test_partitioned_scans_skew():
+    """
+    When no sigma reads an aggregate, the rows of a heavy-hitter key are split over several
+    tasks and the partial aggregates of its group merged.
+    """
+    spec = {"S": ["cust", "sum_quant", "min_quant", "avg_1_quant", "max_2_quant", "count_2_quant"],
+            "n": 2, "V": ["cust"],
+            "F": ["sum_quant", "min_quant", "avg_1_quant", "max_2_quant", "count_2_quant"],
+            "sigma": ["1.state = 'NY'", "2.state = 'NJ' and 2.quant > 500"], "G": "avg_1_quant > 100"}
+    module = types.ModuleType("_partitioned_skew")
+    sys.modules[module.__name__] = module  # worker tasks are pickled by reference
+    exec(generate_code(spec, workers=2, pushdown=False), module.__dict__)
+    assert module.MERGE_OPERATIONS == {"sum_quant": "add", "min_quant": "min", "sum_1_quant": "add",
+                                       "count_1_quant": "add", "max_2_quant": "max", "count_2_quant": "add"}
+    rng = random.Random(562)
+    # Sam has 90% of the rows
+    rows = [(rng.choice(["Sam"] * 90 + [f"Cust{i}" for i in range(10)]), "Milk", 1, 1, 2020,
+             rng.choice(["NY", "NJ", "CT"]), rng.randint(1, 1000), datetime.date(2020, 1, 1)) for _ in range(4000)]
+    split_tasks = []
+    merge_split_groups = module.merge_split_groups
+    module.merge_split_groups = lambda mf, part: split_tasks.append(part.keys) or merge_split_groups(mf, part)
+    assert module.mf_output(module.scan_partitions(rows)) == module.mf_output(module.mf_scans(rows))
+    # 3600 rows of Sam in tasks of at most 4000 / 16 rows
+    assert len(split_tasks) == 15 and all(keys == [("Sam",)] for keys in split_tasks)
+
+
+def test_partitioned_scans_spawn():
+    """
+    Worker processes started with spawn import a program built by compile_mf_query() by
+    module name.
+    """
+    q4 = read_test_queries(["Q4"])["Q4"]
+    assert plan_sales_query(q4)["columns"] == ["cust", "prod", "state", "quant"]
+    program = compile_mf_query(q4, workers=2)
+    rng = random.Random(562)
+    rows = [(rng.choice(["Sam", "Bloom", "Emily"]), rng.choice(["Apple", "Eggs"]), rng.choice(["NY", "NJ", "CT"]),
+             rng.randint(1, 1000)) for _ in range(2000)]
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        assert program.mf_output(program.scan_partitions(rows)) == program.mf_output(program.mf_scans(rows))
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+
+def test_incremental_refresh(tmp_path):
+    """
+    Folding new rows into a persisted MF structure gives the MF structure of all rows,
+    including a grouping variable that depends on another one (3 on avg_2_quant).
+    """
+    q5 = {"S": ["cust", "prod", "avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "n": 3, "V": ["cust", "prod"],
+          "F": ["avg_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "sigma": ["1.state = 'NY'",
+                    "2.state = 'NJ' and 2.quant > avg_quant",
+                    "3.state = 'CT' and 3.quant < avg_2_quant"],
+          "G": ""}
+    module = types.ModuleType("_incremental_q5")
+    exec(generate_code(q5, incremental=str(tmp_path / "state")), module.__dict__)
+    rng = random.Random(562)
+    # Rows of (cust, prod, state, quant, watermark)
+    rows = [(rng.choice(["Sam", "Bloom", "Emily"]), rng.choice(["Apple", "Eggs"]),
+             rng.choice(["NY", "NJ", "CT"]), rng.randint(1, 1000), n) for n in range(600)]
+    mf = module.mf_scans(rows[:500])
+    module.mf_refresh(mf, rows[500:], lambda keys: [row for row in rows if row[:2] in keys])
+    assert module.mf_output(mf) == module.mf_output(module.mf_scans(rows))
+    # A string constant naming an aggregate is not a reference: grouping variable 3 is folded in
+    literals = dict(q5, sigma=q5["sigma"][:2] + ["3.state = 'CT' and 3.prod != 'avg_2_quant'"])
+    assert "dirty_3" not in generate_code(literals, incremental=str(tmp_path / "literals"))
+
+def test_plan_cache(tmp_path):
+    """
+    Equivalent specs share a plan key, cached plans load without generation, and the
+    least recently used plan is evicted once the cache is full.
+    """
+    q1 = {"S": ["cust", "sum_1_quant"], "n": 2, "V": ["cust"], "F": ["sum_1_quant", "count_2_quant"],
+          "sigma": ["1.state = 'NY'", "2.state = 'NJ'"], "G": ""}
+    reordered = dict(q1, F=["count_2_quant", "sum_1_quant"], sigma=["2.state = 'NJ' ", "1.state = 'NY'"])
+    assert plan_key(q1, {"backend": "python"}) == plan_key(reordered, {"backend": "python"})
+    assert plan_key(q1, {"backend": "python"}) != plan_key(q1, {"backend": "numpy"})
+    assert plan_key(q1) != plan_key(dict(q1, V=["prod"]))
+
+    cache = PlanCache(str(tmp_path))
+    key = plan_key(q1)
+    assert cache.load(key) is None
+    cache.put(key, generate_code(q1))
+    module = types.ModuleType("_cached_q1")
+    exec(cache.load(key), module.__dict__)
+    assert module.mf_output(module.mf_scans([("Sam", "NY", 3), ("Sam", "NJ", 4)])) == [
+        {"cust": "Sam", "sum_1_quant": 3}]
+
+    cache.max_bytes = 0
+    other = plan_key(reordered, {"backend": "numpy"})
+    cache.put(other, generate_code(reordered, backend="numpy"))
+    assert cache.get(key) is None and cache.get(other) is not None
+
+def test_sigma_expressions():
+    """
+    Sigma conditions may use parentheses, IN lists and BETWEEN; row-only conjuncts are
+    tested before the group lookup.
+    """
+    spec = {"S": ["cust", "sum_1_quant"], "n": 1, "V": ["cust"], "F": ["avg_quant", "sum_1_quant"],
+            "sigma": ["1.state IN ('NY', 'NJ') and (1.quant BETWEEN 2 AND 4 or 1.quant > avg_quant)"], "G": ""}
+    source = generate_code(spec)
+    assert "if row[1] in {'NY', 'NJ'}:\n            g = index[" in source
+    module = types.ModuleType("_sigma_expressions")
+    exec(source, module.__dict__)
+    rows = [("Sam", "NY", 3), ("Sam", "NJ", 10), ("Sam", "CT", 4), ("Sam", "NY", 1), ("Ann", "NJ", 5)]
+    assert module.mf_output(module.mf_scans(rows)) == [{"cust": "Ann", "sum_1_quant": 0},
+                                                       {"cust": "Sam", "sum_1_quant": 13}]
+
+
+def test_string_literals_in_conditions():
+    """
+    Keywords, '=' and attribute references inside string constants are left as they are,
+    with and without predicate pushdown (on a temporary sales table of the connection).
+    """
+    spec = {"S": ["cust", "count_1_quant", "count_2_quant"], "n": 2, "V": ["cust"],
+            "F": ["count_1_quant", "count_2_quant"],
+            "sigma": ["1.state = 'OR'", "2.prod IN ('IN', 'a=b', '2.x') AND 2.state <> 'NJ'"], "G": ""}
+    assert plan_sales_query(spec)["query"] == ("SELECT cust, prod, state, quant FROM sales "
+                                              "WHERE (state = 'OR') OR (prod IN ('IN', 'a=b', '2.x'))")
+    load_dotenv()
+    conn = psycopg2.connect("dbname=" + os.getenv('DBNAME') + " user=" + os.getenv('USER')
+                            + " password=" + os.getenv('PASSWORD'))
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMPORARY TABLE sales (cust varchar(20), prod varchar(20), day integer, "
+                        "month integer, year integer, state character(2), quant integer, date date)")
+            cur.executemany("INSERT INTO sales VALUES (%s, %s, 1, 1, 2020, %s, %s, '2020-01-01')",
+                            [("Sam", "IN", "OR", 1), ("Sam", "a=b", "NY", 2), ("Sam", "2.x", "NJ", 3),
+                             ("Ann", "in", "or", 4), ("Ann", "Milk", "NY", 5)])
+        conn.commit()
+        expected = [{"cust": "Ann", "count_1_quant": 0, "count_2_quant": 0},
+                    {"cust": "Sam", "count_1_quant": 1, "count_2_quant": 2}]
+        for backend in ("python", "numpy"):
+            for pushdown in (True, False):
+                assert run_mf_query(spec, conn, backend=backend, pushdown=pushdown) == expected, (backend, pushdown)
+    finally:
+        conn.close()
+
+
+def test_bitmap_index():
+    """
+    Passes whose sigma compares columns to constants only visit the rows the bitmap
+    index selects, with the same result as full scans.
+    """
+    spec = {"S": ["cust", "sum_1_quant", "count_2_quant"], "n": 2, "V": ["cust"],
+            "F": ["avg_quant", "sum_1_quant", "count_2_quant"],
+            "sigma": ["1.state IN ('NY', 'CT') and 1.quant > avg_quant", "2.state = 'NJ' or 2.quant = 7"], "G": ""}
+    plain = types.ModuleType("_plain_bitmaps")
+    exec(generate_code(spec), plain.__dict__)
+    indexed = types.ModuleType("_bitmap_index")
+    exec(generate_code(spec, bitmap_index=True), indexed.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice("ABC"), rng.choice(["NY", "NJ", "CT", "PA"]), rng.randint(1, 9)) for _ in range(500)]
+    assert indexed.mf_output(indexed.mf_scans(rows)) == plain.mf_output(plain.mf_scans(rows))
+
+    bitmaps = indexed.BitmapIndex.from_rows(rows)
+    assert bitmaps.covers("state", "quant")
+    ny_or_nj = bitmaps.get("state", "NY") | bitmaps.get("state", "NJ")
+    assert list(indexed.bitmap_rows(rows, ny_or_nj)) == [row for row in rows if row[1] in ("NY", "NJ")]
+    assert list(indexed.bitmap_rows(rows, bitmaps.get("state", "TX"))) == []
+
+
+def test_profile():
+    """
+    An instrumented program counts the rows passing each sigma conjunct per pass and
+    computes the same result as the plain program.
+    """
+    spec = {"S": ["cust", "sum_1_quant"], "n": 1, "V": ["cust"], "F": ["sum_quant", "sum_1_quant"],
+            "sigma": ["1.state = 'NY' and 1.quant > 2"], "G": ""}
+    rows = [("Sam", "NY", 3), ("Sam", "NY", 1), ("Sam", "NJ", 4), ("Ann", "NY", 5)]
+    plain = types.ModuleType("_plain")
+    exec(generate_code(spec), plain.__dict__)
+    profiled = types.ModuleType("_profiled")
+    exec(generate_code(spec, profile=True), profiled.__dict__)
+    assert "perf_counter" not in generate_code(spec)
+
+    passes = []
+    mf = profiled.mf_scans(rows, passes=passes)
+    assert profiled.mf_output(mf) == plain.mf_output(plain.mf_scans(rows))
+    assert [(scan["pass"], scan["rows"]) for scan in passes] == [(0, 4), (1, 4)]
+    assert [(c["rows"], c["selectivity"]) for c in passes[1]["sigma"]["1"]] == [(3, 0.75), (2, 2 / 3)]
+
+
+def test_benchmark_data():
+    """
+    The synthetic sales data is reproducible and follows the requested shape, and the
+    Test_Queries specs generate runnable programs.
+    """
+    rows = list(generate_sales(2000, customers=10, products=5, state_skew=2.0, seed=1))
+    assert rows == list(generate_sales(2000, customers=10, products=5, state_skew=2.0, seed=1))
+    assert len({row[0] for row in rows}) == 10 and len({row[1] for row in rows}) == 5
+    states = [row[5] for row in rows]
+    assert states.count("NY") > states.count("NJ") > states.count("PA")
+    assert all(row[7].year == row[4] and row[7].month == row[3] and row[7].day == row[2] for row in rows)
+
+    specs = read_test_queries()
+    assert sorted(specs) == ["Q1", "Q2", "Q3", "Q4", "Q5"]
+    for spec in specs.values():
+        compile(generate_code(spec), "<generated>", "exec")
+
+
+def test_zone_maps():
+    """
+    Passes with range conditions on date-ordered rows only visit the blocks whose
+    zone map ranges may satisfy them, with the same result as full scans.
+    """
+    spec = {"S": ["cust", "sum_1_quant", "count_2_quant"], "n": 2, "V": ["cust"],
+            "F": ["sum_1_quant", "count_2_quant"],
+            "sigma": ["1.year = 2019 and 1.month < 4", "2.date BETWEEN '2020-02-01' AND '2020-02-29'"], "G": ""}
+    plain = types.ModuleType("_plain_zones")
+    exec(generate_code(spec), plain.__dict__)
+    zoned = types.ModuleType("_zone_maps")
+    exec(generate_code(spec, zone_maps=True), zoned.__dict__)
+    days = [datetime.date(2018, 1, 1) + datetime.timedelta(days=d) for d in range(3 * 365)]
+    rng = random.Random(562)
+    rows = [(rng.choice("ABC"), day.month, day.year, rng.randint(1, 9), day) for day in days for _ in range(10)]
+    assert zoned.mf_output(zoned.mf_scans(rows)) == plain.mf_output(plain.mf_scans(rows))
+
+    zones = zoned.ZoneMap(rows)
+    assert len(zones.blocks) == -(-len(rows) // zoned.BLOCK_SIZE)
+    in_2019 = list(zones.rows_where(lambda z: z["year"][0] <= 2019 <= z["year"][1]))
+    assert len(in_2019) < len(rows)
+    assert [row for row in in_2019 if row[2] == 2019] == [row for row in rows if row[2] == 2019]
+
+
+def test_dictionary_encoding():
+    """
+    Dictionary-encoded rows give the same output as the plain program, including
+    ordering comparisons and IN lists on encoded columns and values no row holds.
+    """
+    spec = {"S": ["cust", "prod", "sum_1_quant", "count_2_quant"], "n": 2, "V": ["cust", "prod"],
+            "F": ["avg_quant", "sum_1_quant", "count_2_quant"],
+            "sigma": ["1.state IN ('NY', 'TX') and 1.quant > avg_quant", "2.cust >= 'Bo' and 'NJ' <> 2.state"], "G": ""}
+    plain = types.ModuleType("_plain_codes")
+    exec(generate_code(spec), plain.__dict__)
+    encoded = types.ModuleType("_dictionary_encoding")
+    exec(generate_code(spec, dictionary_encoding=True), encoded.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice(["Ann", "Bob", "Sam"]), rng.choice("XYZ"), rng.choice(["NY", "NJ", "CT"]),
+             rng.randint(1, 9)) for _ in range(300)]
+    assert encoded.mf_output(encoded.mf_scans(rows)) == plain.mf_output(plain.mf_scans(rows))
+
+    encoded_rows, _, dictionaries = encoded.encode_rows(rows)
+    assert dictionaries["state"] == ["CT", "NJ", "NY"]
+    assert all(dictionaries["cust"][code] == row[0] for (code, *_), row in zip(encoded_rows, rows))
+    assert encoded.code_of(dictionaries["state"], "TX") == -1
+
+
+def test_order_by_limit():
+    """
+    O and L select the top groups by an aggregate (ties by V) after G, on both backends,
+    and an empty O skips the sort.
+    """
+    spec = {"S": ["cust", "prod", "sum_1_quant"], "n": 1, "V": ["cust", "prod"], "F": ["sum_1_quant"],
+            "sigma": ["1.quant > 2"], "G": "sum_1_quant > 0", "O": ["sum_1_quant DESC", "prod DESC"], "L": 3}
+    program = types.ModuleType("_top_k")
+    exec(generate_code(spec), program.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice("ABCD"), rng.choice("XYZ"), rng.randint(1, 9)) for _ in range(200)]
+    plain = types.ModuleType("_unordered")
+    exec(generate_code(dict(spec, O=[], L=None)), plain.__dict__)
+    groups = plain.mf_output(plain.mf_scans(rows))
+    expected = sorted(groups, key=lambda row: (row["cust"], row["prod"]))
+    expected = sorted(expected, key=lambda row: row["prod"], reverse=True)
+    expected = sorted(expected, key=lambda row: row["sum_1_quant"], reverse=True)[:3]
+    assert program.mf_output(program.mf_scans(rows)) == expected
+    assert "sorted(" not in generate_code(dict(spec, O=[], L=None)).split("def mf_output")[1]
+
+    numpy_source = generate_code(spec, backend="numpy")
+    compile(numpy_source, "_top_k_numpy", "exec")
+    assert "np.lexsort" in numpy_source and "selected[:3]" in numpy_source
+
+
+def test_memory_budget_partitions(tmp_path, monkeypatch):
+    """
+    Spilled partitions keep every group in one partition, and a run over partitions gives
+    the output of a single in-memory run.
+    """
+    spec = {"S": ["cust", "prod", "sum_quant", "count_1_quant"], "n": 1, "V": ["cust", "prod"],
+            "F": ["sum_quant", "count_1_quant"], "sigma": ["1.quant > 5"], "G": "sum_quant > 10",
+            "O": ["sum_quant DESC", "cust"], "L": 5}
+    budgeted = types.ModuleType("_memory_budget")
+    exec(generate_code(spec, memory_budget=64), budgeted.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice("ABCDEFG"), rng.choice("XYZ"), rng.randint(1, 9)) for _ in range(500)]
+
+    paths, spill_bytes = budgeted.spill_partitions(rows, 4, budgeted.GROUP_POSITIONS, str(tmp_path), "sales")
+    partitions = [budgeted.SpilledPartition(path) for path in paths]
+    assert spill_bytes > 0 and sorted(row for partition in partitions for row in partition) == sorted(rows)
+    # Every pass reads a partition back from its file
+    assert [list(partition) for partition in partitions] == [list(partition) for partition in partitions]
+    keys = [{row[:2] for row in partition} for partition in partitions]
+    assert sum(len(partition_keys) for partition_keys in keys) == len(set().union(*keys))
+
+    # A budget far below the groups of the sales table runs run_external() over many partitions;
+    # the last query pushes its sigma down, so its groups are partitioned from GROUPS_QUERY
+    pushed_down = {"S": ["cust", "prod", "count_1_quant"], "n": 1, "V": ["cust", "prod"], "F": ["count_1_quant"],
+                   "sigma": ["1.state = 'NY'"], "G": None}
+    assert plan_sales_query(pushed_down)["groups_query"]
+    for spec in (spec, dict(spec, L=None), pushed_down):
+        program = compile_mf_query(spec, memory_budget=1)
+        monkeypatch.setattr(program, "MAX_GROUPS", 8)
+        assert run_mf_query(spec, memory_budget=1) == run_mf_query(spec)
+    assert program.last_memory["mode"] == "external" and program.last_memory["partitions"] > 1
+    # Zone maps slice the rows by position, which the streamed partitions do not allow
+    with pytest.raises(ValueError):
+        generate_code(spec, memory_budget=64, zone_maps=True)
+
+    # Without the resource module (Windows) the report has no peak RSS
+    monkeypatch.setitem(sys.modules, "resource", None)
+    windows = types.ModuleType("_memory_budget_windows")
+    exec(generate_code(spec, memory_budget=64), windows.__dict__)
+    assert windows.memory_report("in-memory", 3)["peak_rss_bytes"] is None
+    windows.report_memory(windows.memory_report("in-memory", 3))
+
+
+def test_memory_budget_cli(tmp_path, monkeypatch, capsys):
+    """
+    A budgeted run of the CLI through the plan cache reports the memory use on stderr.
+    """
+    spec = read_json("input.json")
+    monkeypatch.chdir(tmp_path)  # main() writes _generated.py to the working directory
+    with open("input.json", "w") as f:
+        json.dump(spec, f)
+    generator(["--memory-budget", "64", "--cache-dir", str(tmp_path / "cache")])
+    out, err = capsys.readouterr()
+    assert normalize_output(out) == normalize_output(tabulate.tabulate(run_mf_query(spec), headers="keys",
+                                                                       tablefmt="psql"))
+    assert "in-memory execution:" in err and "peak RSS" in err
+
+
+def test_approximate_estimates():
+    """
+    On the whole table the estimates are exact with empty intervals; on a sample they are
+    scaled up, and G is uncertain when an interval straddles its threshold.
+    """
+    spec = {"S": ["cust", "sum_quant", "count_1_quant", "avg_1_quant", "max_quant"], "n": 1, "V": ["cust"],
+            "F": ["sum_quant", "count_1_quant", "avg_1_quant", "max_quant"], "sigma": ["1.quant > 5"],
+            "G": "sum_quant > 100"}
+    exact = types.ModuleType("_exact")
+    exec(generate_code(spec), exact.__dict__)
+    approximate = types.ModuleType("_approximate")
+    exec(generate_code(spec, approximate=50), approximate.__dict__)
+    rng = random.Random(562)
+    rows = [(rng.choice("ABC"), rng.randint(1, 9)) for _ in range(300)]
+
+    output_rows, max_error = approximate.mf_estimates(approximate.mf_scans(rows), 1.0)
+    assert max_error == 0 and all(row.pop("having") == "yes" for row in output_rows)
+    assert [{key: value for key, value in row.items() if not key.endswith("_ci")} for row in output_rows] \
+        == exact.mf_output(exact.mf_scans(rows))
+
+    sample = [("A", quant) for quant in range(1, 21)]
+    (row,), max_error = approximate.mf_estimates(approximate.mf_scans(sample), 0.5)
+    assert row["sum_quant"] == 2 * sum(quant for _, quant in sample) and row["sum_quant_ci"] > 0
+    assert row["avg_1_quant_ci"] > 0 and max_error > 0
+    assert row["having"] == ("yes" if row["sum_quant"] - row["sum_quant_ci"] > 100 else "uncertain")
+    assert approximate.iv_compare((90, 110), ">", (100, 100)) is None
+    assert approximate.iv_compare((101, 110), ">", (100, 100)) is True
+
+
+
+def test_sketch_aggregates():
+    """
+    Sketch aggregates are close to the exact distinct counts, percentiles and most frequent
+    values, and sketches of two halves of the rows merge into the sketch of all of them.
+    """
+    spec = {"S": ["cust", "count_distinct_1_prod", "median_quant", "p90_1_quant", "top_1_prod"], "n": 1,
+            "V": ["cust"], "F": ["count_distinct_1_prod", "median_quant", "p90_1_quant", "top_1_prod"],
+            "sigma": ["1.quant > 0"], "G": ""}
+    sketched = types.ModuleType("_sketched")
+    exec(generate_code(spec), sketched.__dict__)
+    rng = random.Random(562)
+    rows = [("A", rng.choice("pqrstu"), rng.randint(1, 1000)) for _ in range(5000)] + \
+        [("B", "p", quant) for quant in range(1, 11)] + [("B", "q", 3)]
+    (a, b) = sketched.mf_output(sketched.mf_scans(rows))
+    quants = sorted(quant for cust, _, quant in rows if cust == "A")
+    assert a["count_distinct_1_prod"] == 6 and a["top_1_prod"] in "pqrstu"
+    assert abs(a["median_quant"] - quants[len(quants) // 2]) <= 30
+    assert abs(a["p90_1_quant"] - quants[int(len(quants) * 0.9)]) <= 30
+    assert b == {"cust": "B", "count_distinct_1_prod": 2, "median_quant": 5, "p90_1_quant": 9, "top_1_prod": "p"}
+
+    left, right = sketched.HyperLogLog(*range(3000)), sketched.HyperLogLog(*range(2000, 6000))
+    assert abs(left.merge(right).estimate() - 6000) < 6000 * 0.1
+    evens, odds = sketched.KLLSketch(*range(0, 20000, 2)), sketched.KLLSketch(*range(1, 20000, 2))
+    assert abs(evens.merge(odds).quantile(0.5) - 10000) < 400 and evens.size < 3 * sketched.KLL_K
+    assert sketched.SpaceSaving(*"aaabbc").merge(sketched.SpaceSaving(*"ccccc")).top() == "c"
+
+
+def load_shard(path):
+    """
+    File-backed stand-in for a shard database: its pickled (sales_rows, group_rows).
+    """
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def test_sharded_execution(tmp_path):
+    """
+    Merging the partial aggregates of three shards, with groups spread over several of
+    them, gives the output of one mf_scans() over all their rows, including grouping
+    variables that depend on the merged aggregates of earlier rounds.
+    """
+    q5 = {"S": ["cust", "prod", "avg_quant", "min_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "n": 3, "V": ["cust", "prod"],
+          "F": ["avg_quant", "min_quant", "sum_1_quant", "avg_2_quant", "max_3_quant"],
+          "sigma": ["1.state = 'NY'",
+                    "2.state = 'NJ' and 2.quant > avg_quant",
+                    "3.state = 'CT' and 3.quant < avg_2_quant"],
+          "G": "max_3_quant > avg_quant"}
+    module = compile_mf_query(q5, shards=["east", "central", "west"])
+    assert module.ROUNDS == [[1], [2], [3]]
+    # String constants naming an aggregate are not references
+    literals = dict(q5, sigma=["1.state = 'NY'", "2.prod = 'avg_1_quant'", "3.prod = 'max_3_quant'"])
+    assert compile_mf_query(literals, shards=["east", "central", "west"]).ROUNDS == [[1, 2, 3]]
+    rng = random.Random(562)
+    rows = [(rng.choice(["Sam", "Bloom", "Emily", "Helen", "Knuth"]), rng.choice(["Apple", "Eggs", "Milk"]),
+             rng.choice(["NY", "NJ", "CT", "PA"]), rng.randint(1, 1000)) for _ in range(3000)]
+    loaders = []
+    for shard in range(3):
+        path = tmp_path / f"shard-{shard}.pickle"
+        path.write_bytes(pickle.dumps((rows[shard::3], None)))
+        loaders.append(functools.partial(load_shard, path))
+    expected = module.mf_output(module.mf_scans(rows))
+    assert module.mf_output(module.mf_sharded(loaders)) == expected
+    # Shard processes started with spawn import the program by module name
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method("spawn", force=True)
+    try:
+        assert module.mf_output(module.mf_sharded(loaders)) == expected
+    finally:
+        multiprocessing.set_start_method(start_method, force=True)
+
+
+def test_file_sources(tmp_path):
+    """
+    The same rows read from CSV, Parquet and Arrow IPC files, by both backends, give the
+    output of mf_scans() over the rows.
+    """
+    q4 = read_test_queries(["Q4"])["Q4"]
+    rows = list(generate_sales(3000, customers=10, products=5))
+    reference = types.ModuleType("_reference_q4")
+    exec(generate_code(q4, pushdown=False), reference.__dict__)
+    expected = reference.mf_output(reference.mf_scans(rows))
+    write_csv(str(tmp_path / "sales.csv"), rows)
+    write_arrow(str(tmp_path / "sales.parquet"), rows, chunk_size=1000)
+    write_arrow(str(tmp_path / "sales.arrow"), rows, chunk_size=700)
+    for backend in ("python", "numpy"):
+        for name in ("sales.csv", "sales.parquet", "sales.arrow"):
+            module = types.ModuleType("_source_q4")
+            exec(generate_code(q4, backend=backend, source=str(tmp_path / name), batch_size=500), module.__dict__)
+            assert module.run() == expected, (backend, name)
+
+
+def test_numpy_exact_sums(tmp_path):
+    """
+    The numpy backend sums quantities past 2 ** 53 exactly, like the row backend.
+    """
+    spec = {"S": ["cust", "sum_quant", "sum_1_quant"], "n": 1, "V": ["cust"], "F": ["sum_quant", "sum_1_quant"],
+            "sigma": ["1.state = 'NY'"], "G": None}
+    date = datetime.date(2020, 1, 1)
+    rows = [("Sam", "Apple", 1, 1, 2020, state, 2 ** 53 + 1, date) for state in ("NY", "NY", "NJ")]
+    write_csv(str(tmp_path / "sales.csv"), rows)
+    outputs = []
+    for backend in ("python", "numpy"):
+        module = types.ModuleType("_exact_sums")
+        exec(generate_code(spec, backend=backend, source=str(tmp_path / "sales.csv")), module.__dict__)
+        outputs.append(module.run())
+    assert outputs[0] == outputs[1] == [{"cust": "Sam", "sum_quant": 3 * (2 ** 53 + 1),
+                                         "sum_1_quant": 2 * (2 ** 53 + 1)}]
+
+
+def test_copy_ingest():
+    """
+    The numpy backend gives the same output through the binary COPY, whose decoder returns
+    the arrays of the tuple cursor and rejects the rows it cannot decode (here a NULL), so
+    copy_columns() falls back.
+    """
+    for name, spec in read_test_queries().items():
+        assert run_mf_query(spec, backend="numpy", copy=True) == run_mf_query(spec, backend="numpy"), name
+    plan = {"columns": ["cust", "quant", "date"], "query": "SELECT cust, quant, date FROM sales", "groups_query": None}
+    helpers, _ = generate_copy_ingest(plan, plan["columns"])
+    module = types.ModuleType("_copy_helpers")
+    exec("import numpy as np\n" + helpers, module.__dict__)
+
+    def row(cust, quant, date):
+        fields = struct.pack(">hi", 3, -1) if cust is None else struct.pack(">hi", 3, len(cust)) + cust
+        return fields + struct.pack(">iqii", 8, quant, 4, (date - datetime.date(2000, 1, 1)).days)
+    header = module.COPY_SIGNATURE + bytes(8)
+    rows = [("Zoë", 5, datetime.date(2019, 2, 1)), ("", 7, datetime.date(1999, 4, 3)),
+            ("Al", 9, datetime.date(2019, 2, 1)), ("Bobby", -11, datetime.date(2018, 6, 5)), ("Cy", 3, datetime.date(2020, 1, 1))]
+    columns = module.decode_copy([header + row(rows[0][0].encode(), *rows[0][1:])]
+                                 + [row(cust.encode(), quant, date) for cust, quant, date in rows[1:]] + [b"\xff\xff"])
+    assert {name: values.tolist() for name, values in columns.items()} == {
+        name: list(values) for name, values in zip(plan["columns"], zip(*rows))}
+    assert columns["cust"].dtype.kind == "U" and columns["quant"].dtype == "int64"
+    with pytest.raises(ValueError):
+        module.decode_copy([header + row(None, 1, datetime.date(2020, 1, 1)), b"\xff\xff"])
+
 if __name__ == "__main__":
     test_generator()